@@ -0,0 +1,645 @@
+#!/usr/bin/env python2.7
+#
+# This script contains the benchmarks used to measure the performance of the processing steps in this repository
+# against the implementations they replaced. Each benchmark checks that the old and new paths agree on its input
+# before reporting their timings, so it can also be used as a sanity check when Google changes its result pages.
+#
+# You will need to provide the following arguments to the argument parser for this script:
+#
+# * the benchmark to run
+# * the input used by the benchmark (see the description of each benchmark function)
+#
+
+# standard library imports
+from __future__ import division
+from argparse import ArgumentParser
+import BaseHTTPServer
+import gzip
+from math import ceil
+import operator as op
+import os
+from random import Random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib2
+import urlparse
+
+# third party imports
+from bs4 import BeautifulSoup, Comment
+import nltk
+from nltk.stem.porter import PorterStemmer
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# local imports
+from doc_fetcher import DocumentFetcher
+import google_query_similarity as gr
+from google_related_queries import (load_related_queries, run_google_related_queries,
+                                    run_google_related_queries_concurrent)
+from rate_limit import RateLimiter
+from refs import refs
+from serp_cache import DEFAULT_CACHE_DIR, SerpCache
+from trend_store import TrendStore, open_trends, scale_seed_trends
+
+
+def load_saved_serps(serp_dir):
+    """
+    Load every saved search result page in a directory. Both plain html files and gzip compressed entries of the
+    search result page cache are read.
+
+    :param serp_dir: The directory holding the saved pages
+    :return: The list of pages
+    """
+    pages = list()
+    for fname in sorted(os.listdir(serp_dir)):
+        name = os.path.join(serp_dir, fname)
+        if fname.endswith('.gz'):
+            with gzip.open(name, 'rb') as f:
+                pages.append(f.read())
+        elif fname.endswith('.html') or fname.endswith('.htm'):
+            with open(name, 'rb') as f:
+                pages.append(f.read())
+    return pages
+
+
+def report(name, seconds, count, unit):
+    """
+    Print the timing of a benchmarked path.
+
+    :param name: Name of the path
+    :param seconds: Total time taken
+    :param count: Number of items processed in that time
+    :param unit: Name of the items processed
+    :return: None
+    """
+    rate = 0.0
+    if seconds > 0:
+        rate = count / seconds
+    print '\t{}:\t{:.3f}s\t{:.1f} {}/s'.format(name, seconds, rate, unit)
+
+
+def bench_serp_extraction(serp_dir, repeat=3):
+    """
+    Compare the single pass extraction of search result pages (extract_serp) with the two BeautifulSoup parses done by
+    get_google_related_searches and get_google_query_summary_set.
+
+    :param serp_dir: The directory holding the saved pages, such as the search result page cache directory
+    :param repeat: Number of times to run each path, the best time is reported
+    :return: None
+    """
+    pages = load_saved_serps(serp_dir)
+    print 'SERP extraction over {} pages'.format(len(pages))
+    if not pages:
+        return
+
+    mismatches = 0
+    for page in pages:
+        serp = gr.extract_serp(page)
+        try:
+            rs = gr.get_google_related_searches(page)
+        except AttributeError:
+            # The two parse path fails on pages without related searches, for which extract_serp gives None.
+            rs = None
+        if serp.related_searches != rs or serp.summary_set != gr.get_google_query_summary_set(page):
+            mismatches += 1
+    print '\tpages with differing output: {}'.format(mismatches)
+
+    def two_parse():
+        for page in pages:
+            try:
+                gr.get_google_related_searches(page)
+            except AttributeError:
+                pass
+            gr.get_google_query_summary_set(page)
+
+    def single_pass():
+        for page in pages:
+            gr.extract_serp(page)
+
+    report('two parses', min(timeit.repeat(two_parse, number=1, repeat=repeat)), len(pages), 'pages')
+    report('single pass', min(timeit.repeat(single_pass, number=1, repeat=repeat)), len(pages), 'pages')
+
+
+def legacy_query_expansion_vector(vec):
+    """
+    The dense query expansion vector computation replaced by the sparse get_query_expansion_vector, kept for
+    comparison.
+
+    :param vec: A dense tf-idf matrix
+    :return: The expansion vector for the matrix
+    """
+    def tfidf_normalize(row):
+        return row/np.linalg.norm(row, 2)
+
+    normalized = np.apply_along_axis(tfidf_normalize, axis=1, arr=vec)
+    centroid = np.sum(normalized, axis=0)
+    return centroid/np.linalg.norm(centroid, 2)
+
+
+def bench_query_expansion(serp_dir, repeat=3):
+    """
+    Compare the sparse query expansion vectors with the dense ones computed from tfs.toarray() through
+    np.apply_along_axis. The first saved page is used as the reference query and every other page as a candidate, the
+    tf-idf matrices of each pair being fitted as in get_tfidf_matrices before the timed part.
+
+    :param serp_dir: The directory holding the saved pages, such as the search result page cache directory
+    :param repeat: Number of times to run each path, the best time is reported
+    :return: None
+    """
+    pages = load_saved_serps(serp_dir)
+    expansion_sets = [gr.extract_serp(page).summary_set for page in pages]
+    expansion_sets = [es for es in expansion_sets if es]
+    print 'Query expansion vectors over {} pairs'.format(max(len(expansion_sets) - 1, 0))
+    if len(expansion_sets) < 2:
+        return
+
+    es_q = expansion_sets[0]
+    pairs = list()
+    dense_bytes = 0
+    sparse_bytes = 0
+    for es_c in expansion_sets[1:]:
+        tfs = TfidfVectorizer(tokenizer=gr.word_tokenize, stop_words='english').fit_transform(es_q + es_c)
+        pairs.append((len(es_q), tfs))
+        dense_bytes += tfs.shape[0] * tfs.shape[1] * np.dtype(np.float64).itemsize
+        sparse_bytes += tfs.data.nbytes + tfs.indices.nbytes + tfs.indptr.nbytes
+    print '\tmean documents x terms: {:.0f} x {:.0f}'.format(np.mean([t.shape[0] for (l, t) in pairs]),
+                                                            np.mean([t.shape[1] for (l, t) in pairs]))
+    print '\tmean tf-idf matrix size:\tdense {:.1f} KB\tsparse {:.1f} KB'.format(dense_bytes / len(pairs) / 1024,
+                                                                                   sparse_bytes / len(pairs) / 1024)
+
+    max_diff = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (lq, tfs) in pairs:
+            vectors = tfs.toarray()
+            dense = np.inner(legacy_query_expansion_vector(vectors[0:lq]), legacy_query_expansion_vector(vectors[lq:]))
+            sparse = np.inner(gr.get_query_expansion_vector(tfs[0:lq]), gr.get_query_expansion_vector(tfs[lq:]))
+            if np.isfinite(dense):
+                max_diff = max(max_diff, abs(dense - sparse))
+    print '\tlargest kernel value difference: {:.3g}'.format(max_diff)
+
+    def dense_path():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for (lq, tfs) in pairs:
+                vectors = tfs.toarray()
+                legacy_query_expansion_vector(vectors[0:lq])
+                legacy_query_expansion_vector(vectors[lq:])
+
+    def sparse_path():
+        for (lq, tfs) in pairs:
+            gr.get_query_expansion_vector(tfs[0:lq])
+            gr.get_query_expansion_vector(tfs[lq:])
+
+    report('dense', min(timeit.repeat(dense_path, number=1, repeat=repeat)), len(pairs), 'pairs')
+    report('sparse', min(timeit.repeat(sparse_path, number=1, repeat=repeat)), len(pairs), 'pairs')
+
+
+def legacy_word_tokenize(text):
+    """
+    The tokenization replaced by the cached word_tokenize, building a new stemmer and stemming every token on each
+    call, kept for comparison.
+
+    :param text: The text to tokenize
+    :return: A list of stemmed tokens from the input text
+    """
+    stemmer = PorterStemmer()
+    return [stemmer.stem(t) for t in nltk.word_tokenize(text.lower())]
+
+
+def bench_tokenization(serp_dir, repeat=3):
+    """
+    Compare the tokenization throughput of word_tokenize, with its shared stemmer and its stem and snippet caches, with
+    the previous implementation over the summary sets of the saved pages. The cached path is timed from empty caches
+    (cold) and over a second pass (warm), as when the same snippets show up again in a crawl or in a rerun.
+
+    :param serp_dir: The directory holding the saved pages, such as the search result page cache directory
+    :param repeat: Number of times to run the uncached and cold paths, the best time is reported
+    :return: None
+    """
+    pages = load_saved_serps(serp_dir)
+    snippets = list()
+    for page in pages:
+        snippets.extend(gr.extract_serp(page).summary_set)
+    print 'Tokenization over {} snippets'.format(len(snippets))
+    if not snippets:
+        return
+
+    ntokens = sum(len(legacy_word_tokenize(s)) for s in snippets)
+    mismatches = sum(1 for s in snippets if gr.word_tokenize(s) != legacy_word_tokenize(s))
+    print '\tsnippets with differing tokens: {}'.format(mismatches)
+
+    def legacy():
+        for s in snippets:
+            legacy_word_tokenize(s)
+
+    def cached():
+        for s in snippets:
+            gr.word_tokenize(s)
+
+    def cold():
+        gr._stem_cache = gr.LRUCache(gr.STEM_CACHE_SIZE)
+        gr._token_cache = gr.TokenCache(gr.TOKEN_CACHE_SIZE)
+        cached()
+
+    report('uncached', min(timeit.repeat(legacy, number=1, repeat=repeat)), ntokens, 'tokens')
+    report('cached, cold', min(timeit.repeat(cold, number=1, repeat=repeat)), ntokens, 'tokens')
+    report('cached, warm', min(timeit.repeat(cached, number=1, repeat=1)), ntokens, 'tokens')
+
+
+def legacy_scale_seed_trends(frames, ref):
+    """
+    The scaling of the trends of a seed replaced by scale_seed_trends, going through the files one at a time and growing
+    the result with pd.concat, kept for comparison.
+
+    :param frames: The dictionary of the DataFrame of every file of the seed directory by label
+    :param ref: The reference of the seed
+    :return: The DataFrame of the scaled trends, None if the reference has no trend data
+    """
+    if ref not in frames:
+        return None
+    ref_df = frames[ref]
+    ref_vals_scaled = ref_df[ref]
+
+    resultdf = pd.DataFrame()
+    date_col_added = False
+    for label in sorted(frames):
+        df = frames[label]
+        query = df.columns[1]
+        query_vals = df[query]
+        if not (query_vals > 0).any():
+            continue
+
+        ref_vals = df[ref]
+        if not (ref_vals > 0).any():
+            continue
+
+        max_ref_val = max(ref_vals)
+        scale_factor = 100/max_ref_val
+        do_scale = lambda x: int(ceil(x*scale_factor))
+        ref_vals = ref_vals.apply(do_scale)
+        scaled_diff = sum(map(op.abs, map(op.sub, ref_vals, ref_vals_scaled)))
+        if scaled_diff > int(ref_df.shape[0]*2.5):
+            continue
+
+        if not date_col_added:
+            resultdf = pd.concat([resultdf, df.ix[:, 0]], axis=1)
+            date_col_added = True
+        resultdf = pd.concat([resultdf, query_vals.apply(do_scale)], axis=1)
+    return resultdf
+
+
+def bench_trend_scaling(trends_dir, repeat=3):
+    """
+    Compare the scaling of the trends of every seed of a collection mode by scale_seed_trends with the previous per file
+    implementation. The files are read before the timed part, into memory for the previous implementation and into a
+    trend store for scale_seed_trends, unless the directory already is one.
+
+    :param trends_dir: The collection mode directory compared with the seeds (e.g. ./gtrends/with_seed_cmp/), or its
+                       trend store
+    :param repeat: Number of times to run each path, the best time is reported
+    :return: None
+    """
+    trends = open_trends(trends_dir)
+    if not isinstance(trends, TrendStore):
+        trends = TrendStore.build(trends)
+
+    seeds = list()
+    for seed_dir in trends.seeds():
+        seed = seed_dir[:-len(' comp')] if seed_dir.endswith(' comp') else seed_dir
+        frames = dict((label, trends.frame(seed_dir, label)) for label in trends.files(seed_dir))
+        seeds.append((seed_dir, refs.get(seed, seed), frames))
+    print 'Trend scaling over {} seeds, {} files'.format(len(seeds), sum(len(f) for (s, r, f) in seeds))
+    if not seeds:
+        return
+
+    mismatches = 0
+    for (seed_dir, ref, frames) in seeds:
+        legacy = legacy_scale_seed_trends(frames, ref)
+        scaled = scale_seed_trends(trends, seed_dir, ref)
+        if legacy is None or scaled is None:
+            mismatches += (legacy is None) != (scaled is None)
+        elif list(legacy.columns) != list(scaled.columns) or not (legacy.values == scaled.values).all():
+            mismatches += 1
+    print '\tseeds with differing output: {}'.format(mismatches)
+
+    def per_file():
+        for (seed_dir, ref, frames) in seeds:
+            legacy_scale_seed_trends(frames, ref)
+
+    def vectorized():
+        for (seed_dir, ref, frames) in seeds:
+            scale_seed_trends(trends, seed_dir, ref)
+
+    nfiles = sum(len(f) for (s, r, f) in seeds)
+    report('per file', min(timeit.repeat(per_file, number=1, repeat=repeat)), nfiles, 'files')
+    report('vectorized', min(timeit.repeat(vectorized, number=1, repeat=repeat)), nfiles, 'files')
+
+
+# Pages served by the local stand-in server of bench_doc_fetcher, as (Content-Type, body), and their visible text.
+FETCH_FIXTURES = {
+    '/plain': ('text/html',
+               '<html><head><title>Privacy</title><style>p { color: red; }</style></head><body>'
+               '<!-- not shown --><h1>Privacy settings</h1><p>Change who can see <b>your</b> posts.</p>'
+               '<script>var shown = false;</script>Last updated in May.</body></html>'),
+    '/utf8': ('text/html; charset=utf-8',
+              u'<html><body><p>Caf\xe9 na\xefve r\xe9sum\xe9</p></body></html>'.encode('utf-8')),
+    '/latin1': ('text/html; charset=iso-8859-1',
+                u'<html><body><p>Caf\xe9 na\xefve</p></body></html>'.encode('latin-1')),
+    '/meta': ('text/html',
+              u'<html><head><meta charset="utf-8"></head><body><p>Stra\xdfe</p></body></html>'.encode('utf-8')),
+}
+FETCH_EXPECTED = {
+    '/plain': u'Privacy settings Change who can see your posts. Last updated in May.',
+    '/utf8': u'Caf\xe9 na\xefve r\xe9sum\xe9',
+    '/latin1': u'Caf\xe9 na\xefve',
+    '/meta': u'Stra\xdfe',
+}
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            fixture = self.fixture()
+            if fixture is not None:
+                content_type, body = fixture
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def fixture(self):
+        # The fixture at the path of the request, whatever its query string.
+        return self.server.fixtures.get(self.path.split('?')[0])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SerpFixtureHandler(FixtureHandler):
+    def fixture(self):
+        # The search results page of the query of the request, whatever its path.
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('q')
+        if query is None or query[0] not in self.server.fixtures:
+            return None
+        return 'text/html; charset=utf-8', self.server.fixtures[query[0]]
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay, fixtures=FETCH_FIXTURES, handler=FixtureHandler):
+        """
+        Start a local stand-in server of the fixtures on a free port, in a thread of its own. Other requests get a 404.
+
+        :param delay: The number of seconds to wait before answering each request
+        :param fixtures: The fixtures served, as looked up by the handler
+        :param handler: The request handler, FixtureHandler serving FETCH_FIXTURES-like fixtures by path or
+                        SerpFixtureHandler serving search result pages by query
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.delay = delay
+        self.fixtures = fixtures
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # The fetcher gives up on the slow server before it answers.
+        pass
+
+
+def legacy_get_visible_text(url):
+    """
+    The fetching and visible text extraction replaced by DocumentFetcher, one page at a time with no timeout, kept for
+    comparison. Comments are left out as the `visible` filter of deprecated/query_clarity_score.py meant to.
+
+    :param url: The url of the page
+    :return: The visible text, None if the page could not be fetched
+    """
+    try:
+        page = urllib2.urlopen(url).read()
+    except Exception:
+        return None
+    texts = BeautifulSoup(page, 'html.parser').findAll(text=True)
+    return ' '.join(t for t in texts if t.parent.name not in ['style', 'script', '[document]', 'head', 'title']
+                    and not isinstance(t, Comment))
+
+
+def bench_doc_fetcher(count=20, repeat=3):
+    """
+    Compare the concurrent fetching and extraction of DocumentFetcher with fetching the pages one at a time, against
+    local stand-in servers of FETCH_FIXTURES: two hosts answering after 0.1s, and one answering after 3s, longer than
+    the 1s timeout of the fetcher, along with a 404. The visible text of every fixture page is checked first, including
+    the pages in other encodings than ASCII.
+
+    :param count: Number of pages fetched from each of the two fast hosts
+    :param repeat: Number of times to run each path, the best time is reported
+    :return: None
+    """
+    hosts = [FixtureServer(0.1), FixtureServer(0.1)]
+    slow = FixtureServer(3)
+    fetcher = DocumentFetcher(workers=16, per_host=2, timeout=1)
+
+    paths = sorted(FETCH_FIXTURES)
+    texts = fetcher.get_texts([hosts[0].url + p for p in paths] + [hosts[0].url + '/missing'])
+    mismatches = sum(1 for (p, t) in zip(paths, texts) if t is None or u' '.join(t.split()) != FETCH_EXPECTED[p])
+    legacy = [legacy_get_visible_text(hosts[0].url + p) for p in paths]
+    legacy_mismatches = sum(1 for (p, t) in zip(paths, legacy) if u' '.join(t.split()) != FETCH_EXPECTED[p])
+    print 'Document fetching of {} fixture pages'.format(len(paths))
+    print '\tpages with differing text: {}\t(one at a time: {})'.format(mismatches, legacy_mismatches)
+    print '\tmissing page failed: {}'.format(texts[-1] is None)
+
+    start = time.time()
+    texts = fetcher.get_texts([slow.url + '/plain', hosts[0].url + '/plain'])
+    print '\tslow host failed: {}\tin {:.1f}s'.format(texts[0] is None and texts[1] is not None, time.time() - start)
+
+    urls = ['{}/plain?{}'.format(h.url, i) for i in range(count) for h in hosts]
+    print 'Document fetching over {} pages from {} hosts'.format(len(urls), len(hosts))
+
+    def one_at_a_time():
+        for url in urls:
+            legacy_get_visible_text(url)
+
+    def concurrent():
+        fetcher.get_documents(urls)
+
+    report('one at a time', min(timeit.repeat(one_at_a_time, number=1, repeat=repeat)), len(urls), 'pages')
+    report('concurrent', min(timeit.repeat(concurrent, number=1, repeat=repeat)), len(urls), 'pages')
+    print '\tmost requests in flight to a host: {}'.format(max(h.peak for h in hosts))
+
+    for server in hosts + [slow]:
+        server.shutdown()
+
+
+# The seed of bench_crawl, and the words of the snippets of its related (on topic) and unrelated (off topic) queries.
+CRAWL_SEED = 'privacy settings'
+CRAWL_ON_TOPIC = ['privacy', 'settings', 'account', 'profile', 'share', 'visible', 'friends', 'public', 'control',
+                  'data', 'permission', 'block', 'hide', 'post', 'photo', 'location', 'tracking', 'personal']
+CRAWL_OFF_TOPIC = ['recipe', 'chocolate', 'cake', 'oven', 'butter', 'flour', 'sugar', 'bake', 'frosting', 'vanilla']
+
+
+def serp_fixture(snippets, related):
+    """
+    Build a search results page laid out as the ones extract_serp handles.
+
+    :param snippets: The summary text of every result
+    :param related: The related searches of the page, None for a page without a related searches section
+    :return: The page
+    """
+    results = ''.join('<div class="g"><div class="rc"><h3 class="r"><a href="http://example.com/{}">Result {}</a>'
+                      '</h3><div class="s"><span class="st">{}</span></div></div></div>'.format(i, i, snippet)
+                      for (i, snippet) in enumerate(snippets))
+    brs = ''
+    if related is not None:
+        brs = '<div id="brs"><div class="brs_col">{}</div></div>'.format(
+            ''.join('<p class="_e4b">{}</p>'.format(rs) for rs in related))
+    return '<html><body><div id="ires">{}</div>{}</body></html>'.format(results, brs)
+
+
+def crawl_fixtures():
+    """
+    Generate the search results pages of bench_crawl: the seed and its related searches, mostly on topic with a few
+    off topic ones so that the threshold rejects some, each linking to related searches met elsewhere in the crawl.
+    One page has no related searches section, so that the crawl skips it.
+
+    :return: Dictionary mapping each query to its page
+    """
+    rand = Random(0)
+    on_topic = ['{} {}'.format(CRAWL_SEED, w) for w in CRAWL_ON_TOPIC[2:]]
+    off_topic = ['{} {}'.format(w, CRAWL_OFF_TOPIC[0]) for w in CRAWL_OFF_TOPIC[1:]]
+
+    def snippets(words, noise):
+        return [' '.join(rand.sample(words, 6) + rand.sample(noise, 2)) for _ in range(10)]
+
+    pages = dict()
+    pages[CRAWL_SEED] = serp_fixture(snippets(CRAWL_ON_TOPIC, CRAWL_ON_TOPIC), on_topic[:6] + off_topic[:2])
+    for q in on_topic:
+        related = rand.sample(on_topic, 3) + rand.sample(off_topic, 1)
+        pages[q] = serp_fixture(snippets(CRAWL_ON_TOPIC, CRAWL_OFF_TOPIC), related)
+    for q in off_topic:
+        pages[q] = serp_fixture(snippets(CRAWL_OFF_TOPIC, CRAWL_ON_TOPIC), rand.sample(off_topic, 2))
+    pages[on_topic[-1]] = serp_fixture(snippets(CRAWL_ON_TOPIC, CRAWL_OFF_TOPIC), None)
+    return pages
+
+
+def run_crawl(crawl, server):
+    """
+    Run a related query crawl of CRAWL_SEED against a local stand-in search server, in a temporary directory holding
+    its data files and an empty search result page cache. The output of the crawl is discarded.
+
+    :param crawl: The crawl to run, called with the seed
+    :param server: The FixtureServer of the search results pages
+    :return: The approved and rejected queries of the crawl and its duration as a tuple (approved, rejected, seconds)
+    """
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        os.chdir(directory)
+        os.makedirs('googledata')
+        gr.set_serp_cache(SerpCache(os.path.join(directory, 'cache')))
+        gr.set_search_url(server.url + '/search')
+
+        with open(os.devnull, 'w') as sys.stdout:
+            start = time.time()
+            crawl(CRAWL_SEED)
+            seconds = time.time() - start
+        sys.stdout = stdout
+
+        approved, rejected = load_related_queries(CRAWL_SEED)
+    finally:
+        sys.stdout = stdout
+        gr.set_serp_cache(None)
+        gr.set_search_url(gr.SEARCH_URL)
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return approved, rejected, seconds
+
+
+def bench_crawl(limit=3, workers=8, repeat=3):
+    """
+    Compare the concurrent related query crawl (run_google_related_queries_concurrent) with the serial one, against a
+    local stand-in search server answering after 0.05s with the pages of crawl_fixtures. The approved and rejected
+    queries of both crawls are checked to be the same, in the same order, before reporting their timings.
+
+    :param limit: The iteration limit of the crawls
+    :param workers: The number of requests in flight of the concurrent crawl
+    :param repeat: Number of times to run each crawl, the best time is reported
+    :return: None
+    """
+    server = FixtureServer(0.05, crawl_fixtures(), SerpFixtureHandler)
+
+    # No keyword limit against the local server.
+    def serial(seed):
+        run_google_related_queries(seed, limit, None)
+
+    def concurrent(seed):
+        run_google_related_queries_concurrent(seed, limit, None, workers, limiter=RateLimiter(3600000, jitter=0))
+
+    approved, rejected, _ = run_crawl(serial, server)
+    print 'Related query crawl of {} fixture pages'.format(len(server.fixtures))
+    print '\tapproved: {}\trejected: {}'.format(len(approved), len(rejected))
+
+    timings = dict()
+    mismatches = 0
+    for (name, crawl) in [('serial', serial), ('concurrent', concurrent)]:
+        timings[name] = list()
+        for _ in range(repeat):
+            (a, r, seconds) = run_crawl(crawl, server)
+            timings[name].append(seconds)
+            if a != approved or r != rejected:
+                mismatches += 1
+    print '\tcrawls with differing approved/rejected queries: {}'.format(mismatches)
+
+    report('serial', min(timings['serial']), len(approved) + len(rejected), 'queries')
+    report('concurrent', min(timings['concurrent']), len(approved) + len(rejected), 'queries')
+    print '\tmost requests in flight: {}'.format(server.peak)
+
+    server.shutdown()
+
+
+def main():
+    ap = ArgumentParser(description='Benchmark the processing steps against the implementations they replaced.')
+    ap.add_argument('-b', '-bench', help='Benchmark to run', required=True,
+                    choices=['serp', 'qe', 'tokens', 'scaling', 'fetch', 'crawl'])
+    ap.add_argument('-d', '-dir', help='Directory containing the saved search result pages, or the trends data for '
+                                       'the scaling benchmark', default=DEFAULT_CACHE_DIR)
+    ap.add_argument('-r', '-repeat', help='Number of timing repeats', default=3, type=int)
+
+    args = ap.parse_args()
+
+    if args.b == 'serp':
+        bench_serp_extraction(args.d, args.r)
+    elif args.b == 'qe':
+        bench_query_expansion(args.d, args.r)
+    elif args.b == 'tokens':
+        bench_tokenization(args.d, args.r)
+    elif args.b == 'scaling':
+        bench_trend_scaling(args.d, args.r)
+    elif args.b == 'fetch':
+        bench_doc_fetcher(repeat=args.r)
+    elif args.b == 'crawl':
+        bench_crawl(repeat=args.r)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#
+# This file contains the write-ahead journal of the related query crawl (see google_related_queries.py).
+#
+# The approved and rejected queries and the scrape state of a crawl are only saved from time to time, while every
+# candidate costs a rate limited Google request. To avoid losing these requests when a crawl dies, the result of every
+# processed candidate (query, parent, kernel value and related searches) is appended to the journal of the seed as
+# soon as it is known.
+#
+# When a crawl resumes, it starts over from the last saved state and the journal is replayed: the crawl goes through the
+# candidates in the same order as before, and every candidate found in the journal takes its recorded result instead
+# of being fetched again. The journal is compacted each time the state gets saved, since the saved state then covers
+# every candidate in it, and the crawl saves its state every COMPACT_INTERVAL candidates.
+#
+
+# standard library imports
+from collections import deque
+import os
+import pickle
+
+
+COMPACT_INTERVAL = 100
+
+class CrawlJournal(object):
+    def __init__(self, seed):
+        """
+        Create the journal of the crawl for a given query seed.
+
+        :param seed: The root query of the crawl. The seed should only contain alphanumeric characters and
+                     spaces/underscores as the seed is used to generate the journal file.
+        """
+        self.seed = seed
+        self.filename = './googledata/' + seed.replace(' ', '_') + '_journal'
+        self.appended = 0
+        self._replay = dict()
+
+    def load(self):
+        """
+        Load the results recorded in the journal for replay. A record cut short by a crash at the end of the journal is
+        discarded.
+
+        :return: The number of results loaded
+        """
+        self._replay = dict()
+        if not os.path.isfile(self.filename):
+            return 0
+
+        loaded = 0
+        with open(self.filename, 'rb') as f:
+            good = 0
+            while True:
+                try:
+                    (candidate, parent, kval, related) = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # Truncated last record.
+                    break
+                self._replay.setdefault(candidate, deque()).append((parent, kval, related))
+                loaded += 1
+                good = f.tell()
+
+        # Drop anything past the last complete record
+        # so that new records get appended after it.
+        with open(self.filename, 'ab') as f:
+            f.truncate(good)
+        return loaded
+
+    def __contains__(self, candidate):
+        return candidate in self._replay
+
+    def replayed(self, candidate):
+        """
+        Take the next recorded result for a candidate, if any.
+
+        :param candidate: The candidate query
+        :return: The result of the candidate as a tuple (kernel value, related searches), or None if there is no result
+                 left to replay for it
+        """
+        results = self._replay.get(candidate)
+        if not results:
+            return None
+        (parent, kval, related) = results.popleft()
+        if not results:
+            del self._replay[candidate]
+        return kval, related
+
+    def append(self, candidate, parent, kval, related):
+        """
+        Record the result of a processed candidate, making sure it is on disk before returning.
+
+        :param candidate: The candidate query
+        :param parent: The query the candidate is a related search of
+        :param kval: The kernel value of the candidate, None if its search results could not be processed
+        :param related: The related searches of the candidate
+        :return: None
+        """
+        with open(self.filename, 'ab') as f:
+            pickle.dump((candidate, parent, kval, list(related)), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        self.appended += 1
+
+    def compact(self):
+        """
+        Drop the records covered by the state just saved. Only the results still waiting to be replayed are kept.
+
+        :return: None
+        """
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            for (candidate, results) in self._replay.iteritems():
+                for (parent, kval, related) in results:
+                    pickle.dump((candidate, parent, kval, related), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_name, self.filename)
+        self.appended = 0
+
+
+class JournalResult(object):
+    def __init__(self, journal, candidate):
+        """
+        A result to be taken from the journal, standing in for a pending fetch of the concurrent crawl. The result stays
+        in the journal until it is taken, so that it is not lost if the journal is compacted in the meantime.
+
+        :param journal: The journal holding the result
+        :param candidate: The candidate query
+        """
+        self.journal = journal
+        self.candidate = candidate
+
+    def get(self):
+        kval, related = self.journal.replayed(self.candidate)
+        return kval, related, None
@@ -0,0 +1,218 @@
+#
+# This file contains the fetching of the documents behind search result URLs and the extraction of their visible text,
+# used for the clarity score over the visible text of the results (see query_clarity.py).
+#
+# The pages are fetched by a bounded pool of threads with a timeout on every request and a limit on the number of
+# requests in flight to any one host, so that a slow or unresponsive host only holds up its own pages. The visible text
+# of each page is extracted in a pool of worker processes as soon as the page arrives, while the other pages are still
+# being fetched. The extraction parses the page with lxml and keeps the text that is not inside a style, script, head
+# or title element, nor in a comment, which is the text the BeautifulSoup based `visible` filter of
+# deprecated/query_clarity_score.py was meant to keep.
+#
+# The extracted text of every page is kept in a document cache, with the same policies as the search result page
+# cache (see serp_cache.py), so that rerunning the clarity scores does not fetch the pages again.
+#
+# The fetching and extraction can be checked against local stand-in servers with `benchmarks.py -b fetch`.
+#
+
+# standard library imports
+from collections import OrderedDict
+from itertools import izip_longest
+from multiprocessing.pool import ThreadPool
+import ssl
+import threading
+import urllib2
+import urlparse
+
+# third party imports
+from bs4 import UnicodeDammit
+from lxml import etree
+import lxml.html
+
+# local imports
+from serp_cache import DEFAULT_MAX_BYTES, DEFAULT_TTL, SerpCache
+
+
+DEFAULT_DOC_CACHE_DIR = './doccache/'
+USER_AGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_4) AppleWebKit/536.11 (KHTML, like Gecko) '
+              'Chrome/20.0.1132.57 Safari/536.11')
+INVISIBLE_TAGS = frozenset(['style', 'script', 'head', 'title'])
+
+_utf8_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def visible_text(page, charset=None):
+    """
+    Extract the visible text of an html page.
+
+    :param page: The html page
+    :param charset: The charset of the page given by the Content-Type header of the response, if any
+    :return: The visible text as a string, None if the page could not be parsed
+    """
+    # Decode the page with the charset of the response, or else the one
+    # it declares or the one it looks like, as BeautifulSoup does, since
+    # lxml would take a page without a meta charset for Latin-1.
+    if not isinstance(page, unicode):
+        page = UnicodeDammit(page, [charset] if charset else [], is_html=True).unicode_markup
+        if page is None:
+            return None
+    try:
+        root = lxml.html.fromstring(page.encode('utf-8'), parser=_utf8_parser)
+    except (etree.ParserError, ValueError):
+        return None
+
+    texts = list()
+    for element in root.iter():
+        # The text of an element is inside it, its tail inside its parent.
+        if isinstance(element.tag, basestring) and element.tag not in INVISIBLE_TAGS and element.text:
+            texts.append(element.text)
+        parent = element.getparent()
+        if parent is not None and parent.tag not in INVISIBLE_TAGS and element.tail:
+            texts.append(element.tail)
+    return u' '.join(unicode(t) for t in texts)
+
+
+class DocumentCache(SerpCache):
+    def __init__(self, directory=DEFAULT_DOC_CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        """
+        Create a cache of the visible text of documents backed by a directory, see SerpCache for the parameters.
+        """
+        super(DocumentCache, self).__init__(directory, ttl, max_bytes, offline)
+
+    def get_document(self, url):
+        """
+        Look up the visible text of a document in the cache.
+
+        :param url: The url of the document
+        :return: The visible text, or None on a miss
+        """
+        text = self.get(url, 0, 'text')
+        if text is not None:
+            text = text.decode('utf-8')
+        return text
+
+    def put_document(self, url, text):
+        """
+        Store the visible text of a document in the cache.
+
+        :param url: The url of the document
+        :param text: The visible text
+        :return: None
+        """
+        self.put(url, 0, 'text', text.encode('utf-8'))
+
+
+class DocumentFetcher(object):
+    def __init__(self, workers=16, per_host=2, timeout=10, cache=None, extract_pool=None):
+        """
+        Create a fetcher of documents.
+
+        :param workers: The maximum number of requests in flight
+        :param per_host: The maximum number of requests in flight to the same host
+        :param timeout: The number of seconds to wait on a connection or a read before giving up on a document
+        :param cache: The DocumentCache to use, None for no cache
+        :param extract_pool: A pool of worker processes to extract the visible text in, this process if None. It should
+                             be started before any fetch, as threads and forked processes do not mix.
+        """
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.extract_pool = extract_pool
+        self.fetched = 0
+        self.failed = 0
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlparse.urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def fetch_page(self, url):
+        """
+        Fetch the page of a url, waiting for a slot of its host first.
+
+        :param url: The url
+        :return: The page and the charset given by the response, if any, or None if the page could not be fetched in
+                 time
+        """
+        request = urllib2.Request(url, None, {'User-Agent': USER_AGENT})
+        opt_out_context = ssl._create_unverified_context()
+        slot = self._host_slot(url)
+        with slot:
+            try:
+                urlfile = urllib2.urlopen(request, timeout=self.timeout, context=opt_out_context)
+                page = urlfile.read(), urlfile.info().getparam('charset')
+            except Exception:
+                page = None
+
+        with self._lock:
+            if page is None:
+                self.failed += 1
+            else:
+                self.fetched += 1
+        return page
+
+    def get_documents(self, urls, debug=False):
+        """
+        Get the visible text of the documents of a list of urls, from the cache or else fetched concurrently.
+
+        :param urls: The list of urls
+        :param debug: True iff you want to print debug information to stdout
+        :return: The list of the visible text of the documents that could be fetched and parsed, in url order
+        """
+        return [t for t in self.get_texts(urls, debug) if t is not None]
+
+    def get_texts(self, urls, debug=False):
+        """
+        Get the visible text of the documents of a list of urls, as get_documents but keeping a None for every document
+        that could not be fetched or parsed.
+
+        :param urls: The list of urls
+        :param debug: True iff you want to print debug information to stdout
+        :return: The list of the visible text of the documents, or None, in url order
+        """
+        if debug:
+            print "No. of urls " + str(len(urls))
+
+        texts = [None] * len(urls)
+        by_host = OrderedDict()
+        for (i, url) in enumerate(urls):
+            if self.cache is not None:
+                texts[i] = self.cache.get_document(url)
+            if texts[i] is None:
+                by_host.setdefault(urlparse.urlparse(url).netloc.lower(), list()).append(i)
+
+        # Take the hosts in turn, so that the threads do not all
+        # end up waiting on the slots of the same host.
+        missing = [i for turn in izip_longest(*by_host.values()) for i in turn if i is not None]
+
+        # Hand every page over for extraction as soon as it is fetched.
+        def fetch(i):
+            page = self.fetch_page(urls[i])
+            if page is None:
+                return None
+            if self.extract_pool is not None:
+                return self.extract_pool.apply_async(visible_text, page)
+            return visible_text(*page)
+
+        if missing:
+            pool = ThreadPool(min(self.workers, len(missing)))
+            try:
+                results = pool.map(fetch, missing, chunksize=1)
+            finally:
+                pool.terminate()
+
+            for (i, result) in zip(missing, results):
+                if result is not None and not isinstance(result, basestring):
+                    result = result.get()
+                texts[i] = result
+                if result is not None and self.cache is not None:
+                    self.cache.put_document(urls[i], result)
+                if debug and result is not None:
+                    print "Fetched url: " + urls[i]
+
+        return texts
@@ -25,6 +25,7 @@
 # document size retrieved from google search results page.
 
 # standard library imports
+from collections import namedtuple
 from random import randint
 import string
 from time import sleep
@@ -33,11 +34,116 @@ import urllib
 import urllib2
 
 # third party imports
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
+from lxml import etree
+import lxml.html
 import nltk
 from nltk.stem.porter import PorterStemmer
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+# local imports
+from serp_cache import CacheMiss, SerpCache
+from token_cache import LRUCache, TokenCache
+
+
+STEM_CACHE_SIZE = 100000
+TOKEN_CACHE_SIZE = 500000
+
+# The stemmer and tokenizer shared by all tokenization in this process, along with the caches of stems by word and of
+# stemmed tokens by snippet.
+_stemmer = PorterStemmer()
+_regex_tokenizer = nltk.RegexpTokenizer(r'\w+')
+_stem_cache = LRUCache(STEM_CACHE_SIZE)
+_token_cache = TokenCache(TOKEN_CACHE_SIZE)
+
+
+# Everything extract_serp pulls out of a search results page: the related searches, the summary set and the URLs of
+# the results, in page order.
+SerpResult = namedtuple('SerpResult', ['related_searches', 'summary_set', 'urls'])
+
+
+def _class_xpath(tag, cls):
+    """
+    Build the XPath expression selecting the descendants with the given tag that carry the given class, matching the
+    class the way BeautifulSoup does (i.e. as one of possibly several space separated classes).
+
+    :param tag: The element tag to select
+    :param cls: The class the element has to carry
+    :return: The compiled XPath expression
+    """
+    return etree.XPath(".//{}[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]".format(tag, cls))
+
+_brs_xpath = etree.XPath(".//div[@id='brs']")
+_brs_col_xpath = _class_xpath('div', 'brs_col')
+_e4b_xpath = _class_xpath('p', '_e4b')
+_g_xpath = _class_xpath('div', 'g')
+_rc_xpath = _class_xpath('div', 'rc')
+_r_xpath = _class_xpath('h3', 'r')
+_s_xpath = _class_xpath('div', 's')
+_st_xpath = _class_xpath('span', 'st')
+_a_xpath = etree.XPath('.//a')
+
+# The parser for the pages extract_serp has decoded and encoded back as UTF-8.
+_utf8_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+
+SEARCH_URL = 'http://www.google.com/search'
+
+# The address get_query_html sends its queries to, see set_search_url.
+_search_url = SEARCH_URL
+
+# The search result page cache shared by every call to get_query_html in this process. It is created with the default
+# settings on first use unless configured beforehand through set_serp_cache.
+_serp_cache = None
+
+
+def get_serp_cache():
+    """
+    Get the search result page cache used by get_query_html, creating the default one if none was configured.
+
+    :return: The SerpCache in use
+    """
+    global _serp_cache
+    if _serp_cache is None:
+        _serp_cache = SerpCache()
+    return _serp_cache
+
+
+def set_serp_cache(cache):
+    """
+    Configure the search result page cache used by get_query_html.
+
+    :param cache: The SerpCache to use
+    :return: None
+    """
+    global _serp_cache
+    _serp_cache = cache
+
+
+def get_token_cache():
+    """
+    Get the cache of snippet tokens used by word_tokenize and regex_tokenize, e.g. to load or save it.
+
+    :return: The TokenCache in use
+    """
+    return _token_cache
+
+
+def stem_word(word):
+    """
+    Stem a word with the Porter stemmer shared by the process, looking it up in the stem cache first.
+
+    :param word: The word to stem
+    :return: The stemmed word
+    """
+    stem = _stem_cache.get(word)
+    if stem is None:
+        stem = _stemmer.stem(word)
+        _stem_cache.put(word, stem)
+    return stem
 
 
 def stem_tokens(tokens):
@@ -48,12 +154,7 @@ def stem_tokens(tokens):
     :param tokens: Tokens to stem
     :return: All tokens passed in with stemming applied
     """
-    #
-    stemmer = PorterStemmer()
-    stemmed = []
-    for item in tokens:
-        stemmed.append(stemmer.stem(item))
-    return stemmed
+    return [stem_word(item) for item in tokens]
 
 def regex_tokenize(text):
     """
@@ -63,11 +164,14 @@ def regex_tokenize(text):
     :param text: The text to tokenize
     :return: A list of stemmed tokens from the input text
     """
-    text = text.lower()
-    tokenizer = nltk.RegexpTokenizer(r'\w+')
-    tokens = tokenizer.tokenize(text)
-    stems = stem_tokens(tokens)
-    return stems
+    key = _token_cache.key('regex', text)
+    stems = _token_cache.get(key)
+    if stems is None:
+        text = text.lower()
+        tokens = _regex_tokenizer.tokenize(text)
+        stems = tuple(stem_tokens(tokens))
+        _token_cache.put(key, stems)
+    return list(stems)
 
 def word_tokenize(text):
     """
@@ -76,10 +180,14 @@ def word_tokenize(text):
     :param text: The text to tokenize
     :return: A list of stemmed tokens from the input text
     """
-    text = text.lower()
-    tokens = nltk.word_tokenize(text)
-    stems = stem_tokens(tokens)
-    return stems
+    key = _token_cache.key('word', text)
+    stems = _token_cache.get(key)
+    if stems is None:
+        text = text.lower()
+        tokens = nltk.word_tokenize(text)
+        stems = tuple(stem_tokens(tokens))
+        _token_cache.put(key, stems)
+    return list(stems)
 
 
 def to_ascii(s):
@@ -92,49 +200,87 @@ def to_ascii(s):
     return unicodedata.normalize('NFKD', s).encode('ascii', 'ignore')
 
 
-def tfidf_normalize(row):
+def get_query_expansion_vector(vec):
     """
-    A function used to normalize the tf-idf matrix along an axis. This function is used to prepare for centroid
-    calculation by:
+    Get the query expansion vector for a tf-idf matrix. The rows of the matrix are L2 normalized, summed into their
+    centroid and the centroid is L2 normalized in turn. The computation stays sparse, and rows (or a centroid) without
+    any term are left as zero rather than divided by a zero norm.
+
+    :param vec: A tf-idf sparse matrix
+    :return: The expansion vector for the matrix
+    """
+    # Calculate the vector.
+    normalized = normalize(sp.csr_matrix(vec))
+    centroid = np.asarray(normalized.sum(axis=0)).ravel()
+    l2norm = np.linalg.norm(centroid, 2)
+    if l2norm == 0:
+        return centroid
+    return centroid/l2norm
 
-    * Calculating the L2 norm for each row
-    * Normalizing the row by the L2 norm
 
-    :param row: The row to normalize
-    :return: The normalized row
+def get_query_expansion_matrix(counts, idf, offsets):
     """
-    # Calculate L2 norm value.
-    l2norm = np.linalg.norm(row, 2)
+    Get the query expansion vectors of several expansion sets at once, given the term counts of all their documents
+    stacked over a shared vocabulary. Everything stays sparse: the tf-idf rows are L2 normalized, summed into one
+    centroid per expansion set through a sparse aggregation matrix and the centroids are L2 normalized in turn.
+    Documents without any term and expansion sets without any document are left as zero vectors.
+
+    :param counts: The sparse documents x terms count matrix of all documents, grouped by expansion set
+    :param idf: The inverse document frequency of each term
+    :param offsets: The row at which each expansion set starts in counts, followed by the total number of rows
+    :return: The sparse expansion sets x terms matrix of query expansion vectors
+    """
+    tfidf = normalize(sp.csr_matrix(counts, dtype=np.float64) * sp.diags(idf))
 
-    # Normalize row by L2 norm.
-    return row/l2norm
+    # Aggregation matrix with a one for every (expansion set, document) pair.
+    offsets = np.asarray(offsets)
+    sizes = np.diff(offsets)
+    rows = np.repeat(np.arange(len(sizes)), sizes)
+    cols = np.arange(offsets[0], offsets[-1])
+    agg = sp.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(sizes), counts.shape[0]))
 
+    return normalize(agg * tfidf)
 
-def get_query_expansion_vector(vec):
+
+def set_search_url(url):
     """
-    Get the query expansion vector for a tf-idf matrix
+    Configure the address get_query_html sends its queries to, e.g. to point it to a local stand-in server.
 
-    :param vec: A tf-idf sparse matrix
-    :return: The expansion vector for the matrix
+    :param url: The address of the search page, without the query string
+    :return: None
     """
-    # Calculate the vector.
-    normalized = np.apply_along_axis(tfidf_normalize, axis=1, arr=vec)
-    centroid = np.sum(normalized, axis=0)
-    qe = centroid/np.linalg.norm(centroid, 2)
-    return qe
+    global _search_url
+    _search_url = url
 
 
-def get_query_html(query, limit=None, num_results=100):
+def get_query_html(query, limit=None, num_results=100, hl='en', use_cache=True, limiter=None):
     """
-    Retrieves html result for a query pushed into the Google search engine.
+    Retrieves html result for a query pushed into the Google search engine. Pages are served from the search result
+    page cache when possible, in which case no request is issued and no rate limiting delay is applied.
 
     :param query: The query to search Google for
     :param limit: THe limit for the number of Google queries to issue in an hour. This parameter should be specified
                   to reduce the risk of being hit by rate limiting.
     :param num_results: THe number of query results to retrieve
+    :param hl: The interface language of the results page
+    :param use_cache: Set to False to bypass the search result page cache
+    :param limiter: A rate limiter shared with other threads (see rate_limit.py) to wait on before issuing the request,
+                    used instead of sleeping according to limit
     :return: The Google search page for the provided query
     """
-    address = 'http://www.google.com/search?q={}&num={}&hl=en&start=0'.format(urllib.quote_plus(query), num_results)
+    cache = None
+    if use_cache:
+        cache = get_serp_cache()
+        page = cache.get(query, num_results, hl)
+        if page is not None:
+            return page
+        if cache.offline:
+            raise CacheMiss('No cached search results page for: ' + query)
+
+    if limiter is not None:
+        limiter.acquire()
+
+    address = '{}?q={}&num={}&hl={}&start=0'.format(_search_url, urllib.quote_plus(query), num_results, hl)
     request = urllib2.Request(address,
                               None,
                               {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_4) AppleWebKit/536.11 '
@@ -142,18 +288,94 @@ def get_query_html(query, limit=None, num_results=100):
     urlfile = urllib2.urlopen(request)
     page = urlfile.read()
 
+    if cache is not None:
+        cache.put(query, num_results, hl, page)
+
     # Determine the amount of time needed to sleep
     # before we yield control.
-    if limit is not None:
+    if limit is not None and limiter is None:
         sleep_time = 3600/limit
         sleep(randint(sleep_time, sleep_time+5))
     return page
 
 
+class ExpansionSet(object):
+    """
+    An immutable expansion set for a query, that is the summary set of its Google search results page.
+
+    Besides the documents, an expansion set holds their term counts. These are computed the first time the set takes
+    part in a kernel computation and reused afterwards, so the seed of a crawl is tokenized only once no matter how many
+    candidates it gets compared to.
+    """
+    def __init__(self, docs):
+        """
+        Create an expansion set from a summary set.
+
+        :param docs: The documents (summary snippets) of the expansion set
+        """
+        self._docs = tuple(docs)
+        self._counts = None
+        self._vocabulary = None
+        self._df = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def __getitem__(self, i):
+        return self._docs[i]
+
+    @property
+    def docs(self):
+        return self._docs
+
+    def term_counts(self):
+        """
+        Get the term counts of the documents, tokenized the same way as in get_tfidf_matrices.
+
+        :return: A tuple (counts, vocabulary, df) where counts is the sparse documents x terms count matrix, vocabulary
+                 maps each term to its column and df is the document frequency of each column
+        """
+        if self._counts is None:
+            cv = CountVectorizer(tokenizer=word_tokenize, stop_words='english')
+            self._counts = cv.fit_transform(self._docs)
+            self._vocabulary = cv.vocabulary_
+            self._df = np.bincount(self._counts.indices, minlength=len(self._vocabulary))
+        return self._counts, self._vocabulary, self._df
+
+
+def as_expansion_set(es):
+    """
+    Wrap a summary set into an expansion set, if it isn't one already.
+
+    :param es: The summary set or expansion set
+    :return: The expansion set
+    """
+    if isinstance(es, ExpansionSet):
+        return es
+    return ExpansionSet(es)
+
+
+def get_idf(df, n):
+    """
+    Compute the smoothed inverse document frequency the same way as the TfidfVectorizer used in get_tfidf_matrices.
+
+    :param df: The document frequency of each term
+    :param n: The number of documents
+    :return: The inverse document frequency of each term
+    """
+    return np.log((1.0 + n) / (1.0 + df)) + 1.0
+
+
 def get_tfidf_matrices(es_q, es_c):
     """
     Retrives the term frequency inverse document frequency (tf-idf) matrix for a query and candidate.
 
+    .. note:: This refits a vectorizer over both expansion sets on every call. kval_es computes the same kernel value
+              from the term counts held by the expansion sets instead.
+
     :param es_q: The expansion set for the reference query (i.e. the ultimate root query)
     :param es_c: The expansion set for the candidate query
     :return: The tf-idf matrices
@@ -161,16 +383,15 @@ def get_tfidf_matrices(es_q, es_c):
     lq = len(es_q)
     lc = len(es_c)
 
-    # Combine the document sets for tf-idf calculation.
-    combined = es_q
-    combined.extend(es_c)
+    # Combine the document sets for tf-idf calculation, without
+    # touching the sets passed in.
+    combined = list(es_q) + list(es_c)
 
     # We want to get a new vectorizer for every string.
     tfidf = TfidfVectorizer(tokenizer=word_tokenize, stop_words='english')
     tfs = tfidf.fit_transform(combined)
 
-    vectors = tfs.toarray()
-    return vectors[0:lq-1, :], vectors[lq:lq+lc-1, :]
+    return tfs[0:lq, :], tfs[lq:lq+lc, :]
 
 
 def kval_es(es_q, es_c):
@@ -178,6 +399,11 @@ def kval_es(es_q, es_c):
     Calculates the kernel function value from two expansion sets rather than raw short string candidates, makes
     caching easier.
 
+    The value is the one obtained by fitting a tf-idf vectorizer over the union of both sets (see get_tfidf_matrices),
+    but it is computed from the term counts held by the expansion sets: only the inverse document frequencies, which
+    depend on both sets, are worked out for each pair. Passing the same ExpansionSet for the reference query on every
+    call therefore only costs the tokenization of the candidate.
+
     .. note:: This kernel function is an implementation of the methodology presented in 
     [A web-based kernel function for measuring the similarity of short text snippets]
     URL: http://dl.acm.org/citation.cfm?id=1135834
@@ -186,10 +412,35 @@ def kval_es(es_q, es_c):
     :param es_c: The expansion set for the candidate query
     :return: The kernel function value
     """
-    vq, vc = get_tfidf_matrices(es_q, es_c)
+    es_q = as_expansion_set(es_q)
+    es_c = as_expansion_set(es_c)
+    counts_q, vocab_q, df_q = es_q.term_counts()
+    counts_c, vocab_c, df_c = es_c.term_counts()
+
+    # Find the terms the two vocabularies share, only these
+    # contribute to the inner product of the expansion vectors.
+    shared_q = list()
+    shared_c = list()
+    for (term, j) in vocab_c.iteritems():
+        i = vocab_q.get(term)
+        if i is not None:
+            shared_q.append(i)
+            shared_c.append(j)
+    shared_q = np.array(shared_q, dtype=np.intp)
+    shared_c = np.array(shared_c, dtype=np.intp)
+
+    # Document frequencies over the union of both sets.
+    n = len(es_q) + len(es_c)
+    dfu_q = df_q.copy()
+    dfu_q[shared_q] += df_c[shared_c]
+    dfu_c = df_c.copy()
+    dfu_c[shared_c] += df_q[shared_q]
+
+    vq = counts_q * sp.diags(get_idf(dfu_q, n))
+    vc = counts_c * sp.diags(get_idf(dfu_c, n))
     qe_q = get_query_expansion_vector(vq)
     qe_c = get_query_expansion_vector(vc)
-    return np.inner(qe_q, qe_c)
+    return np.inner(qe_q[shared_q], qe_c[shared_c])
 
 
 def kval(q, c):
@@ -203,10 +454,8 @@ def kval(q, c):
     :param c: Candidate to calculate the k value for
     :return: Value of kernel function
     """
-    q_page = get_query_html(q)
-    c_page = get_query_html(c)
-    es_q = get_google_query_summary_set(q_page)
-    es_c = get_google_query_summary_set(c_page)
+    es_q = extract_serp(get_query_html(q)).summary_set
+    es_c = extract_serp(get_query_html(c)).summary_set
     return kval_es(es_q, es_c)
 
 
@@ -264,6 +513,60 @@ def get_google_query_summary_set(query_results_page):
     return summary_set
 
 
+def extract_serp(page):
+    """
+    Retrieves the related searches, the summary set and the result URLs from the html page of a Google search in a
+    single pass. The page is parsed once with lxml and the same elements as in get_google_related_searches,
+    get_google_query_summary_set and the result links are selected through precompiled XPath expressions, so this
+    should be preferred over calling those functions one after the other on the same page.
+
+    .. note:: This function depends on the classes assigned by Google in the search results. Any change in these
+              will likely break the functionality of this function.
+
+    :param page: Google search result page to extract
+    :return: A SerpResult holding the related searches, summary set and URLs for the page, the related searches being
+             None if the page has no related searches section (where get_google_related_searches fails)
+    """
+    rs = list()
+    summary_set = list()
+    urls = list()
+    if page is None:
+        return SerpResult(rs, summary_set, urls)
+
+    # Decode the page the way BeautifulSoup does, since lxml would take a
+    # page without a meta charset for Latin-1.
+    if not isinstance(page, unicode):
+        page = UnicodeDammit(page, is_html=True).unicode_markup
+    if not page.strip():
+        return SerpResult(None, summary_set, urls)
+    root = lxml.html.fromstring(page.encode('utf-8'), parser=_utf8_parser)
+
+    # Related searches from the first "brs" division only, as in get_google_related_searches.
+    rsdivs = _brs_xpath(root)
+    if rsdivs:
+        for d in _brs_col_xpath(rsdivs[0]):
+            for p in _e4b_xpath(d):
+                rs.append(to_ascii(unicode(p.text_content())).translate(None, string.punctuation))
+    else:
+        rs = None
+
+    for div in _g_xpath(root):
+        for d in _rc_xpath(div):
+            doc = u''
+            for hr in _r_xpath(d):
+                doc += unicode(hr.text_content())
+                doc += ' '
+                links = _a_xpath(hr)
+                if links and links[0].get('href') is not None:
+                    urls.append(links[0].get('href'))
+            for ds in _s_xpath(d):
+                for st in _st_xpath(ds):
+                    doc += unicode(st.text_content())
+            summary_set.append(to_ascii(doc).translate(None, string.punctuation))
+
+    return SerpResult(rs, summary_set, urls)
+
+
 def test_kval(q, c):
     """
     Calculate and print the kernel function value between a query string and a candidate.
@@ -14,6 +14,8 @@
 # * seed
 # * iteration count (generally set to 3)
 # * request limit (see bullet 2 in next list)
+# * optionally, a budget of candidates to fetch, in which case the crawl goes best-first: the candidates whose parent
+#   is closest to the seed are fetched first and the crawl stops early once few candidates get approved
 #
 # In running this script, we have identified the following issues that you need to be aware of and potentially
 # address:
@@ -28,10 +30,14 @@
 # standard library imports
 from __future__ import division
 import argparse
-from collections import OrderedDict
+from collections import deque, OrderedDict
 import csv
+import heapq
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
 import pickle
+import sys
 import traceback
 import string
 
@@ -41,8 +47,16 @@ import pandas as pd
 
 # local imports
 import google_query_similarity as gr
+from near_duplicates import NearDuplicateIndex
+import qe_store
+from crawl_journal import COMPACT_INTERVAL, CrawlJournal, JournalResult
+from rate_limit import RateLimiter, TokenBucket
+from serp_cache import DEFAULT_CACHE_DIR, SerpCache
+from streaming_threshold import ThresholdEstimator
+from token_cache import TOKEN_CACHE_FILE
 
 INDEX_RECALL_DIR = "./indexrecall/"
+PAIRWISE_BLOCK_SIZE = 256
 
 
 class ScrapeState:
@@ -55,10 +69,29 @@ class ScrapeState:
         """
         self.seed = seed
         self.iteration = 0
-        self.candidates = list()
+        self.candidates = deque()
         self.next_candidates = list()
         self.threshold = 1.0
 
+        # Space for iteration 0, the candidates waiting on the threshold.
+        self.iter0 = OrderedDict()
+        self.iter0kvals = list()
+
+        # Running threshold deciding on iteration 0 early, see record_candidate.
+        self.estimator = None
+        self.prune = False
+        self.early = dict()
+
+        # Near-duplicate candidates collapsed into the candidate already fetched, see infer_kval.
+        self.duplicates = None
+        self.collapsed = 0
+
+        # Space for the best-first crawl, see run_google_related_queries_best_first.
+        self.frontier = list()
+        self.pushed = 0
+        self.requests = 0
+        self.recent = list()
+
     def pickle(self):
         """
         Save the object to a data file so we can resume where we left off
@@ -66,8 +99,12 @@ class ScrapeState:
         :return: None
         """
         name_suffix = './googledata/' + self.seed.replace(' ', '_')
-        with open(name_suffix, 'wb') as f:
+
+        # The state is saved while crawling, so never leave a half written file behind.
+        tmp_name = name_suffix + '.tmp'
+        with open(tmp_name, 'wb') as f:
             pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, name_suffix)
 
     def unpickle(self):
         """
@@ -81,6 +118,9 @@ class ScrapeState:
                 tmp = pickle.load(f)
                 self.__dict__.update(tmp)
 
+        # States saved before the frontier was a deque hold a list.
+        self.candidates = deque(self.candidates)
+
     def display(self):
         """
         Print the current state of the object. This can be used to check the progress after unpickling
@@ -143,20 +183,307 @@ def save_related_queries(seed, approved, rejected):
     a_name = name_suffix + 'approved.csv'
     r_name = name_suffix + 'rejected.csv'
 
+    # Write to temporary files first, the queries
+    # are saved again and again during a crawl.
     if any(approved):
-        with open(a_name, 'w') as f:
+        with open(a_name + '.tmp', 'w') as f:
             csv_writer = csv.writer(f, lineterminator='\n')
             for (k, v) in approved.iteritems():
                 csv_writer.writerow([k, v[0], v[1]])
+        os.rename(a_name + '.tmp', a_name)
 
     if any(rejected):
-        with open(r_name, 'w') as f:
+        with open(r_name + '.tmp', 'w') as f:
             csv_writer = csv.writer(f, lineterminator='\n')
             for (k, v) in rejected.iteritems():
                 csv_writer.writerow([k, v[0], v[1]])
+        os.rename(r_name + '.tmp', r_name)
+
+
+def is_processed(state, candidate, approved, rejected):
+    """
+    Determine whether a candidate query has already been processed, in which case it must not be processed again.
+
+    :param state: The scrape state
+    :param candidate: The candidate query
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :return: True iff the candidate has already been processed
+    """
+    return (candidate in approved) or (candidate in rejected) or (candidate in state.iter0)
+
+
+def record_candidate(state, candidate, parent, kval, can_rs, approved, rejected):
+    """
+    Record the kernel value of a processed candidate and queue its related searches for the next iteration.
+
+    :param state: The scrape state
+    :param candidate: The candidate query
+    :param parent: The query the candidate is a related search of
+    :param kval: The kernel value between the seed and the candidate
+    :param can_rs: The related searches of the candidate
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :return: None
+    """
+    # If this is the first iteration accept all.
+    # Otherwise if the kernel value is less than
+    # the threshold then reject it.
+    if state.iteration == 0:
+        state.iter0kvals.append(kval)
+
+        # With a running threshold, decide as soon as the kernel value
+        # is clear of its bounds, pruning confident rejections if asked.
+        decision = None
+        if state.estimator is not None:
+            state.estimator.add(kval)
+            decision = state.estimator.decide(kval)
+
+        if decision is None:
+            # For the first iteration store everything inside iter0.
+            # We will figure out everything at the end of the iteration.
+            state.iter0[candidate] = (parent, kval)
+        else:
+            state.early[candidate] = (kval, decision)
+            if decision:
+                approved[candidate] = (parent, kval)
+            else:
+                rejected[candidate] = (parent, kval)
+                if state.prune:
+                    return
+    else:
+        # For further iteration, only accept if kernel
+        # value is greater than the threshold.
+        if kval >= state.threshold:
+            approved[candidate] = (parent, kval)
+        else:
+            rejected[candidate] = (parent, kval)
+
+    # Add the candidate's related searches to the next_candidates.
+    for rs in can_rs:
+        state.next_candidates.append((rs, candidate))
+
+
+def end_iteration(state, approved, rejected):
+    """
+    Move on to the next iteration once all the candidates of the current one have been processed. At the end of the
+    first iteration, this determines the threshold and decides on the candidates of the first iteration.
+
+    :param state: The scrape state
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :return: None
+    """
+    # Add the next candidates to the candidates set
+    # and increase the iteration count.
+    state.candidates.extend(state.next_candidates)
+    state.next_candidates = list()
+
+    # Before incrementing the iteration counter, process
+    # the first iteration if this is the first iteration.
+    if state.iteration == 0:
+        q75, q25 = np.percentile(state.iter0kvals, [75, 25])
+        iqr = q75 - q25
+        state.threshold = q25 - (1.5 * iqr)
+
+        # Process the iteration 0 candidates and later ones
+        # based on this threshold.
+        for (k, v) in state.iter0.iteritems():
+            if v[1] >= state.threshold:
+                approved[k] = v
+            else:
+                rejected[k] = v
+
+        # Correct the candidates decided early against the final threshold.
+        # Only the related searches of those pruned stay uncrawled.
+        wrong = 0
+        for (k, (kval, decision)) in state.early.iteritems():
+            if decision != (kval >= state.threshold):
+                wrong += 1
+                src, dst = (approved, rejected) if decision else (rejected, approved)
+                if k in src:
+                    dst[k] = src.pop(k)
+
+        if len(state.early) > 0:
+            print 'Decided {} of {} candidates early, {} against the final threshold'.format(
+                len(state.early), len(state.iter0kvals), wrong)
+
+        state.iter0 = OrderedDict()
+        state.iter0kvals = list()
+        state.estimator = None
+        state.early = dict()
+
+    state.iteration += 1
+
+
+def resume_crawl(seed, stream=False, prune=False, collapse=False):
+    """
+    Recover from any previous failures/runs of the crawl for a seed, by loading the queries, unpickling the scrape state
+    and loading the results journaled since they were saved.
+
+    :param seed: The root query of the crawl
+    :param stream: Decide on the candidates of iteration 0 as soon as a running estimate of the threshold allows it
+    :param prune: Do not crawl the related searches of the candidates of iteration 0 rejected early
+    :param collapse: Infer the kernel value of near-duplicates of the candidates already fetched instead of fetching them
+    :return: The approved queries, rejected queries, scrape state and journal of the crawl as a tuple
+    """
+    approved, rejected = load_related_queries(seed)
+    state = ScrapeState(seed)
+    state.unpickle()
+    state.display()
 
+    if not stream:
+        state.estimator = None
+    elif state.iteration == 0 and state.estimator is None:
+        state.estimator = ThresholdEstimator()
+        for kval in state.iter0kvals:
+            state.estimator.add(kval)
+    state.prune = prune
 
-def run_google_related_queries(seed, limit, keycnt):
+    if not collapse:
+        state.duplicates = None
+    elif state.duplicates is None:
+        state.duplicates = NearDuplicateIndex()
+        state.duplicates.add(seed)
+
+    journal = CrawlJournal(seed)
+    replayed = journal.load()
+    if replayed > 0:
+        print 'Replaying {} journaled candidates'.format(replayed)
+
+    return approved, rejected, state, journal
+
+
+def save_progress(state, approved, rejected, journal):
+    """
+    Save the approved and rejected queries and the scrape state, then compact the journal they now cover.
+
+    :param state: The scrape state
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :param journal: The journal of the crawl
+    :return: None
+    """
+    save_related_queries(state.seed, approved, rejected)
+    state.pickle()
+    journal.compact()
+
+
+def infer_kval(state, candidate, approved, rejected):
+    """
+    Infer the kernel value of a candidate that is a near-duplicate of a query already recorded (see near_duplicates.py),
+    as the kernel value of that query. Candidates are only collapsed past iteration 0, so that the threshold is computed
+    over fetched kernel values only.
+
+    :param state: The scrape state
+    :param candidate: The candidate query
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :return: The inferred kernel value, None if the candidate needs to be fetched
+    """
+    if state.duplicates is None or state.iteration == 0:
+        return None
+    # Only the queries recorded so far can stand for the candidate, not the ones still in flight.
+    rep = state.duplicates.lookup(candidate, lambda q: q in approved or q in rejected)
+    if rep is None:
+        return None
+    if rep in approved:
+        return float(approved[rep][1])
+    return float(rejected[rep][1])
+
+
+def get_related_searches(serp):
+    """
+    Get the related searches of an extracted search results page for the crawl, which skips a candidate whose page has
+    no related searches section (and fails on such a seed) as it did when get_google_related_searches raised.
+
+    :param serp: The SerpResult of the page
+    :return: The related searches of the page
+    """
+    if serp.related_searches is None:
+        raise ValueError('No related searches section in the search results page')
+    return serp.related_searches
+
+
+def process_candidate(state, candidate, parent, seed_es, keycnt, approved, rejected, journal):
+    """
+    Get the kernel value and related searches of a candidate. The kernel value of a near-duplicate of a query already
+    recorded is inferred from it, without related searches. Otherwise the result comes from the journal if the
+    candidate has been processed before the crawl was resumed, or else from its Google search results page, in which
+    case it is journaled.
+
+    :param state: The scrape state
+    :param candidate: The candidate query
+    :param parent: The query the candidate is a related search of
+    :param seed_es: The expansion set of the seed
+    :param int keycnt: The maximum number of Google keyword requests per hour
+    :param approved: The approved queries
+    :param rejected: The rejected queries
+    :param journal: The journal of the crawl
+    :return: The kernel value and related searches of the candidate and whether the kernel value was inferred as a
+             tuple (kernel value, related searches, inferred), the kernel value being None if the search results could
+             not be processed
+    """
+    kval = infer_kval(state, candidate, approved, rejected)
+    if kval is not None:
+        state.collapsed += 1
+        return kval, list(), True
+
+    if candidate in journal:
+        kval, can_rs = journal.replayed(candidate)
+    else:
+        kval, can_rs = fetch_candidate(candidate, parent, seed_es, keycnt, journal)
+
+    # The candidate represents its near-duplicates from now on.
+    if kval is not None and state.duplicates is not None:
+        state.duplicates.add(candidate)
+    return kval, can_rs, False
+
+
+def fetch_candidate(candidate, parent, seed_es, keycnt, journal):
+    """
+    Get the kernel value and related searches of a candidate from its Google search results page and journal them.
+
+    :param candidate: The candidate query
+    :param parent: The query the candidate is a related search of
+    :param seed_es: The expansion set of the seed
+    :param int keycnt: The maximum number of Google keyword requests per hour
+    :param journal: The journal of the crawl
+    :return: The kernel value and related searches of the candidate as a tuple (kernel value, related searches), the
+             kernel value being None if the search results could not be processed
+    """
+    # Get the candidate's related searches and extended set.
+    can_page = gr.get_query_html(candidate, keycnt)
+
+    try:
+        can_serp = gr.extract_serp(can_page)
+        can_rs = get_related_searches(can_serp)
+        can_es = can_serp.summary_set
+
+        # Retrieve the kernel value.
+        kval = gr.kval_es(seed_es, can_es)
+    except Exception as e:
+        print 'Error processing google search results: ' + repr(e)
+        print 'Candidate query: ' + candidate
+        kval, can_rs = None, list()
+
+    journal.append(candidate, parent, kval, can_rs)
+    return kval, can_rs
+
+
+def report_collapsed(state):
+    """
+    Print the number of requests saved by collapsing near-duplicate candidates, if enabled.
+
+    :param state: The scrape state
+    :return: None
+    """
+    if state.duplicates is not None:
+        print 'Collapsed {} near-duplicate candidates into {} fetched queries, saving {} requests'.format(
+            state.collapsed, len(state.duplicates), state.collapsed)
+
+
+def run_google_related_queries(seed, limit, keycnt, stream=False, prune=False, collapse=False):
     """
     This function is where the main logic of getting the related google queries occurs. Execution continues until either
     the maximum number of iterations occur or there is an error in the execution.
@@ -179,108 +506,371 @@ def run_google_related_queries(seed, limit, keycnt):
         Iteration 1+:
             steps 3, 4, 5, and 7 are repeated for all other iterations (1+).
 
+    The result of every candidate is journaled as soon as it is known (see crawl_journal.py) and the progress is saved
+    every COMPACT_INTERVAL candidates, so a crawl that dies loses at most the request it was waiting on.
+
     :param str seed: The root query that the related queries are generated for. The seed should only contain
                      alphanumeric characters and spaces/underscores as the seed is used to generate the backup file.
     :param int limit: Specifies the maximum number of times to iterate through the related queries
     :param int keycnt: The maximum number of Google keyword requests per hour
+    :param stream: Decide on the candidates of iteration 0 as soon as a running estimate of the threshold allows it
+    :param prune: Do not crawl the related searches of the candidates of iteration 0 rejected early
+    :param collapse: Infer the kernel value of near-duplicates of the candidates already fetched instead of fetching them
     :return: None
     """
-    # Recover from any previous failures/runs, if any, by loading the queries and unpickling the scrape state
-    approved, rejected = load_related_queries(seed)
-    state = ScrapeState(seed)
-    state.unpickle()
-    state.display()
-
-    # Create space for iteration 0 if necessary.
-    if state.iteration==0:
-        iter0 = OrderedDict()
-        iter0kvals = list()
+    approved, rejected, state, journal = resume_crawl(seed, stream, prune, collapse)
 
     try:
         # Expansion set and first iteration of  for the seed.
         seed_page = gr.get_query_html(seed, keycnt)
-        seed_rs = gr.get_google_related_searches(seed_page)
-        seed_es = gr.get_google_query_summary_set(seed_page)
+        seed_serp = gr.extract_serp(seed_page)
+        seed_rs = get_related_searches(seed_serp)
+        seed_es = gr.ExpansionSet(seed_serp.summary_set)
 
         # Add seed to the accepted set.
         approved[seed] = (seed, 1.0)
 
         # Initiate the candidates with the seed's related queries as (related search, parent) tuple.
-        # The parent in this case is the seed.
-        for rs in seed_rs:
-            state.candidates.append((rs, seed))
+        # The parent in this case is the seed. A resumed crawl already has them.
+        if state.iteration == 0 and len(state.candidates) == 0 and len(state.iter0) == 0:
+            for rs in seed_rs:
+                state.candidates.append((rs, seed))
         while state.iteration < limit:
             while len(state.candidates) > 0:
-                (candidate, parent) = state.candidates.pop(0)
+                (candidate, parent) = state.candidates.popleft()
                 # If the candidate appears in either the accepted
                 # or rejected sets then don't process it.
-                if (candidate in approved) or (candidate in rejected):
+                if is_processed(state, candidate, approved, rejected):
                     continue
 
-                # Get the candidate's related searches and extended set.
-                can_page = gr.get_query_html(candidate, keycnt)
+                kval, can_rs, inferred = process_candidate(state, candidate, parent, seed_es, keycnt, approved, rejected,
+                                                           journal)
 
-                try:
-                    can_rs = gr.get_google_related_searches(can_page)
-                    can_es = gr.get_google_query_summary_set(can_page)
+                # Skip candidates whose search results could not be processed.
+                if kval is not None:
+                    record_candidate(state, candidate, parent, kval, can_rs, approved, rejected)
+                if journal.appended >= COMPACT_INTERVAL:
+                    save_progress(state, approved, rejected, journal)
 
-                    # Retrieve the kernel value.
-                    kval = gr.kval_es(seed_es, can_es)
-                except Exception as e:
-                    print 'Error processing google search results: ' + repr(e)
-                    print 'Candidate query: ' + candidate
-                    continue
+            end_iteration(state, approved, rejected)
+    except Exception as e:
+        # We do not want to die unexpectedly without saving the current progress, so catch all errors.
+        print 'Error retrieving google search results: ' + repr(e)
+        traceback.print_exc()
+    finally:
+        # Regardless of whether we have failed (i.e. caught an exception) or not, save the approved and rejected queries
+        # and the state of the calculation.
+        save_progress(state, approved, rejected, journal)
+        report_collapsed(state)
 
-                # If this is the first iteration accept all.
-                # Otherwise if the kernel value is less than
-                # the threshold then reject it.
-                if state.iteration == 0:
-                    # For the first iteration store everything inside iter0.
-                    # We will figure out everything at the end of the iteration.
-                    iter0[candidate] = (parent, kval)
-                    iter0kvals.append(kval)
-                else:
-                    # For further iteration, only accept if kernel
-                    # value is greater than the threshold.
-                    if kval >= state.threshold:
-                        approved[candidate] = (parent, kval)
-                    else:
-                        rejected[candidate] = (parent, kval)
 
-                # Add the candidate's related searches to the next_candidates.
-                for rs in can_rs:
-                    state.next_candidates.append((rs, candidate))
+def push_frontier(state, candidate, parent, parent_kval, depth):
+    """
+    Queue a candidate in the priority frontier of the best-first crawl. Candidates are taken by decreasing kernel value
+    of their parent, then by increasing depth, then in the order they were queued.
+
+    :param state: The scrape state
+    :param candidate: The candidate query
+    :param parent: The query the candidate is a related search of
+    :param parent_kval: The kernel value of the parent
+    :param depth: The iteration the candidate belongs to in the breadth-first crawl
+    :return: None
+    """
+    heapq.heappush(state.frontier, (-parent_kval, depth, state.pushed, candidate, parent))
+    state.pushed += 1
+
 
-            # Add the next candidates to the candidates set
-            # and increase the iteration count.
-            state.candidates.extend(state.next_candidates)
-            state.next_candidates = list()
+def run_google_related_queries_best_first(seed, limit, keycnt, budget, cutoff, window, stream=False, prune=False,
+                                          collapse=False):
+    """
+    Best-first version of run_google_related_queries. Rather than going through the candidates of each iteration in
+    order, this crawl always fetches the candidate whose parent has the highest kernel value, so the branches that stay
+    close to the seed get explored first. The crawl stops once budget candidates have been fetched, or once fewer than
+    cutoff of the last window candidates were approved, since the remaining candidates are unlikely to be approved.
+
+    Iteration 0 is crawled as in run_google_related_queries, as the threshold is computed over all of its kernel
+    values. The candidates beyond iteration 0 are kept in the priority frontier of the scrape state, so the crawl of a
+    seed should not be resumed with run_google_related_queries once it has gone past iteration 0.
 
-            # Before incrementing the iteration counter, process
-            # the first iteration if this is the first iteration.
+    :param str seed: The root query that the related queries are generated for. The seed should only contain
+                     alphanumeric characters and spaces/underscores as the seed is used to generate the backup file.
+    :param int limit: Specifies the maximum depth, i.e. iteration, of the candidates
+    :param int keycnt: The maximum number of Google keyword requests per hour
+    :param int budget: The maximum number of candidates to fetch, over all the runs of the crawl
+    :param float cutoff: The acceptance rate under which the crawl stops
+    :param int window: The number of most recent candidates the acceptance rate is computed over
+    :param stream: Decide on the candidates of iteration 0 as soon as a running estimate of the threshold allows it
+    :param prune: Do not crawl the related searches of the candidates of iteration 0 rejected early
+    :param collapse: Infer the kernel value of near-duplicates of the candidates already fetched instead of fetching them
+    :return: None
+    """
+    approved, rejected, state, journal = resume_crawl(seed, stream, prune, collapse)
+
+    try:
+        seed_page = gr.get_query_html(seed, keycnt)
+        seed_serp = gr.extract_serp(seed_page)
+        seed_rs = get_related_searches(seed_serp)
+        seed_es = gr.ExpansionSet(seed_serp.summary_set)
+
+        approved[seed] = (seed, 1.0)
+        if state.iteration == 0 and len(state.candidates) == 0 and len(state.iter0) == 0:
+            for rs in seed_rs:
+                state.candidates.append((rs, seed))
+
+        while state.requests < budget:
             if state.iteration == 0:
-                q75, q25 = np.percentile(iter0kvals, [75, 25])
-                iqr = q75 - q25
-                state.threshold = q25 - (1.5 * iqr)
-
-                # Process the iteration 0 candidates and later ones
-                # based on this threshold.
-                for (k, v) in iter0.iteritems():
-                    if v[1] >= state.threshold:
-                        approved[k] = v
-                    else:
-                        rejected[k] = v
+                if len(state.candidates) == 0:
+                    # Iteration 0 is over. Its related searches go into the priority frontier.
+                    end_iteration(state, approved, rejected)
+                    if limit > 1:
+                        for (candidate, parent) in state.candidates:
+                            parent_kval = (approved.get(parent) or rejected.get(parent))[1]
+                            push_frontier(state, candidate, parent, float(parent_kval), 1)
+                    state.candidates.clear()
+                    continue
+                (candidate, parent) = state.candidates.popleft()
+                depth = 0
+            else:
+                if len(state.frontier) == 0:
+                    break
+                if len(state.recent) >= window and sum(state.recent) / len(state.recent) < cutoff:
+                    print 'Stopping, acceptance rate of the last {} candidates under {}'.format(window, cutoff)
+                    break
+                (priority, depth, order, candidate, parent) = heapq.heappop(state.frontier)
+
+            if is_processed(state, candidate, approved, rejected):
+                continue
+
+            kval, can_rs, inferred = process_candidate(state, candidate, parent, seed_es, keycnt, approved, rejected,
+                                                       journal)
+            if not inferred:
+                state.requests += 1
+
+            if kval is not None:
+                record_candidate(state, candidate, parent, kval, can_rs, approved, rejected)
+
+                # The candidates of iteration 0 leave their related searches to end_iteration,
+                # the later ones move them straight into the priority frontier.
+                if depth > 0:
+                    state.recent.append(candidate in approved)
+                    del state.recent[:-window]
+                    if depth + 1 < limit:
+                        for (rs, p) in state.next_candidates:
+                            push_frontier(state, rs, p, kval, depth + 1)
+                    state.next_candidates = list()
+
+            if journal.appended >= COMPACT_INTERVAL:
+                save_progress(state, approved, rejected, journal)
+
+        print 'Fetched {} of {} candidates, {} approved'.format(state.requests, budget, len(approved))
+    except Exception as e:
+        print 'Error retrieving google search results: ' + repr(e)
+        traceback.print_exc()
+    finally:
+        save_progress(state, approved, rejected, journal)
+        report_collapsed(state)
 
-            state.iteration += 1
+
+# The seed expansion sets of a scoring worker process, see score_page.
+_worker_seed_es = dict()
+
+
+def score_page(seed, seed_docs, page):
+    """
+    Parse a candidate's search results page and compute its kernel value against the seed, in a scoring worker process.
+    The expansion set of each seed is kept by the worker, so that its term counts are computed once per process.
+
+    :param seed: The seed query
+    :param seed_docs: The summary set of the seed
+    :param page: The candidate's Google search results page
+    :return: The kernel value and related searches of the candidate as a tuple (kernel value, related searches)
+    """
+    if seed not in _worker_seed_es:
+        _worker_seed_es[seed] = gr.ExpansionSet(seed_docs)
+    serp = gr.extract_serp(page)
+    return gr.kval_es(_worker_seed_es[seed], serp.summary_set), get_related_searches(serp)
+
+
+def run_google_related_queries_concurrent(seed, limit, keycnt, workers, limiter=None, score_pool=None, stream=False,
+                                          prune=False, collapse=False):
+    """
+    Concurrent version of run_google_related_queries producing the same approved/rejected queries and scrape state.
+
+    Up to workers candidates of the current iteration are fetched at the same time by a pool of threads sharing a
+    single budget of keycnt requests per hour (pages found in the search result page cache do not use the budget).
+    The fetched pages are parsed and scored by a pool of worker processes while the other requests are waiting. The
+    results are recorded and journaled in the order of the candidates, so the outcome is the same as with the serial
+    crawl and either version can resume the other.
+
+    :param str seed: The root query that the related queries are generated for. The seed should only contain
+                     alphanumeric characters and spaces/underscores as the seed is used to generate the backup file.
+    :param int limit: Specifies the maximum number of times to iterate through the related queries
+    :param int keycnt: The maximum number of Google keyword requests per hour
+    :param int workers: The maximum number of requests in flight
+    :param limiter: A limiter shared with other crawls to use instead of limiting this crawl to keycnt requests per hour
+    :param score_pool: A pool of scoring worker processes shared with other crawls, one is started for this crawl if
+                       not given
+    :param stream: Decide on the candidates of iteration 0 as soon as a running estimate of the threshold allows it
+    :param prune: Do not crawl the related searches of the candidates of iteration 0 rejected early
+    :param collapse: Infer the kernel value of near-duplicates of the candidates already fetched instead of fetching them
+    :return: None
+    """
+    approved, rejected, state, journal = resume_crawl(seed, stream, prune, collapse)
+
+    if limiter is None:
+        limiter = RateLimiter(keycnt)
+    own_score_pool = score_pool is None
+    fetch_pool = None
+
+    # Candidates popped from the frontier whose results are pending, in frontier order.
+    in_flight = deque()
+
+    def fetch_and_score(candidate):
+        # Failing to fetch is fatal for the crawl, as in the serial version,
+        # while failing to process a page only skips the candidate.
+        page = gr.get_query_html(candidate, limiter=limiter)
+        try:
+            kval, can_rs = score_pool.apply(score_page, (seed, seed_docs, page))
+            return kval, can_rs, None
+        except Exception as e:
+            return None, list(), e
+
+    def save():
+        # The candidates in flight have left the frontier but are not
+        # recorded yet, so they go back into the saved frontier.
+        queued = [(candidate, parent) for (candidate, parent, result) in in_flight]
+        state.candidates.extendleft(reversed(queued))
+        try:
+            save_progress(state, approved, rejected, journal)
+        finally:
+            for _ in queued:
+                state.candidates.popleft()
+
+    try:
+        seed_page = gr.get_query_html(seed, limiter=limiter)
+        seed_serp = gr.extract_serp(seed_page)
+        seed_rs = get_related_searches(seed_serp)
+        seed_docs = seed_serp.summary_set
+
+        # Start the worker processes before any thread is running.
+        if own_score_pool:
+            score_pool = Pool()
+        fetch_pool = ThreadPool(workers)
+
+        approved[seed] = (seed, 1.0)
+        if state.iteration == 0 and len(state.candidates) == 0 and len(state.iter0) == 0:
+            for rs in seed_rs:
+                state.candidates.append((rs, seed))
+
+        while state.iteration < limit:
+            pending = set()
+            while len(state.candidates) > 0 or len(in_flight) > 0:
+                # Keep the fetch pool busy with the next candidates of the iteration.
+                while len(in_flight) < workers and len(state.candidates) > 0:
+                    (candidate, parent) = state.candidates.popleft()
+                    if is_processed(state, candidate, approved, rejected) or candidate in pending:
+                        continue
+                    pending.add(candidate)
+
+                    # A near-duplicate of a query recorded or in flight waits for it rather than being fetched.
+                    collapsed = (state.duplicates is not None and state.iteration > 0 and
+                                 state.duplicates.lookup(candidate) is not None)
+                    if collapsed:
+                        result = None
+                    elif candidate in journal:
+                        result = JournalResult(journal, candidate)
+                    else:
+                        result = fetch_pool.apply_async(fetch_and_score, (candidate,))
+                    if not collapsed and state.duplicates is not None:
+                        state.duplicates.add(candidate)
+                    in_flight.append((candidate, parent, result))
+
+                if len(in_flight) == 0:
+                    break
+
+                (candidate, parent, result) = in_flight[0]
+                if result is None:
+                    # The query the candidate duplicates has been recorded by now, unless its search results could
+                    # not be processed, in which case the candidate is fetched after all as in the serial version.
+                    kval = infer_kval(state, candidate, approved, rejected)
+                    if kval is not None:
+                        state.collapsed += 1
+                        can_rs, error = list(), None
+                    else:
+                        result = fetch_pool.apply_async(fetch_and_score, (candidate,))
+                        state.duplicates.add(candidate)
+                        in_flight[0] = (candidate, parent, result)
+                if result is not None:
+                    kval, can_rs, error = result.get()
+                in_flight.popleft()
+                pending.discard(candidate)
+                if result is not None and not isinstance(result, JournalResult):
+                    if error is not None:
+                        print 'Error processing google search results: ' + repr(error)
+                        print 'Candidate query: ' + candidate
+                    journal.append(candidate, parent, kval, can_rs)
+                if result is not None and kval is None and state.duplicates is not None:
+                    state.duplicates.remove(candidate)
+
+                if kval is not None:
+                    record_candidate(state, candidate, parent, kval, can_rs, approved, rejected)
+                if journal.appended >= COMPACT_INTERVAL:
+                    save()
+
+            end_iteration(state, approved, rejected)
     except Exception as e:
-        # We do not want to die unexpectedly without saving the current progress, so catch all errors.
         print 'Error retrieving google search results: ' + repr(e)
         traceback.print_exc()
     finally:
-        # Regardless of whether we have failed (i.e. caught an exception) or not, save the approved and rejected queries
-        # and the state of the calculation.
-        save_related_queries(seed, approved, rejected)
-        state.pickle()
+        if fetch_pool is not None:
+            fetch_pool.terminate()
+        if own_score_pool and score_pool is not None:
+            score_pool.terminate()
+
+        # Put the candidates whose results never came back at the front of the frontier.
+        save()
+        in_flight.clear()
+        report_collapsed(state)
+
+
+def run_seed_list(seed_file, limit, keycnt, workers, parallel, burst, stream=False, prune=False, collapse=False):
+    """
+    Run the concurrent related query crawl for every seed in a seed list (e.g. seed_queries.txt) in this process.
+
+    Up to parallel seeds are crawled at the same time and all of them draw their requests from one token bucket of
+    keycnt requests per hour, taking turns when several are waiting. Unlike running one process per seed in sequence,
+    the budget left unused while a seed starts up, finishes early or fails goes to the other seeds (up to burst
+    requests can be saved up for later), so the whole hourly budget gets spent.
+
+    :param seed_file: The file listing the seeds, one per line
+    :param int limit: Specifies the maximum number of times to iterate through the related queries
+    :param int keycnt: The maximum number of Google keyword requests per hour, shared by all seeds
+    :param int workers: The maximum number of requests in flight for each seed
+    :param int parallel: The maximum number of seeds crawled at the same time
+    :param int burst: The maximum number of requests that can be saved up while unused
+    :param stream: Decide on the candidates of iteration 0 as soon as a running estimate of the threshold allows it
+    :param prune: Do not crawl the related searches of the candidates of iteration 0 rejected early
+    :param collapse: Infer the kernel value of near-duplicates of the candidates already fetched instead of fetching them
+    :return: None
+    """
+    with open(seed_file, 'r') as f:
+        seed_list = filter(None, map(str.strip, f.readlines()))
+
+    bucket = TokenBucket(keycnt, burst)
+
+    # A single pool of scoring processes for all the seeds, started before any thread is running.
+    score_pool = Pool()
+    seed_pool = ThreadPool(parallel)
+    try:
+        def crawl(seed):
+            print 'Current Seed: ' + seed
+            run_google_related_queries_concurrent(seed, limit, keycnt, workers, bucket.limiter(seed), score_pool,
+                                                  stream, prune, collapse)
+
+        seed_pool.map(crawl, seed_list, chunksize=1)
+    finally:
+        seed_pool.terminate()
+        score_pool.terminate()
 
 
 def comp_survey_index_similarity(seed, indfile, keycnt):
@@ -314,7 +904,7 @@ def comp_survey_index_similarity(seed, indfile, keycnt):
 
     # Expansion set of for the seed.
     seed_page = gr.get_query_html(seed, keycnt)
-    seed_es = gr.get_google_query_summary_set(seed_page)
+    seed_es = gr.ExpansionSet(gr.extract_serp(seed_page).summary_set)
 
     # Start computing the k-values for each of the query in the index.
     approved_cnt = 0
@@ -327,7 +917,7 @@ def comp_survey_index_similarity(seed, indfile, keycnt):
 
         kval = 0.0
         try:
-            ind_es = gr.get_google_query_summary_set(ind_page)
+            ind_es = gr.extract_serp(ind_page).summary_set
 
             # Retrieve the kernel value.
             kval = gr.kval_es(seed_es, ind_es)
@@ -363,12 +953,12 @@ def comp_survey_index_similarity(seed, indfile, keycnt):
     return
 
 
-def do_pairwise(seed, keycnt):
+def load_pairwise_queries(seed):
     """
-    Computes the pairwise k-values between the coded index queries and the corresponding
-    survey queries for the given seed.
-    :param seed:
-    :param keycnt:
+    Load the coded index queries and the survey queries of a seed for the pairwise k-value computation.
+
+    :param seed: The seed query
+    :return: The survey queries and the coded queries as a tuple of lists (survey, coded)
     """
     CODED_DIR = "./gtrends/coded/"
     SURVEY_QUERY_DIR = "./surveyQueries/grouped_by_seed/"
@@ -390,19 +980,31 @@ def do_pairwise(seed, keycnt):
         for row in reader:
             coded_list.append(row[0])
 
+    return survey_queries, coded_list
+
+
+def do_pairwise(seed, keycnt):
+    """
+    Computes the pairwise k-values between the coded index queries and the corresponding
+    survey queries for the given seed.
+    :param seed:
+    :param keycnt:
+    """
+    survey_queries, coded_list = load_pairwise_queries(seed)
+
     # For each of the coded query bring in their search results page and cache it.
     coded_ex_sets = dict()
     for q in coded_list:
         # Expansion set of for the query.
         query_page = gr.get_query_html(q, keycnt)
-        query_es = gr.get_google_query_summary_set(query_page)
+        query_es = gr.ExpansionSet(gr.extract_serp(query_page).summary_set)
         coded_ex_sets[q] = query_es
 
     # Now we bring in the survey query expansion set, and do pairwise k-value computation.
     results = dict()
     for s in survey_queries:
         squery_page = gr.get_query_html(s, keycnt)
-        squery_es = gr.get_google_query_summary_set(squery_page)
+        squery_es = gr.ExpansionSet(gr.extract_serp(squery_page).summary_set)
 
         kvals = dict()
         for q in coded_list:
@@ -433,27 +1035,145 @@ def do_pairwise(seed, keycnt):
     return
 
 
+def do_pairwise_batch(seed, keycnt, block_size=PAIRWISE_BLOCK_SIZE):
+    """
+    Computes the pairwise k-values between the coded index queries and the corresponding survey queries for the given
+    seed as one kernel matrix.
+
+    Rather than refitting a vectorizer for every pair as do_pairwise does, the expansion sets of all the queries are
+    vectorized once over a shared vocabulary and inverse document frequencies (see qe_store.py), so the values differ
+    slightly from the ones of do_pairwise. The coded x survey kernel matrix is then computed by sparse matrix products
+    over blocks of coded queries, which bounds the memory used to block_size rows of the matrix at a time. The matrix
+    is written to the pairwise directory as a csv laid out as the one of do_pairwise, as well as a .npy file along
+    with files listing the row (coded) and column (survey) labels. Queries whose page could not be retrieved get a
+    k-value of -1.
+
+    :param seed: The seed query
+    :param keycnt: The maximum number of Google keyword requests per hour
+    :param block_size: The number of coded queries per block
+    :return: None
+    """
+    survey_queries, coded_list = load_pairwise_queries(seed)
+    survey_queries = list(OrderedDict.fromkeys(survey_queries))
+    coded_list = list(OrderedDict.fromkeys(coded_list))
+
+    expansion_sets = qe_store.get_expansion_sets(coded_list + survey_queries, keycnt)
+    if not any(len(es) for es in expansion_sets.values()):
+        return
+    try:
+        store = qe_store.QEVectorStore.build(expansion_sets)
+    except ValueError as e:
+        # The summaries hold no terms outside of the stop words.
+        print 'Error building the expansion vectors: ' + repr(e)
+        return
+
+    # Rows of the kernel matrix for the coded and survey queries we have vectors for.
+    coded_found = [i for (i, q) in enumerate(coded_list) if q in store]
+    survey_found = [j for (j, s) in enumerate(survey_queries) if s in store]
+    coded_vectors = store.vectors[[store.index[coded_list[i]] for i in coded_found]]
+    survey_vectors_t = store.vectors[[store.index[survey_queries[j]] for j in survey_found]].T.tocsc()
+
+    # Create the directory if needed.
+    directory = './pairwise'
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    fn_prefix = os.path.join(directory, seed.replace(' ', '_') + '_batch')
+    qe_store.write_lines(fn_prefix + '_rows.txt', coded_list)
+    qe_store.write_lines(fn_prefix + '_cols.txt', survey_queries)
+    kmat = np.lib.format.open_memmap(fn_prefix + '.npy', mode='w+', dtype=np.float32,
+                                     shape=(len(coded_list), len(survey_queries)))
+    kmat[:] = -1.0
+
+    with open(fn_prefix + '.csv', 'w') as f:
+        csv_writer = csv.writer(f, lineterminator='\n')
+        csv_writer.writerow([''] + survey_queries)
+
+        found_row = dict((i, r) for (r, i) in enumerate(coded_found))
+        for start in range(0, len(coded_list), block_size):
+            end = min(start + block_size, len(coded_list))
+            block_rows = [i for i in range(start, end) if i in found_row]
+            if block_rows:
+                block = (coded_vectors[[found_row[i] for i in block_rows]] * survey_vectors_t).toarray()
+                kmat[np.ix_(block_rows, survey_found)] = block
+
+            for i in range(start, end):
+                csv_writer.writerow([coded_list[i]] + kmat[i].tolist())
+
+    kmat.flush()
+    del kmat
+    return
+
+
 def main():
     ap = argparse.ArgumentParser(description='Use the script to pull google related search queries.')
-    ap.add_argument('-s', '-seed', help='Seed word', required=True)
+    ap.add_argument('-s', '-seed', help='Seed word')
+    ap.add_argument('-l', '-seedlist', help='File listing the seeds to crawl in this process, one per line, sharing '
+                                            'the keyword limit, overrides the seed parameter')
     ap.add_argument('-i', '-iteration', help='limit to number of related search iteration', default=3)
     ap.add_argument('-k', '-keywordlimit', help='limit to number of keyword request per hour', default=30)
     ap.add_argument('-c', '-comp', help='compute the k-value for the survey index, overrides the iteration '
                                         'limit parameter if given', action='store_true')
     ap.add_argument('-f', '-file', help='file containing the index for computing k-values')
     ap.add_argument('-p', '-pairwise', help='Do pairwise k-value computation for given seed',       action='store_true')
+    ap.add_argument('-w', '-workers', help='Number of concurrent Google requests in the related search crawl, the '
+                                           'keyword limit is shared between them', default=1, type=int)
+    ap.add_argument('-n', '-parallel', help='Number of seeds crawled at the same time with the seed list parameter',
+                    default=4, type=int)
+    ap.add_argument('-e', '-burst', help='Number of keyword requests that can be saved up while unused with the seed '
+                                         'list parameter', default=10, type=int)
+    ap.add_argument('-u', '-url', help='Address of the search page, e.g. a local stand-in server',
+                    default=gr.SEARCH_URL)
+    ap.add_argument('-b', '-batch', help='Compute the pairwise k-values as one kernel matrix over a shared '
+                                         'vocabulary, used with the pairwise parameter', action='store_true')
+    ap.add_argument('-d', '-cachedir', help='Directory of the search result page cache', default=DEFAULT_CACHE_DIR)
+    ap.add_argument('-o', '-offline', help='Only use search result pages from the cache, never query Google',
+                    action='store_true')
+    ap.add_argument('-r', '-budget', help='Crawl best-first, fetching at most this many candidates, the iteration '
+                                          'limit bounds the depth', type=int)
+    ap.add_argument('-a', '-cutoff', help='Stop the best-first crawl when the acceptance rate falls under this value',
+                    default=0.1, type=float)
+    ap.add_argument('-m', '-window', help='Number of recent candidates the acceptance rate of the best-first crawl is '
+                                          'computed over', default=50, type=int)
+    ap.add_argument('-t', '-stream', help='Decide on the candidates of the first iteration as soon as a running '
+                                          'estimate of the threshold allows it', action='store_true')
+    ap.add_argument('-z', '-prune', help='Do not crawl the related searches of the candidates rejected early, used '
+                                         'with the stream parameter', action='store_true')
+    ap.add_argument('-x', '-collapse', help='Infer the k-value of near-duplicates of the candidates already fetched '
+                                            'instead of fetching them', action='store_true')
 
     args = ap.parse_args()
+    if args.s is None and args.l is None:
+        ap.error('either the seed or the seed list parameter is required')
 
     seed, limit, keycnt, comp, indfile, pairwise = args.s, int(args.i), int(args.k), bool(args.c), args.f, bool(args.p)
 
-    if comp:
+    cache = SerpCache(args.d, offline=bool(args.o))
+    gr.set_serp_cache(cache)
+    gr.set_search_url(args.u)
+    token_file = os.path.join(args.d, TOKEN_CACHE_FILE)
+    gr.get_token_cache().load(token_file)
+
+    if args.l is not None:
+        run_seed_list(args.l, limit, keycnt, args.w, args.n, args.e, args.t, args.z, args.x)
+    elif comp:
         comp_survey_index_similarity(seed, indfile, keycnt)
+    elif pairwise and args.b:
+        do_pairwise_batch(seed, keycnt)
     elif pairwise:
         do_pairwise(seed, keycnt)
+    elif args.r is not None:
+        run_google_related_queries_best_first(seed, limit, keycnt, args.r, args.a, args.m, args.t, args.z,
+                                              args.x)
+    elif args.w > 1:
+        run_google_related_queries_concurrent(seed, limit, keycnt, args.w, stream=args.t, prune=args.z, collapse=args.x)
     else:
-        run_google_related_queries(seed, limit, keycnt)
+        run_google_related_queries(seed, limit, keycnt, args.t, args.z, args.x)
+
+    gr.get_token_cache().save(token_file)
 
+    # The comparison mode output is redirected into a csv, so keep the counters out of stdout.
+    print >> sys.stderr, cache.stats()
     return
 
 
@@ -38,10 +38,8 @@ import argparse
 import csv
 from random import randint, shuffle
 import os
-import operator as op
 import pandas as pd
 from time import sleep
-from math import ceil
 
 # third party imports
 from pytrends.request import TrendReq
@@ -49,6 +47,10 @@ from pytrends.request import TrendReq
 # local imports
 from keys import google_auth
 from refs import refs
+from trend_store import scale_to_reference
+
+# Google Trends compares at most five keywords in one payload.
+MAX_PAYLOAD_TERMS = 5
 
 def get_google_auth():
     """
@@ -89,6 +91,79 @@ def get_pytrends_obj():
     py_trends = TrendReq(google_user, google_pass, custom_useragent='WSPR PrivacySearchQueries')
     return py_trends
 
+def get_trend_filename(seed, term, comp):
+    """
+    Get the file holding the trend data of a term.
+
+    :param seed: The seed the term was collected for
+    :param term: The term
+    :param comp: True if the term is compared with the seed reference
+    :return: The path of the csv file
+    """
+    dir_suffix = seed
+    if comp:
+        dir_suffix += ' comp'
+    label = term.replace('/', '_')
+    return os.path.join('./gtrends', dir_suffix, label + '.csv')
+
+
+def split_trend_data(df, term, ref):
+    """
+    Extract the comparison of a term with the reference from the trend data of a batch of terms compared with the same
+    reference. Google normalizes the interest of all the keywords of a payload by their overall maximum, so the values
+    are renormalized so that the maximum of the term and the reference is 100, as it would be in a payload of the two.
+    The values of a term much smaller than the others of its batch are coarser than in a payload of its own.
+
+    :param df: The trend data of the batch
+    :param term: The term
+    :param ref: The reference
+    :return: The trend data of the term and the reference, in the layout written by get_trend_data
+    """
+    cols = [term, ref] + [c for c in df.columns if c == 'isPartial']
+    pair = df[cols].copy()
+    peak = pair[[term, ref]].values.max()
+    if peak > 0:
+        pair[[term, ref]] = (pair[[term, ref]] * (100 / peak)).round().astype(int)
+    return pair
+
+
+def get_trend_data_batch(t, terms, failed, seed, ref, sleep_time):
+    """
+    Pull the trend data of several terms compared with the seed reference in a single request, and write the data of
+    each term to its own file as get_trend_data does. If the request fails, each term of the batch is pulled on its own
+    so that one bad term does not fail the others.
+
+    :param t: The pytrends object
+    :param terms: The terms, at most MAX_PAYLOAD_TERMS - 1 of them and none equal to the reference
+    :param failed: The list of terms without trend data, to be extended
+    :param seed: The seed query
+    :param ref: The reference of the seed
+    :param sleep_time: Amount of time to wait between trend requests
+    :return: None
+    """
+    try:
+        t.build_payload(terms + [ref], timeframe='2011-01-01 2017-01-31')
+        df = t.interest_over_time()
+        for term in terms:
+            filename = get_trend_filename(seed, term, True)
+            if df.empty:
+                # No data for any of the terms, nor for a pair of them.
+                df.to_csv(filename)
+            else:
+                split_trend_data(df, term, ref).to_csv(filename)
+    except Exception as e:
+        print 'No trend data for batch: ' + ', '.join(terms), repr(e)
+        sleep(randint(sleep_time, sleep_time+5))
+
+        # Isolate the terms of the failed batch.
+        for term in terms:
+            get_trend_data(t, term, failed, seed, ref, True, sleep_time)
+        return
+
+    sleep(randint(sleep_time, sleep_time+5))
+    return
+
+
 def get_trend_data(t, term, failed, seed, ref, comp, sleep_time):
     """
 
@@ -101,15 +176,11 @@ def get_trend_data(t, term, failed, seed, ref, comp, sleep_time):
     :param sleep_time:
     :return:
     """
-    # First check if we have the data from some other session.
-    dir_suffix = seed
-
     # Remove any residual newlines due to cross platform csv processing.
     term = term.translate(None, "\r\n")
-    if comp:
-        dir_suffix += ' comp'
-    label = term.replace('/', '_')
-    filename = os.path.join('./gtrends', dir_suffix, label + '.csv')
+
+    # First check if we have the data from some other session.
+    filename = get_trend_filename(seed, term, comp)
     if os.path.isfile(filename):
         return
 
@@ -151,7 +222,7 @@ def get_trend_data_multiple(t, terms, failed, sleep_time):
     return scale_df
 
 
-def run_google_trends(trends_file, seed, comp, scale, limit, amt):
+def run_google_trends(trends_file, seed, comp, scale, limit, amt, batch=False):
     """
     Collect the trend data for all queries in a file if the data exists. This function has the ability to recover from
     failure if Google's anti-spam prevention temporarily causes the trend collection from failing.
@@ -162,6 +233,7 @@ def run_google_trends(trends_file, seed, comp, scale, limit, amt):
     :param scale: Set to True if you want to pull trends data for the seed (reference for seed) comparison scale for the given seed. This will override the comp parameter.
     :param limit: No. of trend request to make per hour.
     :param amt: Indicate which seed queries list to use.
+    :param batch: Set to True to pull the trends of several queries in each request when comparing with the seed.
     :return: None
     """
     dir_suffix = seed
@@ -213,7 +285,7 @@ def run_google_trends(trends_file, seed, comp, scale, limit, amt):
                 for row in reader:
                     trends_list.append(row[0])
 
-        pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp)
+        pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp, batch)
 
     return
 
@@ -269,15 +341,19 @@ def pull_seed_scale(dir_suffix, seed, sleep_time, seed_list):
         print "No non-zero trend for seed: " + seed + ", ref: " + ref
         return
 
-    ref_df = pd.DataFrame()
-    ref_df = pd.concat([ref_df, ref_vals_scaled], axis=1)
-
-    # Load the seed queries list
+    # Pull every seed against the reference first, and keep the
+    # reference and seed trends of each request to scale them at once.
+    cols = list()
+    ref_rows = list()
+    rows = list()
     for s in seed_list:
         if s != seed:
             r = s
             if s in refs.keys():
                 r = refs[s]
+            if r == ref:
+                # Seeds sharing the reference are on its scale already.
+                continue
             terms.append(r)
         else:
             continue
@@ -286,43 +362,36 @@ def pull_seed_scale(dir_suffix, seed, sleep_time, seed_list):
 
         # Remove all the terms except the seed for the next request.
         del terms[1:]
-
-        # Process the dataframe and combine it with the other.
-        col_names = scale_df.columns.values.tolist()
-        col_names.remove(ref)
-        # If there aren't any value for the reference columns then
-        # we can't do anything.
-        ref_vals = scale_df[ref]
-        if not (ref_vals > 0).any():
-            failed_list.extend(col_names)
-            continue
-
-        # Determine the scale factor from the reference column.
-        max_ref_val = max(ref_vals)
-        scale_factor = 100/max_ref_val
-        do_scale = lambda x: int(ceil(x*scale_factor))
-        ref_vals = ref_vals.apply(do_scale)
-
-        # Get the sum of the absolute difference
-        # between scaled reference values.
-        scaled_diff = sum(map(op.abs, map(op.sub, ref_vals, ref_vals_scaled)))
-
-        # If the scaled difference is more than 2.5 for each of the rows
-        # in the dataframe then there is only minute data for these terms.
-        # Compared to the peak, the maximum value is very small. So, we
-        # shouldn't scale in this case.
-        if scaled_diff > int(scale_df.shape[0]*2.5):
-            failed_list.extend(col_names)
+        if scale_df is None:
             continue
 
         for col in scale_df.columns:
-            if col not in ref_df.columns:
-                col_vals = scale_df[col].apply(do_scale)
-                if (col_vals > 0).any():
-                    ref_df = pd.concat([ref_df, col_vals], axis=1)
+            if col != ref:
+                cols.append(col)
+                ref_rows.append(scale_df[ref].values)
+                rows.append(scale_df[col].values)
+
+    # Scale the seeds with their reference column. If there aren't any values for the reference columns, or if the
+    # scaled reference differs by more than 2.5 for each of the rows from the reference pulled alone, there is only
+    # minute data for these terms compared to the peak. So, we shouldn't scale in this case.
+    ref_df = ref_vals_scaled.to_frame()
+    if cols:
+        scaled, accepted = scale_to_reference(ref_rows, ref_vals_scaled.values, rows)
+
+        keep = list()
+        for (i, col) in enumerate(cols):
+            if not accepted[i]:
+                failed_list.append(col)
+            elif col not in ref_df.columns and col not in [cols[k] for k in keep]:
+                if (scaled[i] > 0).any():
+                    keep.append(i)
                 else:
                     failed_list.append(col)
 
+        if keep:
+            ref_df = pd.concat([ref_df, pd.DataFrame(scaled[keep].T, index=ref_df.index,
+                                                     columns=[cols[k] for k in keep])], axis=1)
+
     # Write failed list if any.
     if failed_list:
         write_failed_list(failed_file, seed, failed_list, len(refs), True)
@@ -331,7 +400,44 @@ def pull_seed_scale(dir_suffix, seed, sleep_time, seed_list):
     ref_df.to_csv(scale_file, index=True)
     return
 
-def pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp):
+def pull_seed_trends_batched(t, trends_list, failed_list, seed, ref, sleep_time):
+    """
+    Pulls the trend data compared with the seed reference for a list of queries, in batches of MAX_PAYLOAD_TERMS - 1
+    queries. Queries whose data was already collected are skipped, so that every batch is full.
+    :param t: The pytrends object.
+    :param trends_list: The list of queries, emptied except for the reference if it is in the list.
+    :param failed_list: The list of queries without trends data.
+    :param seed: The seed query.
+    :param ref: The reference of the seed.
+    :param sleep_time: Amount of time to wait between trend requests.
+    :return: None.
+    """
+    batch = list()
+    rest = list()
+    while trends_list:
+        term = trends_list.pop(0)
+        if term in failed_list:
+            continue
+
+        term = term.translate(None, "\r\n")
+        if term == ref:
+            # The reference cannot be compared with itself in a batch.
+            rest.append(term)
+            continue
+        if term in batch or os.path.isfile(get_trend_filename(seed, term, True)):
+            continue
+
+        batch.append(term)
+        if len(batch) == MAX_PAYLOAD_TERMS - 1:
+            get_trend_data_batch(t, batch, failed_list, seed, ref, sleep_time)
+            batch = list()
+
+    if batch:
+        get_trend_data_batch(t, batch, failed_list, seed, ref, sleep_time)
+    trends_list.extend(rest)
+    return
+
+def pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp, batch=False):
     """
     Pulls the seed trend data for a given seed.
     :param trends_list: The list file containing the queries to retrieve trends for. Overriden by the scale parameter.
@@ -339,6 +445,7 @@ def pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp):
     :param seed: The seed query.
     :param sleep_time: Amount of time to wait between trend requests.
     :param comp: Set to True if you want to compare the seed word against all queries when collecting trend data. This allows all trends collected to have a common reference point.
+    :param batch: Set to True to pull the trends of MAX_PAYLOAD_TERMS - 1 queries along with the seed reference in each request, used with comp.
     :return: None.
     """
     count = len(trends_list)
@@ -353,6 +460,9 @@ def pull_seed_trends(trends_list, dir_suffix, seed, sleep_time, comp):
         ref = refs[seed]
 
     py_trends = get_pytrends_obj()
+    if comp and batch:
+        pull_seed_trends_batched(py_trends, trends_list, failed_list, seed, ref, sleep_time)
+
     while trends_list:
         term = trends_list.pop(0)
         if term in failed_list:
@@ -372,9 +482,11 @@ def main():
     ap.add_argument('-l', '-scale', help='Enable seed to seed comparison scale', action='store_true')
     ap.add_argument('-k', '-keywordlimit', help='limit to number of keyword request per hour', default=200)
     ap.add_argument('-a', '-amt', help='Use the AMT seed list rather than the index one', action='store_true')
+    ap.add_argument('-b', '-batch', help='Pull the trends of four keywords with the seed in each request, used with '
+                                         'the seed comparison', action='store_true')
     args = ap.parse_args()
 
-    run_google_trends(args.f, args.s, args.c, args.l, args.k, args.a)
+    run_google_trends(args.f, args.s, args.c, args.l, args.k, args.a, args.b)
     return
 
 if __name__ == '__main__':
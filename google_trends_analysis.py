@@ -5,21 +5,17 @@
 from __future__ import division
 import csv
 import os
-import glob
 import pandas as pd
 import numpy as np
 from collections import OrderedDict
 from datetime import datetime
+from multiprocessing import Pool
 
-from trend_stats import cliffs_delta, load_trends_df, kstest2samp
-
-# In[18]:
-
-def get_trend_files(dirname, extension):
-    filestring = dirname + '/*.{}'
-    files = [i for i in glob.glob(filestring.format(extension))]
-    return files
+from trend_tests import split_tests, sweep_tests
+from trend_store import TrendStore, open_trends, seed_matrix
 
+SUMMARY_FILE = "summary.csv"
+RANK_SUM_FILE = "rank sums.csv"
 
 # In[19]:
 
@@ -34,37 +30,142 @@ def save_stats(results, dirname, seed):
 
 # In[21]:
 
+def compute_stats(trends, seed, sd):
+    _, queries, values = trends.matrix(seed)
+    months = pd.to_datetime(trends.months(seed), format='%Y-%m-%d')
+    pre = np.asarray(months < sd)
+
+    # Run the tests on all the queries at once, or on each group of
+    # queries having the same months if some miss a few of them.
+    groups = OrderedDict()
+    for (i, missing) in enumerate(np.isnan(values)):
+        groups.setdefault(missing.tostring(), (missing, list()))[1].append(i)
+
+    tests = np.zeros((len(queries), 5))
+    for (missing, rows) in groups.itervalues():
+        prevals = values[rows][:, pre & ~missing]
+        postvals = values[rows][:, ~pre & ~missing]
+
+        # Compute ks 2-sample test with p-value, the Wilcoxon rank-sum
+        # (Mann-Whitney U) test with p-value and the Cliff's Delta value
+        df = split_tests(np.hstack([prevals, postvals]), prevals.shape[1])
+        tests[rows] = df[['ks', 'ks pvalue', 'delta', 'u', 'u pvalue']].values
+
+    results = OrderedDict()
+    for (i, query) in enumerate(queries):
+        results[query] = (tests[i, 0], tests[i, 1], float(tests[i, 2]), tests[i, 3], tests[i, 4])
+    return results
+
+
 def process_trends(trendsdir, seed, splitdate, resultdir):
     # Make results directory if not exists.
     if not os.path.exists(resultdir):
         os.makedirs(resultdir)
 
     sd = datetime.strptime(splitdate, '%Y-%m-%d')
-    dirname = os.path.join(trendsdir, seed)
-    filenames = get_trend_files(dirname, "csv")
-    results = OrderedDict()
-    for fname in filenames:
-        df = load_trends_df(fname)
-        query = df.columns[1]
+    trends = open_trends(trendsdir)
+    results = compute_stats(trends, seed, sd)
 
-        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
-        predf = df[df['date'] < sd]
-        postdf = df[df['date'] >= sd]
+    # Save the results into a csv.
+    save_stats(results, resultdir, seed)
+    return
 
-        prevals = predf[query].values
-        postvals = postdf[query].values
 
-        # Compute ks 2-sample test with p-value
-        ksval, pvalue = kstest2samp(prevals, postvals)
+def sweep_trends(trendsdir, seed, startdate, enddate, resultdir):
+    # Make results directory if not exists.
+    if not os.path.exists(resultdir):
+        os.makedirs(resultdir)
 
-        # Compute the Cliff's Delta value
-        d, flag = cliffs_delta(prevals, postvals)
+    trends = open_trends(trendsdir)
+    queries, values, months = seed_matrix(trends, seed)
+
+    # Every month from the start to the end date is a candidate split,
+    # as long as there is data on both sides of it.
+    start = np.datetime64(datetime.strptime(startdate, '%Y-%m-%d'))
+    end = np.datetime64(datetime.strptime(enddate, '%Y-%m-%d'))
+    splits = [k for k in range(1, len(months)) if start <= months[k] <= end]
+    if not queries or not splits:
+        return
+
+    ks, deltas = sweep_tests(values, splits)
+    dates = pd.Index(pd.to_datetime(months[splits]).strftime('%Y-%m-%d'), name='date')
+    pd.DataFrame(ks, index=dates, columns=queries).to_csv(os.path.join(resultdir, seed + " sweep ks.csv"))
+    pd.DataFrame(deltas, index=dates, columns=queries).to_csv(os.path.join(resultdir, seed + " sweep delta.csv"))
+    return
 
-        results[query] = (ksval, pvalue, d)
 
-    # Save the results into a csv.
+# In[22]:
+
+# Trend data shared with the worker processes of run_seed_list, which
+# inherit it when forked instead of each loading it again.
+_trends = None
+
+
+def seed_stats_worker(args):
+    seed, splitdate, resultdir = args
+    results = compute_stats(_trends, seed, datetime.strptime(splitdate, '%Y-%m-%d'))
     save_stats(results, resultdir, seed)
-    return
+    return seed, results
+
+
+def summarize_stats(stats, alpha=0.05):
+    # One row per seed: the number of queries, of queries whose trend
+    # changed at the split date and in which direction (Cliff's Delta is
+    # positive when the values before the split are larger).
+    rows = list()
+    for (seed, results) in stats:
+        vals = np.array(results.values(), dtype=np.float64).reshape(-1, 5)
+        significant = vals[:, 1] < alpha
+        rows.append(OrderedDict([('seed', seed),
+                                 ('queries', len(vals)),
+                                 ('significant', significant.sum()),
+                                 ('increased', (significant & (vals[:, 2] < 0)).sum()),
+                                 ('decreased', (significant & (vals[:, 2] > 0)).sum()),
+                                 ('rank-sum significant', (vals[:, 4] < alpha).sum()),
+                                 ('mean ks', vals[:, 0].mean() if len(vals) else np.nan),
+                                 ('mean delta', vals[:, 2].mean() if len(vals) else np.nan)]))
+    return pd.DataFrame(rows, columns=['seed', 'queries', 'significant', 'increased', 'decreased',
+                                       'rank-sum significant', 'mean ks', 'mean delta'])
+
+
+def save_rank_sums(stats, filename):
+    # The Mann-Whitney U statistic of the values after the split (the rank-sum
+    # test) and its p-value for every query of every seed.
+    with open(filename, 'w') as f:
+        csv_writer = csv.writer(f, lineterminator='\n')
+        csv_writer.writerow(['seed', 'query', 'u', 'p'])
+        for (seed, results) in stats:
+            for (k, v) in results.iteritems():
+                csv_writer.writerow([seed, k, v[3], v[4]])
+
+
+def run_seed_list(trendsdir, seed_file, splitdate, resultdir, processes=None):
+    global _trends
+
+    # Make results directory if not exists.
+    if not os.path.exists(resultdir):
+        os.makedirs(resultdir)
+
+    with open(seed_file, 'r') as f:
+        seed_list = filter(None, map(str.strip, f.readlines()))
+
+    # Load the trend data once for all the seeds, importing the csv
+    # files into memory if the directory is not a trend store.
+    _trends = open_trends(trendsdir)
+    if not isinstance(_trends, TrendStore):
+        _trends = TrendStore.build(_trends)
+
+    pool = Pool(processes)
+    try:
+        stats = pool.map(seed_stats_worker, [(seed, splitdate, resultdir) for seed in seed_list], chunksize=1)
+    finally:
+        pool.terminate()
+        _trends = None
+
+    summary = summarize_stats(stats)
+    summary.to_csv(os.path.join(resultdir, SUMMARY_FILE), index=False)
+    save_rank_sums(stats, os.path.join(resultdir, RANK_SUM_FILE))
+    return summary
 
 
 # In[24]:
@@ -72,10 +173,15 @@ def process_trends(trendsdir, seed, splitdate, resultdir):
 def main():
     import argparse
     ap = argparse.ArgumentParser(description="Compute 2 sample ks test and Cliff's Delta for the trend data of a given seed")
-    ap.add_argument("-s", "-seed", help="Seed word", required=True)
-    ap.add_argument("-d", "-dir", help="Directory containing the trends data for seeds", required=True)
+    ap.add_argument("-s", "-seed", help="Seed word")
+    ap.add_argument("-f", "-file", help="File listing the seeds to compute for in parallel, instead of a single seed, e.g. "
+                                        "seed_queries.txt")
+    ap.add_argument("-p", "-procs", help="Number of worker processes for a seed list, by default one per CPU", type=int)
+    ap.add_argument("-d", "-dir", help="Directory containing the trends data for seeds, or its trend store", required=True)
     ap.add_argument("-i", "-inc", help="Incident date to split the trend data in YYYY-m-d format", required=True)
     ap.add_argument("-r", "-rdir", help="Directory to put the results of the compute", required=True)
+    ap.add_argument("-e", "-end", help="End date in YYYY-m-d format to compute for every split month from the incident "
+                                       "date to this date, for a single seed")
 
     args = ap.parse_args()
 
@@ -84,7 +190,17 @@ def main():
     splitdate = args.i
     resultdir = args.r
 
-    process_trends(trendsdir, seed, splitdate, resultdir)
+    if args.e is not None:
+        if seed is None:
+            ap.error("a sweep of split dates is computed for a single seed")
+        sweep_trends(trendsdir, seed, splitdate, args.e, resultdir)
+    elif args.f is not None:
+        summary = run_seed_list(trendsdir, args.f, splitdate, resultdir, args.p)
+        print summary.to_string(index=False)
+    elif seed is not None:
+        process_trends(trendsdir, seed, splitdate, resultdir)
+    else:
+        ap.error("a seed or a seed list is required")
     return
 
 
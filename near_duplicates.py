@@ -0,0 +1,161 @@
+#
+# This file contains the detection of near-duplicate queries used to collapse candidates of the related query crawl
+# (see google_related_queries.py).
+#
+# The related searches Google gives are often variants of one another, e.g. "delete gmail", "deleting gmail" and "how do
+# i delete my gmail", whose search results and kernel values are nearly the same. Each query is first canonicalized by
+# lower casing it, dropping punctuation and stop words, stemming the remaining words and sorting them, which makes all
+# three of the examples above the same query. To also catch variants that differ by a letter or two (e.g. typos), the
+# canonical query is reduced to a MinHash signature over its character shingles, and signatures are indexed with
+# locality sensitive hashing so that the queries within a Jaccard similarity threshold of a new query are found
+# without comparing it to every query seen.
+#
+# The first query of a cluster to be added to the index is its representative.
+#
+
+# standard library imports
+from __future__ import division
+from string import punctuation
+import zlib
+
+# third party imports
+import numpy as np
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+# local imports
+import google_query_similarity as gr
+
+MINHASH_PRIME = (1 << 31) - 1
+
+
+def canonicalize(query):
+    """
+    Get the canonical form of a query: its stemmed words without stop words and punctuation, in sorted order.
+
+    :param query: The query
+    :return: The canonical query as a string
+    """
+    if not isinstance(query, unicode):
+        query = query.decode('utf-8', 'ignore')
+    query = gr.to_ascii(query)
+    words = query.lower().translate(None, punctuation).split()
+    stems = [gr.stem_word(w) for w in words if w not in ENGLISH_STOP_WORDS]
+    if len(stems) == 0:
+        # Keep queries made only of stop words apart.
+        stems = words
+    return ' '.join(sorted(stems))
+
+
+def shingles(text, size):
+    """
+    Get the character shingles of a text.
+
+    :param text: The text
+    :param size: The number of characters of a shingle
+    :return: The set of shingles, the text itself if it is shorter than a shingle
+    """
+    if len(text) <= size:
+        return {text}
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+class NearDuplicateIndex(object):
+    def __init__(self, threshold=0.85, num_perm=64, bands=16, shingle=3):
+        """
+        Create an empty index of queries.
+
+        :param threshold: The estimated Jaccard similarity of the canonical queries above which two queries are near
+                          duplicates
+        :param num_perm: The number of hash functions of the MinHash signatures
+        :param bands: The number of bands the signatures are split into for locality sensitive hashing, it must divide
+                      num_perm
+        :param shingle: The number of characters of a shingle
+        """
+        self.threshold = threshold
+        self.bands = bands
+        self.shingle = shingle
+
+        rs = np.random.RandomState(1)
+        self._a = rs.randint(1, MINHASH_PRIME, size=num_perm).astype(np.int64)
+        self._b = rs.randint(0, MINHASH_PRIME, size=num_perm).astype(np.int64)
+
+        self._canonical = dict()
+        self._signatures = dict()
+        self._buckets = dict()
+
+    def __contains__(self, query):
+        return query in self._signatures
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def signature(self, canonical):
+        """
+        Compute the MinHash signature of a canonical query.
+
+        :param canonical: The canonical query
+        :return: The signature as an array of num_perm integers
+        """
+        x = np.array([zlib.crc32(s) & MINHASH_PRIME for s in shingles(canonical, self.shingle)], dtype=np.int64)
+        return ((np.outer(x, self._a) + self._b) % MINHASH_PRIME).min(axis=0)
+
+    def _band_keys(self, sig):
+        rows = len(sig) // self.bands
+        return [(i, sig[i * rows:(i + 1) * rows].tostring()) for i in range(self.bands)]
+
+    def lookup(self, query, accept=None):
+        """
+        Find the representative of the cluster of a query.
+
+        :param query: The query
+        :param accept: Function telling whether a query of the index can be returned, any query can be if None
+        :return: A query of the index with the same canonical form, or else the most similar one within the threshold,
+                 None if there is none
+        """
+        canonical = canonicalize(query)
+        if canonical in self._canonical and (accept is None or accept(self._canonical[canonical])):
+            return self._canonical[canonical]
+
+        sig = self.signature(canonical)
+        found = set()
+        for key in self._band_keys(sig):
+            found.update(self._buckets.get(key, ()))
+
+        best, best_sim = None, self.threshold
+        for q in found:
+            if accept is not None and not accept(q):
+                continue
+            sim = np.mean(self._signatures[q] == sig)
+            if sim >= best_sim:
+                best, best_sim = q, sim
+        return best
+
+    def add(self, query):
+        """
+        Add a query to the index as the representative of its cluster.
+
+        :param query: The query
+        :return: None
+        """
+        canonical = canonicalize(query)
+        sig = self.signature(canonical)
+        self._canonical.setdefault(canonical, query)
+        self._signatures[query] = sig
+        for key in self._band_keys(sig):
+            self._buckets.setdefault(key, set()).add(query)
+
+    def remove(self, query):
+        """
+        Remove a query from the index.
+
+        :param query: The query
+        :return: None
+        """
+        sig = self._signatures.pop(query, None)
+        if sig is None:
+            return
+        canonical = canonicalize(query)
+        if self._canonical.get(canonical) == query:
+            del self._canonical[canonical]
+        for key in self._band_keys(sig):
+            self._buckets[key].discard(query)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python2.7
+#
+# This script builds and serves a persistent store of query expansion (QE) vectors (see google_query_similarity.py for
+# the kernel function they are used in).
+#
+# kval_es fits the inverse document frequencies over the union of the two expansion sets it compares, so the expansion
+# vectors it computes cannot be reused outside of that pair. The store instead fits one vocabulary and one set of
+# inverse document frequencies over the expansion sets of every query it holds (e.g. all the queries collected for a
+# seed), and keeps the L2 normalized QE vector of each query. The kernel between two queries of the store is then a
+# single sparse dot product.
+#
+# Since the inverse document frequencies are shared by the whole corpus rather than fitted for each pair, the kernel
+# values of the store are close to, but not the same as, the ones given by kval_es. Values from the two should not be
+# compared against each other (e.g. against a threshold computed by the crawl).
+#
+# A store is saved as a directory of .npy arrays holding the float32 CSR matrix of vectors and the inverse document
+# frequencies, along with text files listing the vocabulary and the queries in column and row order. The arrays are
+# memory mapped when loaded.
+#
+# You will need to provide the following arguments to the argument parser for this script:
+#
+# * seed
+# * optionally, the files holding the queries to add to the store (queries in the first column), by default the
+#   approved and rejected queries collected for the seed by google_related_queries.py
+#
+
+# standard library imports
+from __future__ import division
+from argparse import ArgumentParser
+from collections import OrderedDict
+import csv
+import os
+
+# third party imports
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+# local imports
+import google_query_similarity as gr
+from serp_cache import DEFAULT_CACHE_DIR, SerpCache
+from token_cache import TOKEN_CACHE_FILE
+
+QE_STORE_DIR = './qevectors/'
+
+
+class QEVectorStore(object):
+    def __init__(self, vocabulary, idf, queries, vectors):
+        """
+        Create a store from its parts. Use build to create a store from expansion sets and load to open a saved one.
+
+        :param vocabulary: Dictionary mapping every term to its column
+        :param idf: The inverse document frequency of each column
+        :param queries: The list of queries, in row order
+        :param vectors: The sparse queries x terms matrix of L2 normalized QE vectors
+        """
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.queries = list(queries)
+        self.index = dict((q, i) for (i, q) in enumerate(self.queries))
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, expansion_sets):
+        """
+        Build a store by fitting the vocabulary and inverse document frequencies over all the given expansion sets.
+
+        :param expansion_sets: Ordered dictionary mapping each query to its expansion set
+        :return: The store holding the QE vector of every query
+        """
+        queries = list()
+        docs = list()
+        offsets = [0]
+        for (q, es) in expansion_sets.iteritems():
+            queries.append(q)
+            docs.extend(es)
+            offsets.append(len(docs))
+
+        cv = CountVectorizer(tokenizer=gr.word_tokenize, stop_words='english')
+        counts = cv.fit_transform(docs)
+        df = np.bincount(counts.indices, minlength=len(cv.vocabulary_))
+        idf = gr.get_idf(df, len(docs)).astype(np.float32)
+
+        vectors = gr.get_query_expansion_matrix(counts, idf, offsets).astype(np.float32)
+        return cls(cv.vocabulary_, idf, queries, vectors)
+
+    def __contains__(self, query):
+        return query in self.index
+
+    def __len__(self):
+        return len(self.queries)
+
+    def add(self, expansion_sets):
+        """
+        Add the QE vectors of new queries, computed with the vocabulary and inverse document frequencies of the store.
+        Terms outside of the vocabulary are ignored. Queries already in the store are replaced.
+
+        :param expansion_sets: Ordered dictionary mapping each query to its expansion set
+        :return: None
+        """
+        docs = list()
+        offsets = [0]
+        for es in expansion_sets.itervalues():
+            docs.extend(es)
+            offsets.append(len(docs))
+
+        cv = CountVectorizer(tokenizer=gr.word_tokenize, stop_words='english', vocabulary=self.vocabulary)
+        added = gr.get_query_expansion_matrix(cv.transform(docs), self.idf, offsets).astype(np.float32)
+
+        keep = [i for (i, q) in enumerate(self.queries) if q not in expansion_sets]
+        self.queries = [self.queries[i] for i in keep] + list(expansion_sets.iterkeys())
+        self.index = dict((q, i) for (i, q) in enumerate(self.queries))
+        self.vectors = sp.vstack([self.vectors[keep], added], format='csr')
+
+    def vector(self, query):
+        """
+        Get the QE vector of a query of the store.
+
+        :param query: The query
+        :return: The sparse 1 x terms QE vector
+        """
+        return self.vectors[self.index[query]]
+
+    def terms(self, query):
+        """
+        Get the non-zero entries of the QE vector of a query of the store.
+
+        :param query: The query
+        :return: A tuple (columns, weights) of the non-zero entries
+        """
+        i = self.index[query]
+        start, end = self.vectors.indptr[i], self.vectors.indptr[i + 1]
+        return self.vectors.indices[start:end], self.vectors.data[start:end]
+
+    def kval(self, q, c):
+        """
+        Find the kernel function value between two queries of the store.
+
+        :param q: Query string to calculate the kernel value in reference to
+        :param c: Candidate to calculate the k value for
+        :return: Value of kernel function
+        """
+        # Work on the raw CSR arrays, slicing rows out of the sparse
+        # matrix costs far more than the product itself.
+        tq, wq = self.terms(q)
+        tc, wc = self.terms(c)
+        _, iq, ic = np.intersect1d(tq, tc, assume_unique=True, return_indices=True)
+        return float(np.dot(wq[iq], wc[ic]))
+
+    def kvals(self, q, candidates):
+        """
+        Find the kernel function values between a query and several candidates of the store.
+
+        :param q: Query string to calculate the kernel values in reference to
+        :param candidates: List of candidates to calculate the k values for
+        :return: Array of kernel function values, in the order of the candidates
+        """
+        rows = [self.index[c] for c in candidates]
+        return self.vectors[rows].dot(self.vector(q).T).toarray().ravel()
+
+    def save(self, directory):
+        """
+        Save the store to a directory.
+
+        :param directory: The directory to save to, created if necessary
+        :return: None
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        vectors = self.vectors.tocsr()
+        np.save(os.path.join(directory, 'data.npy'), vectors.data.astype(np.float32))
+        np.save(os.path.join(directory, 'indices.npy'), vectors.indices)
+        np.save(os.path.join(directory, 'indptr.npy'), vectors.indptr)
+        np.save(os.path.join(directory, 'idf.npy'), self.idf)
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        write_lines(os.path.join(directory, 'vocabulary.txt'), terms)
+        write_lines(os.path.join(directory, 'queries.txt'), self.queries)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load a store saved with save. The arrays are memory mapped unless specified otherwise.
+
+        :param directory: The directory the store was saved to
+        :param mmap: Set to False to read the arrays into memory
+        :return: The store
+        """
+        mode = 'r' if mmap else None
+        data = np.load(os.path.join(directory, 'data.npy'), mmap_mode=mode)
+        indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode=mode)
+        indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode=mode)
+        idf = np.load(os.path.join(directory, 'idf.npy'), mmap_mode=mode)
+
+        terms = read_lines(os.path.join(directory, 'vocabulary.txt'))
+        queries = read_lines(os.path.join(directory, 'queries.txt'))
+        vocabulary = dict((t, i) for (i, t) in enumerate(terms))
+        vectors = sp.csr_matrix((data, indices, indptr), shape=(len(queries), len(terms)), copy=False)
+        return cls(vocabulary, idf, queries, vectors)
+
+
+def write_lines(filename, lines):
+    """
+    Write a list of strings to a file, one per line.
+
+    :param filename: The file to write
+    :param lines: The strings to write
+    :return: None
+    """
+    with open(filename, 'w') as f:
+        for l in lines:
+            f.write(l + '\n')
+
+
+def read_lines(filename):
+    """
+    Read a file written by write_lines.
+
+    :param filename: The file to read
+    :return: The list of strings in the file
+    """
+    with open(filename, 'r') as f:
+        return [l.rstrip('\n') for l in f]
+
+
+def get_store_dir(seed):
+    """
+    Get the directory holding the store of a seed.
+
+    :param seed: The seed query
+    :return: The directory of the store
+    """
+    return os.path.join(QE_STORE_DIR, seed.replace(' ', '_'))
+
+
+def get_expansion_sets(queries, keycnt):
+    """
+    Get the expansion sets of a list of queries through the search result page cache.
+
+    :param queries: The queries
+    :param keycnt: The maximum number of Google keyword requests per hour
+    :return: Ordered dictionary mapping each query to its expansion set, queries whose page could not be retrieved are
+             left out
+    """
+    expansion_sets = OrderedDict()
+    for q in queries:
+        if q in expansion_sets:
+            continue
+        try:
+            page = gr.get_query_html(q, keycnt)
+            expansion_sets[q] = gr.ExpansionSet(gr.extract_serp(page).summary_set)
+        except Exception as e:
+            print 'Error retrieving google search results: ' + repr(e)
+            print 'Query: ' + q
+    return expansion_sets
+
+
+def build_seed_store(seed, query_files, keycnt):
+    """
+    Build the store of a seed from the seed and the queries in the given files.
+
+    :param seed: The seed query
+    :param query_files: Files holding the queries in their first column, the approved and rejected queries of the seed
+                        are used if None
+    :param keycnt: The maximum number of Google keyword requests per hour
+    :return: None
+    """
+    if query_files is None:
+        name_suffix = './googledata/' + seed.replace(' ', '_') + '_'
+        query_files = [name_suffix + 'approved.csv', name_suffix + 'rejected.csv']
+
+    queries = [seed]
+    for fname in query_files:
+        if not os.path.isfile(fname):
+            continue
+        with open(fname, 'rU') as f:
+            reader = csv.reader(f)
+            for row in reader:
+                if row and row[0].strip():
+                    queries.append(row[0].strip())
+
+    store = QEVectorStore.build(get_expansion_sets(queries, keycnt))
+    store.save(get_store_dir(seed))
+    print seed, len(store), len(store.vocabulary)
+
+
+def main():
+    ap = ArgumentParser(description='Build the query expansion vector store for a seed.')
+    ap.add_argument('-s', '-seed', help='Seed word', required=True)
+    ap.add_argument('-f', '-file', help='file containing queries to add to the store at column 0, can be repeated',
+                    action='append')
+    ap.add_argument('-k', '-keywordlimit', help='limit to number of keyword request per hour', default=30)
+    ap.add_argument('-d', '-cachedir', help='Directory of the search result page cache', default=DEFAULT_CACHE_DIR)
+    ap.add_argument('-o', '-offline', help='Only use search result pages from the cache, never query Google',
+                    action='store_true')
+
+    args = ap.parse_args()
+
+    gr.set_serp_cache(SerpCache(args.d, offline=bool(args.o)))
+    token_file = os.path.join(args.d, TOKEN_CACHE_FILE)
+    gr.get_token_cache().load(token_file)
+    build_seed_store(args.s, args.f, int(args.k))
+    gr.get_token_cache().save(token_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python2.7
+#
+# This script computes the clarity score of a search query, the relative entropy between the language model of the
+# documents containing the query terms and the language model of the whole collection of documents returned for the
+# query, following:
+#
+#       Cronen-Townsend, Steve, and W. Bruce Croft. "Quantifying query ambiguity."
+#       Proceedings of the second international conference on Human Language Technology Research.
+#       Morgan Kaufmann Publishers Inc., 2002.
+#
+# It computes the same scores as deprecated/query_clarity_score.py (see there for how the score is used in this
+# project), which goes through every word of the vocabulary, and for each word through every document and query term
+# with frequency distributions. Here every document is tokenized once into a documents x vocabulary count matrix, and
+# with P(w|D) = l*c(w,D)/|D| + (1-l)*P(w|C) the probability of every word given the query is one product with that
+# matrix:
+#
+#       P(w|Q) = \Sum_{D \in R} P(w|D)P(Q|D) = l * \Sum_{D \in R} (P(Q|D)/|D|) c(w,D) + (1-l) * P(w|C) \Sum_{D \in R} P(Q|D)
+#
+# where R is the set of documents containing at least one query term and P(Q|D) the product of the smoothed
+# probabilities of the query terms. The entropy and cross entropy are then sums over the vocabulary.
+#
+# You will need to provide the following arguments to the argument parser for this script:
+#
+# * the query, or a file of queries (e.g. seed_queries.txt) to score in one run. The documents of all the queries are
+#   then fetched and tokenized once, and the queries scored in parallel by a pool of worker processes.
+# * optionally, the number of search results to use as documents
+# * whether to use the summary set of the results (expanded docs) rather than the visible text of the result pages,
+#   which are fetched concurrently (see doc_fetcher.py)
+#
+
+# standard library imports
+from __future__ import division
+from argparse import ArgumentParser
+from collections import OrderedDict
+from itertools import chain
+from multiprocessing import Pool
+import os
+
+# third party imports
+from nltk.corpus import stopwords
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# local imports
+from doc_fetcher import DocumentCache, DocumentFetcher
+from google_query_similarity import extract_serp, get_query_html, get_serp_cache, get_token_cache, regex_tokenize
+from token_cache import TOKEN_CACHE_FILE
+
+
+SMOOTHING = 0.6
+
+_stop_words = None
+
+
+def clean_tokenize(text):
+    """
+    Tokenize a text and remove the stop words from its tokens, as in deprecated/query_clarity_score.py.
+
+    :param text: The text to cleanly tokenize
+    :return: The list of tokens
+    """
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = set(stopwords.words('english'))
+    return [t for t in regex_tokenize(text) if t not in _stop_words]
+
+
+class DocumentCounts(object):
+    def __init__(self, docs):
+        """
+        Tokenize a collection of documents into a documents x vocabulary count matrix.
+
+        :param docs: The list of documents
+        """
+        self.vocab = dict()
+        indices = list()
+        indptr = [0]
+        for doc in docs:
+            for token in clean_tokenize(doc):
+                indices.append(self.vocab.setdefault(token, len(self.vocab)))
+            indptr.append(len(indices))
+
+        data = np.ones(len(indices), dtype=np.float64)
+        self.counts = csr_matrix((data, indices, indptr), shape=(len(docs), len(self.vocab)))
+        self.counts.sum_duplicates()
+
+        self.doc_lengths = np.asarray(self.counts.sum(axis=1)).ravel()
+        coll_counts = np.asarray(self.counts.sum(axis=0)).ravel()
+        self.prob_coll = coll_counts / max(coll_counts.sum(), 1)
+
+    def query_likelihood(self, query, l=SMOOTHING):
+        """
+        Determine the probability of every word of the vocabulary given a query, P(w|Q).
+
+        :param query: The query
+        :param l: The value of lambda of the linear smoothing
+        :return: The array of probabilities, in vocabulary order
+        """
+        query_tokens = clean_tokenize(query)
+        columns = [self.vocab[q] for q in set(query_tokens) if q in self.vocab]
+
+        # Documents with at least one query term.
+        if columns:
+            docs_r = np.flatnonzero(np.asarray(self.counts[:, columns].sum(axis=1)).ravel() > 0)
+        else:
+            docs_r = np.zeros(0, dtype=int)
+        counts = self.counts[docs_r]
+        lengths = self.doc_lengths[docs_r]
+
+        # Relative frequencies within each document, 0 for empty documents as FreqDist.freq.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_lengths = np.where(lengths > 0, 1 / lengths, 0.0)
+
+        # P(Q|D) for every document, the query terms counted with repetition.
+        prob_query_doc = np.ones(len(docs_r))
+        for q in query_tokens:
+            if q in self.vocab:
+                c = self.vocab[q]
+                freq = counts[:, c].toarray().ravel() * inv_lengths
+                prob_query_doc *= l * freq + (1 - l) * self.prob_coll[c]
+            else:
+                prob_query_doc *= 0.0
+
+        weights = prob_query_doc * inv_lengths
+        return l * counts.T.dot(weights) + (1 - l) * self.prob_coll * prob_query_doc.sum()
+
+
+def get_clarity_score(query, docs, debug=False):
+    """
+    Calculate the entropy of a query and its cross entropy with the collection of documents returned for it.
+
+    :param query: The query to calculate the clarity score of
+    :param docs: The collection of documents to base the clarity score off of
+    :param debug: True iff you want to print debug information to stdout
+    :return: The entropy and cross entropy, the clarity score being their difference
+    """
+    dc = DocumentCounts(docs)
+    prob_w_query = dc.query_likelihood(query)
+    if debug:
+        print "Vocab size: " + str(len(dc.vocab))
+
+    # Words with no probability given the query contribute nothing.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e = np.where(prob_w_query > 0, -(prob_w_query * np.log2(prob_w_query)), 0.0)
+        ce = np.where(prob_w_query > 0, -(prob_w_query * np.log2(dc.prob_coll)), 0.0)
+    return e.sum(), ce.sum()
+
+
+def process_clarity_score(query, count, debug=False, use_expanded_docs=True, fetcher=None):
+    """
+    Determine the clarity score of a query over its search results.
+
+    :param query: Query to calculate the clarity score for
+    :param count: Number of search results to use as documents
+    :param debug: True iff you want to print debug information to stdout
+    :param use_expanded_docs: Use the summary set of the results as documents, or else the visible text of the result
+                              pages
+    :param fetcher: The DocumentFetcher of the result pages, one without cache is used if None
+    :return: The entropy and cross entropy
+    """
+    serp = extract_serp(get_query_html(query, num_results=count))
+    if use_expanded_docs:
+        docs = serp.summary_set
+    else:
+        if fetcher is None:
+            fetcher = DocumentFetcher()
+        docs = fetcher.get_documents(serp.urls, debug)
+    return get_clarity_score(query, docs, debug)
+
+
+# Documents of the seeds scored by run_seed_list, shared with its worker
+# processes, which inherit them when forked along with the tokens of
+# every document in the token cache.
+_seed_docs = None
+
+
+def get_seed_documents(seed_list, count, use_expanded_docs=True, fetcher=None, debug=False):
+    """
+    Get the documents of every seed of a list, fetching the result pages shared by several seeds only once.
+
+    :param seed_list: The list of seeds
+    :param count: Number of search results to use as documents
+    :param use_expanded_docs: Use the summary set of the results as documents, or else the visible text of the result
+                              pages
+    :param fetcher: The DocumentFetcher of the result pages, one without cache is used if None
+    :param debug: True iff you want to print debug information to stdout
+    :return: An OrderedDict of the list of documents of every seed
+    """
+    serps = OrderedDict((seed, extract_serp(get_query_html(seed, num_results=count))) for seed in seed_list)
+    if use_expanded_docs:
+        return OrderedDict((seed, serp.summary_set) for (seed, serp) in serps.iteritems())
+
+    if fetcher is None:
+        fetcher = DocumentFetcher()
+    urls = list(OrderedDict.fromkeys(chain.from_iterable(serp.urls for serp in serps.itervalues())))
+    texts = dict(zip(urls, fetcher.get_texts(urls, debug)))
+    return OrderedDict((seed, [texts[u] for u in serp.urls if texts[u] is not None])
+                       for (seed, serp) in serps.iteritems())
+
+
+def seed_clarity_worker(seed):
+    e, ce = get_clarity_score(seed, _seed_docs[seed])
+    return seed, e, ce
+
+
+def run_seed_list(seed_file, count, use_expanded_docs=True, fetcher=None, processes=None, debug=False):
+    """
+    Determine the clarity score of every seed of a file, scoring the seeds in parallel.
+
+    :param seed_file: The file containing the seeds, one per line
+    :param count: Number of search results to use as documents
+    :param use_expanded_docs: Use the summary set of the results as documents, or else the visible text of the result
+                              pages
+    :param fetcher: The DocumentFetcher of the result pages, one without cache is used if None
+    :param processes: The number of worker processes, the number of cpus if None
+    :param debug: True iff you want to print debug information to stdout
+    :return: The list of the seed, entropy and cross entropy of every seed, in file order
+    """
+    global _seed_docs
+
+    with open(seed_file, 'r') as f:
+        seed_list = list(OrderedDict.fromkeys(filter(None, map(str.strip, f.readlines()))))
+
+    _seed_docs = get_seed_documents(seed_list, count, use_expanded_docs, fetcher, debug)
+
+    # Tokenize every document once, before the workers are forked, as the
+    # same documents come up for many seeds. The tokens are kept with the
+    # search result page cache for the next run.
+    token_file = os.path.join(get_serp_cache().directory, TOKEN_CACHE_FILE)
+    get_token_cache().load(token_file)
+    for doc in set(chain.from_iterable(_seed_docs.itervalues())):
+        clean_tokenize(doc)
+    if os.path.isdir(get_serp_cache().directory):
+        get_token_cache().save(token_file)
+    if debug:
+        print "No. of documents " + str(len(get_token_cache()))
+
+    pool = Pool(processes)
+    try:
+        return pool.map(seed_clarity_worker, seed_list, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+def main():
+    ap = ArgumentParser(description='Compute the clarity score of a given short text and the no. of documents.')
+    ap.add_argument('-q', '-query', help='Query text')
+    ap.add_argument('-f', '-file', help='File containing the queries to score, one per line, instead of a single query')
+    ap.add_argument('-c', '-doc', help='No. of fetched documents to use', default=100, type=int)
+    ap.add_argument('-x', '-exp', help='Use expanded docs', action='store_true')
+    ap.add_argument('-w', '-workers', help='Maximum number of result pages fetched at the same time', default=16,
+                    type=int)
+    ap.add_argument('-o', '-timeout', help='Number of seconds to wait on a result page', default=10, type=int)
+    ap.add_argument('-p', '-procs', help='Number of worker processes scoring the queries of a file', type=int)
+    ap.add_argument('-d', '-debug', help='Print traces', action='store_true')
+
+    args = ap.parse_args()
+    if not args.q and not args.f:
+        ap.error('Please provide a query (-q) or a file of queries (-f)')
+
+    # Start the extraction processes before any fetching thread.
+    pool = None
+    fetcher = None
+    if not args.x:
+        pool = Pool()
+        fetcher = DocumentFetcher(workers=args.w, timeout=args.o, cache=DocumentCache(), extract_pool=pool)
+    try:
+        if args.f:
+            scores = run_seed_list(args.f, args.c, args.x, fetcher, args.p, args.d)
+        else:
+            scores = [(args.q, ) + process_clarity_score(args.q, args.c, args.d, args.x, fetcher)]
+    finally:
+        if pool is not None:
+            pool.terminate()
+    for (q, e, ce) in scores:
+        print "{},{},{},{}".format(q, str(e), str(ce), str(ce - e))
+
+
+if __name__ == '__main__':
+    main()
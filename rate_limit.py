@@ -0,0 +1,136 @@
+#
+# This file contains the rate limiting used when several threads issue Google requests concurrently.
+#
+# get_query_html limits the rate of a single caller by sleeping after each request. When requests are issued from
+# several threads, the budget of requests per hour has to be shared between them instead, so each thread waits on a
+# common limiter before going to the network. The RateLimiter spaces the requests of one crawl evenly, while the
+# TokenBucket is shared by the crawls of several seeds run in the same process.
+#
+
+# standard library imports
+from collections import deque, OrderedDict
+from random import uniform
+import threading
+import time
+
+
+class RateLimiter(object):
+    def __init__(self, limit, jitter=5):
+        """
+        Create a rate limiter spacing requests evenly so that at most limit requests are issued per hour.
+
+        :param limit: The maximum number of requests per hour
+        :param jitter: Maximum number of seconds randomly added to each interval, as done by get_query_html. It is
+                       capped to the interval itself.
+        """
+        self.interval = 3600 / float(limit)
+        self.jitter = min(jitter, self.interval)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until the next request slot, reserving it for the calling thread.
+
+        :return: None
+        """
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self.interval + uniform(0, self.jitter)
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TokenBucket(object):
+    def __init__(self, limit, burst=1):
+        """
+        Create a token bucket handing out limit tokens per hour, shared by the crawls of several seeds.
+
+        Tokens accumulate while no crawl is asking for them, up to burst tokens, so that time left unused by a seed
+        (e.g. a seed finishing early or failing) can be spent by the others later on. When several seeds are waiting,
+        tokens are granted to them in turn, so that a seed with many requests in flight does not starve the others.
+
+        :param limit: The number of tokens per hour
+        :param burst: The maximum number of tokens that can accumulate
+        """
+        self.rate = limit / 3600.0
+        self.capacity = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._cond = threading.Condition()
+
+        # Queue of waiting requests of each seed, the seeds
+        # being kept in the order in which they get served.
+        self._waiting = OrderedDict()
+
+    def _refill(self):
+        """
+        Add the tokens accumulated since the last refill. Must be called with the lock held.
+
+        :return: None
+        """
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, key=None):
+        """
+        Wait for a token, taking turns with the other seeds waiting.
+
+        :param key: The seed the token is requested for
+        :return: None
+        """
+        ticket = object()
+        with self._cond:
+            self._waiting.setdefault(key, deque()).append(ticket)
+            while True:
+                self._refill()
+                turn = next(iter(self._waiting))
+                if turn == key and self._waiting[key][0] is ticket and self._tokens >= 1:
+                    break
+
+                # Sleep until the next token, or until the token is
+                # taken by another seed and it is our turn to wait.
+                timeout = None
+                if self._tokens < 1:
+                    timeout = (1 - self._tokens) / self.rate
+                self._cond.wait(timeout)
+
+            self._tokens -= 1
+
+            # Move the seed to the back of the line if it has more requests waiting.
+            queue = self._waiting.pop(key)
+            queue.popleft()
+            if queue:
+                self._waiting[key] = queue
+            self._cond.notify_all()
+
+    def limiter(self, key):
+        """
+        Get a limiter drawing tokens from this bucket on behalf of a seed, to be passed to get_query_html.
+
+        :param key: The seed the tokens are requested for
+        :return: The limiter
+        """
+        return SeedLimiter(self, key)
+
+
+class SeedLimiter(object):
+    def __init__(self, bucket, key):
+        """
+        Create a limiter drawing tokens from a shared token bucket on behalf of a seed.
+
+        :param bucket: The shared token bucket
+        :param key: The seed the tokens are requested for
+        """
+        self.bucket = bucket
+        self.key = key
+
+    def acquire(self):
+        """
+        Wait for a token of the shared bucket.
+
+        :return: None
+        """
+        self.bucket.acquire(self.key)
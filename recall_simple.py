@@ -4,9 +4,22 @@
 # This script can be used to determine simple recall statistics for the query data set. It does a simple lookup to
 # determine what percent of the recall queries was captured by the automated query generation process.
 #
+# The queries of each list are kept in sets, as they are and by their sorted tokens for the comparison without concern
+# for word order, so that every lookup takes constant time. The seeds are compared in parallel, and the statistics of
+# every seed can be written to a CSV report besides the tables printed.
+#
+# The fuzzy mode also counts a query as captured when it differs from one of the other list by a typo or an extra word.
+# Queries are compared by the Jaccard similarity of their sets of character trigrams, and every query is only compared
+# with the queries of the other list found in a trigram inverted index that could reach the lowest threshold: those
+# sharing one of its rarest trigrams (prefix filtering) and with a similar number of trigrams (length filtering). The
+# recall and precision of every seed are reported for a range of similarity thresholds.
 #
 
 from argparse import ArgumentParser
+from collections import OrderedDict
+import csv
+import math
+from multiprocessing import Pool
 from nltk import RegexpTokenizer
 import os
 import re
@@ -16,6 +29,117 @@ QUERY_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(
 RECALL_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                                 'surveyQueries/grouped_by_seed'))
 
+REPORT_FIELDS = ['seed', 'generated', 'amt', 'recall', 'unordered recall', 'precision', 'unordered precision',
+                 'recall matches', 'unordered recall matches', 'precision matches', 'unordered precision matches']
+
+FUZZY_REPORT_FIELDS = ['seed', 'threshold', 'recall', 'precision', 'recall matches', 'precision matches']
+FUZZY_THRESHOLDS = [x / 20.0 for x in range(10, 21)]
+
+_tokenizer = RegexpTokenizer(r'[a-zA-Z\']+')
+
+
+def canonical_key(query):
+    """
+    Get the key of a query without concern for word order, capitalization, or punctuation: its sorted tokens.
+
+    :param query: the query
+    :return: tuple of the sorted tokens of the query
+    """
+    return tuple(sorted(_tokenizer.tokenize(query.lower())))
+
+
+class QueryIndex(object):
+    def __init__(self, query_list):
+        """
+        Index a list of queries, both as they are and by their canonical keys, for constant time lookups.
+
+        :param query_list: list containing the queries to index
+        """
+        self.queries = set(query_list)
+        self.keys = set(canonical_key(q) for q in query_list)
+
+    def count(self, query_list):
+        """
+        Count the queries of a list found in the index as they are.
+
+        :param query_list: list containing the queries to look up
+        :return: number of queries found
+        """
+        return sum(1 for q in query_list if q in self.queries)
+
+    def count_unordered(self, keys):
+        """
+        Count the canonical keys of the queries of a list found in the index.
+
+        :param keys: list containing the canonical keys of the queries to look up, see canonical_key
+        :return: number of queries found
+        """
+        return sum(1 for k in keys if k in self.keys)
+
+
+def get_trigrams(query):
+    """
+    Get the character trigrams of a query, capitalization and punctuation aside, with a space around every word.
+
+    :param query: the query
+    :return: frozenset of the trigrams of the query
+    """
+    text = ' {} '.format(' '.join(_tokenizer.tokenize(query.lower())))
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex(object):
+    def __init__(self, query_list):
+        """
+        Index a list of queries by their character trigrams.
+
+        :param query_list: list containing the queries to index
+        """
+        self.trigrams = [get_trigrams(q) for q in query_list]
+        self.postings = dict()
+        for (i, grams) in enumerate(self.trigrams):
+            for g in grams:
+                self.postings.setdefault(g, list()).append(i)
+
+    def best_match(self, grams, min_similarity):
+        """
+        Find the highest Jaccard similarity between the trigrams of a query and those of an indexed query.
+
+        :param grams: the trigrams of the query, see get_trigrams
+        :param min_similarity: the lowest similarity of interest, queries less similar are pruned
+        :return: the highest similarity, 0 if none reaches min_similarity
+        """
+        n = len(grams)
+        if n == 0:
+            return 0.0
+
+        # A query at least min_similarity similar shares at least ceil(min_similarity * n) trigrams, so one of any
+        # n - ceil(min_similarity * n) + 1 of them: only the queries having one of the rarest are candidates.
+        rarest = sorted(grams, key=lambda g: len(self.postings.get(g, ())))
+        prefix = rarest[:n - int(math.ceil(min_similarity * n - 1e-9)) + 1]
+
+        best = 0.0
+        seen = set()
+        for g in prefix:
+            for i in self.postings.get(g, ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                other = self.trigrams[i]
+                m = len(other)
+                # The similarity is at most min(n, m) / max(n, m).
+                if min(n, m) < min_similarity * max(n, m):
+                    continue
+                shared = len(grams & other)
+                best = max(best, shared / float(n + m - shared))
+        return best if best >= min_similarity else 0.0
+
+
+def get_fraction(num, query_list):
+    if len(query_list) == 0:
+        return 0, 0
+    return float(num)/float(len(query_list)), num
+
 
 def get_recall(recall_list, query_list):
     """
@@ -25,14 +149,7 @@ def get_recall(recall_list, query_list):
     :param query_list: list containing all automatically generated queries
     :return: fraction of recall queries captured
     """
-    num = 0
-    for q in recall_list:
-        if q in query_list:
-            num += 1
-
-    if len(recall_list) == 0:
-        return 0, 0
-    return float(num)/float(len(recall_list)), num
+    return get_fraction(QueryIndex(query_list).count(recall_list), recall_list)
 
 
 def get_recall_unordered(recall_list, query_list):
@@ -44,68 +161,221 @@ def get_recall_unordered(recall_list, query_list):
     :param query_list: list containing all automatically generated queries
     :return: fraction of recall queries captured
     """
-    tokenizer = RegexpTokenizer(r'[a-zA-Z\']+')
-    query_token = []
-    for q in query_list:
-        l = tokenizer.tokenize(q.lower())
-        sorted(l, key=str.lower)
-        query_token.append(l)
-
-    num = 0
-    for q in recall_list:
-        l = tokenizer.tokenize(q.lower())
-        sorted(l, key=str.lower)
-        if l in query_token:
-            num += 1
-
-    if len(recall_list) == 0:
-        return 0, 0
-    return float(num)/float(len(recall_list)), num
+    keys = [canonical_key(q) for q in recall_list]
+    return get_fraction(QueryIndex(query_list).count_unordered(keys), recall_list)
+
+
+def get_recall_stats(recall_list, query_list):
+    """
+    Determine the recall and precision of the query list, with ordered and unordered comparisons, indexing and
+    tokenizing each list only once.
+
+    :param recall_list: list containing all queries from a recall data set
+    :param query_list: list containing all automatically generated queries
+    :return: dictionary with the sizes of the lists and the fractions and numbers of queries captured, see REPORT_FIELDS
+    """
+    recall_index = QueryIndex(recall_list)
+    query_index = QueryIndex(query_list)
+    recall_keys = [canonical_key(q) for q in recall_list]
+    query_keys = [canonical_key(q) for q in query_list]
+
+    frac1, num1 = get_fraction(query_index.count(recall_list), recall_list)
+    frac2, num2 = get_fraction(query_index.count_unordered(recall_keys), recall_list)
+    frac3, num3 = get_fraction(recall_index.count(query_list), query_list)
+    frac4, num4 = get_fraction(recall_index.count_unordered(query_keys), query_list)
+    return OrderedDict([('generated', len(query_list)), ('amt', len(recall_list)),
+                        ('recall', frac1), ('unordered recall', frac2),
+                        ('precision', frac3), ('unordered precision', frac4),
+                        ('recall matches', num1), ('unordered recall matches', num2),
+                        ('precision matches', num3), ('unordered precision matches', num4)])
+
+
+def get_fuzzy_recall_curves(recall_list, query_list, thresholds=FUZZY_THRESHOLDS):
+    """
+    Determine the recall and precision of the query list for a range of similarity thresholds, a query being captured
+    by the other list at a threshold when its most similar query there is at least that similar.
+
+    :param recall_list: list containing all queries from a recall data set
+    :param query_list: list containing all automatically generated queries
+    :param thresholds: list of the similarity thresholds, between 0 and 1
+    :return: list of dictionaries with the threshold and the fractions and numbers of queries captured at it
+    """
+    min_similarity = min(thresholds)
+    recall_index = TrigramIndex(recall_list)
+    query_index = TrigramIndex(query_list)
+    best_recall = [query_index.best_match(grams, min_similarity) for grams in recall_index.trigrams]
+    best_precision = [recall_index.best_match(grams, min_similarity) for grams in query_index.trigrams]
+
+    curves = list()
+    for t in sorted(thresholds):
+        frac1, num1 = get_fraction(sum(1 for b in best_recall if b >= t), recall_list)
+        frac2, num2 = get_fraction(sum(1 for b in best_precision if b >= t), query_list)
+        curves.append(OrderedDict([('threshold', t), ('recall', frac1), ('precision', frac2),
+                                   ('recall matches', num1), ('precision matches', num2)]))
+    return curves
+
 
-def run_recall(recall_dir, query_dir):
+def read_queries(recall_file, query_file):
     """
-    Run the recall calculation based on the recall directory and query directory
+    Read the recall queries and the automatically generated queries of a seed.
+
+    :param recall_file: file containing the recall queries, one per line
+    :param query_file: file containing the automatically generated queries at column 0
+    :return: the recall list and the query list
+    """
+    with open(recall_file, 'r') as f_recall, open(query_file, 'r') as f_query:
+        recall_list = [re.sub(r'[^\x00-\x7f]',r'', row).lower() for row in f_recall.read().splitlines()]
+        query_list = [re.sub(r'[^\x00-\x7f]',r'', row).encode('ascii', errors='ignore').split(',')[0].strip().lower() for row in f_query.read().splitlines()]
+    return recall_list, query_list
+
+
+def seed_recall_worker(args):
+    """
+    Read the recall and query files of a seed and determine its recall statistics.
+
+    :param args: tuple of the name of the files, the recall file and the query file
+    :return: dictionary with the seed and its recall statistics, see REPORT_FIELDS
+    """
+    candidate, recall_file, query_file = args
+    recall_list, query_list = read_queries(recall_file, query_file)
+
+    stats = OrderedDict([('seed', candidate.split('.')[0])])
+    stats.update(get_recall_stats(recall_list, query_list))
+    return stats
+
+
+def seed_fuzzy_worker(args):
+    """
+    Read the recall and query files of a seed and determine its fuzzy recall and precision curves.
+
+    :param args: tuple of the name of the files, the recall file, the query file and the list of thresholds
+    :return: list of dictionaries with the seed, the threshold and the recall statistics at it, see FUZZY_REPORT_FIELDS
+    """
+    candidate, recall_file, query_file, thresholds = args
+    recall_list, query_list = read_queries(recall_file, query_file)
+
+    curves = get_fuzzy_recall_curves(recall_list, query_list, thresholds)
+    for row in curves:
+        row['seed'] = candidate.split('.')[0]
+    return curves
+
+
+def print_recall_stats(stats):
+    """
+    Print the recall statistics of a seed as a table.
+
+    :param stats: dictionary with the seed and its recall statistics, see REPORT_FIELDS
+    :return: None
+    """
+    print '\n{}'.format(stats['seed'])
+    print '\tmetric\t\tordered comparison\t\tunordered comparison'
+    print '\t------\t\t------------------\t\t--------------------'
+    print '\trecall\t\t{:.3f}\t\t{:.3f}'.format(stats['recall'], stats['unordered recall'])
+    print '\tprecision\t\t{:.3f}\t\t{:.3f}'.format(stats['precision'], stats['unordered precision'])
+
+    print '\n\tnumber of queries in generated set:\t{}\n\tnumber of queries in AMT set:\t{}'.format(stats['generated'], stats['amt'])
+    print '\tnumber matching in ordered recall:\t{}\n\tnumber matching in unordered recall:\t{}'.format(stats['recall matches'], stats['unordered recall matches'])
+    print '\tnumber matching in ordered precision:\t{}\n\tnumber matching in unordered precision:\t{}'.format(stats['precision matches'], stats['unordered precision matches'])
+
+
+def print_fuzzy_curves(curves):
+    """
+    Print the fuzzy recall and precision curves of a seed as a table.
+
+    :param curves: list of dictionaries with the seed, the threshold and the recall statistics at it
+    :return: None
+    """
+    print '\n{}'.format(curves[0]['seed'] if curves else '')
+    print '\tthreshold\trecall\tprecision\trecall matches\tprecision matches'
+    print '\t---------\t------\t---------\t--------------\t-----------------'
+    for row in curves:
+        print '\t{:.2f}\t\t{:.3f}\t{:.3f}\t\t{}\t\t{}'.format(row['threshold'], row['recall'], row['precision'],
+                                                          row['recall matches'], row['precision matches'])
+
+
+def save_report(results, report_file, fields=REPORT_FIELDS):
+    """
+    Save the recall statistics of every seed to a csv file.
+
+    :param results: list of dictionaries with the seed and its recall statistics
+    :param report_file: the csv file to write
+    :param fields: the columns of the report, see REPORT_FIELDS and FUZZY_REPORT_FIELDS
+    :return: None
+    """
+    with open(report_file, 'w') as f:
+        csv_writer = csv.DictWriter(f, fields, lineterminator='\n')
+        csv_writer.writeheader()
+        csv_writer.writerows(results)
+
+
+def get_recall_tasks(recall_dir, query_dir):
+    """
+    Find the seeds having both a recall file and a query file.
 
     :param recall_dir: directory containing all recall queries
     :param query_dir: directory containing all automatically generated queries
-    :return: None, prints statistics to stdout
+    :return: list of tuples of the name of the files, the recall file and the query file
     """
-    #total=0
+    tasks = list()
     for candidate in os.listdir(recall_dir):
         recall_file = os.path.join(recall_dir, candidate)
         if os.path.isfile(recall_file):
             query_file = os.path.join(query_dir, candidate)
             if os.path.exists(query_file):
                 # we have a file that exists in both, let us determine the recall score
-                with open(recall_file, 'r') as f_recall, open(query_file, 'r') as f_query:
-                    #recall_reader = csv.reader(f_recall.read().splitlines())
-                    #query_reader = csv.reader(f_query.read().splitlines())
-                    #recall_list = [re.sub(r'[^\x00-\x7f]',r'', row).lower() for row in recall_reader]
-                    #query_list = [re.sub(r'[^\x00-\x7f]',r'', row[0]).encode('ascii', errors='ignore').lower() for row in query_reader]
-
-                    recall_list = [re.sub(r'[^\x00-\x7f]',r'', row).lower() for row in f_recall.read().splitlines()]
-                    query_list = [re.sub(r'[^\x00-\x7f]',r'', row).encode('ascii', errors='ignore').split(',')[0].strip().lower() for row in f_query.read().splitlines()]
-                    frac1, num1 = get_recall(recall_list, query_list)
-                    frac2, num2 = get_recall_unordered(recall_list, query_list)
-                    frac3, num3 = get_recall(query_list, recall_list)
-                    frac4, num4 = get_recall_unordered(query_list, recall_list)
-                    print '\n{}'.format(candidate.split('.')[0])
-                    print '\tmetric\t\tordered comparison\t\tunordered comparison'
-                    print '\t------\t\t------------------\t\t--------------------'
-                    print '\trecall\t\t{:.3f}\t\t{:.3f}'.format(frac1, frac2)
-                    print '\tprecision\t\t{:.3f}\t\t{:.3f}'.format(frac3, frac4)
-
-                    print '\n\tnumber of queries in generated set:\t{}\n\tnumber of queries in AMT set:\t{}'.format(len(query_list), len(recall_list))
-                    print '\tnumber matching in ordered recall:\t{}\n\tnumber matching in unordered recall:\t{}'.format(num1, num2)
-                    print '\tnumber matching in ordered precision:\t{}\n\tnumber matching in unordered precision:\t{}'.format(num3, num4)
-                    #total += len(recall_list) - num2
-
-                    # print '{}\n\trecall:\t{:.3f}\t{:.3f}'.format(os.path.splitext(candidate)[0],
-                    #                            get_recall(recall_list, query_list),
-                    #                            get_recall_unordered(recall_list, query_list)),
-                    # print '\tprecision:\t{:.3f}\t{:.3f}'.format(get_recall(query_list, recall_list),
-                    #                            get_recall_unordered(query_list, recall_list))
-    #print total
+                tasks.append((candidate, recall_file, query_file))
+    return tasks
+
+
+def run_recall(recall_dir, query_dir, report_file=None, processes=None):
+    """
+    Run the recall calculation based on the recall directory and query directory, for all seeds in parallel
+
+    :param recall_dir: directory containing all recall queries
+    :param query_dir: directory containing all automatically generated queries
+    :param report_file: csv file to write the statistics of every seed to, if given
+    :param processes: number of worker processes, the number of cpus if None
+    :return: list of dictionaries with the seed and its recall statistics, also printed to stdout
+    """
+    tasks = get_recall_tasks(recall_dir, query_dir)
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(seed_recall_worker, tasks)
+    finally:
+        pool.terminate()
+
+    for stats in results:
+        print_recall_stats(stats)
+    if report_file is not None:
+        save_report(results, report_file)
+    return results
+
+
+def run_fuzzy_recall(recall_dir, query_dir, report_file=None, processes=None, thresholds=FUZZY_THRESHOLDS):
+    """
+    Run the fuzzy recall calculation based on the recall directory and query directory, for all seeds in parallel
+
+    :param recall_dir: directory containing all recall queries
+    :param query_dir: directory containing all automatically generated queries
+    :param report_file: csv file to write the curves of every seed to, one row per seed and threshold, if given
+    :param processes: number of worker processes, the number of cpus if None
+    :param thresholds: list of the similarity thresholds, between 0 and 1
+    :return: list of the curves of every seed, also printed to stdout
+    """
+    tasks = [task + (thresholds, ) for task in get_recall_tasks(recall_dir, query_dir)]
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(seed_fuzzy_worker, tasks)
+    finally:
+        pool.terminate()
+
+    for curves in results:
+        print_fuzzy_curves(curves)
+    if report_file is not None:
+        save_report([row for curves in results for row in curves], report_file, FUZZY_REPORT_FIELDS)
+    return results
 
 
 def get_recall_arg_parse():
@@ -121,6 +391,19 @@ def get_recall_arg_parse():
     ap.add_argument('-recall',
                     help='Directory containing recall queries',
                     default=RECALL_DIRECTORY)
+    ap.add_argument('-report',
+                    help='CSV file to write the recall statistics of every seed to')
+    ap.add_argument('-procs',
+                    help='Number of worker processes, the number of cpus by default',
+                    type=int)
+    ap.add_argument('-fuzzy',
+                    help='Count the queries matching with a trigram similarity above thresholds',
+                    action='store_true')
+    ap.add_argument('-thresholds',
+                    help='Similarity thresholds of the fuzzy recall, between 0 and 1',
+                    nargs='+',
+                    type=float,
+                    default=FUZZY_THRESHOLDS)
 
     return ap
 
@@ -128,4 +411,7 @@ if __name__ == '__main__':
     parser = get_recall_arg_parse()
     args = parser.parse_args()
 
-    run_recall(args.recall, args.query)
+    if args.fuzzy:
+        run_fuzzy_recall(args.recall, args.query, args.report, args.procs, args.thresholds)
+    else:
+        run_recall(args.recall, args.query, args.report, args.procs)
@@ -9,7 +9,10 @@
 from argparse import ArgumentParser
 import os
 
-from recall_simple import get_recall, get_recall_unordered
+import numpy as np
+
+from recall_simple import get_recall_stats
+from trend_store import open_trends
 
 FILTERED_QUERY_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                                    'indextrends/index'))
@@ -17,12 +20,29 @@ FILTERED_RECALL_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.absp
                                                     'indextrends/amt'))
 
 
-def run_recall_with_trend(recall_dir, query_dir):
+def get_trend_queries(trends, seed):
+    """
+    Get the queries of a seed with non-zero trend data
+
+    :param trends: trend data of a collection mode, see trend_store.open_trends
+    :param seed: the seed, its directory being named after it with or without the comparison suffix
+    :return: list of queries
+    """
+    for seed_dir in (seed, seed + ' comp'):
+        labels, queries, values = trends.matrix(seed_dir)
+        if labels:
+            return [q.lower() for (q, v) in zip(queries, values) if np.nansum(v) > 0]
+    return list()
+
+
+def run_recall_with_trend(recall_dir, query_dir, trends=None):
     """
     Run the recall calculation based on the recall directory and query directory
 
     :param recall_dir: directory containing all recall queries
     :param query_dir: directory containing all automatically generated queries
+    :param trends: trend data to take the automatically generated queries with trend data from instead of the query
+                   directory, see trend_store.open_trends
     :return: None, prints statistics to stdout
     """
     total = 0
@@ -34,15 +54,19 @@ def run_recall_with_trend(recall_dir, query_dir):
                 if candidate != 'combined.xlsx':
                     recall_file = os.path.join(cat_recall, candidate)
                     query_file = os.path.join(cat_query, candidate)
-                    if os.path.exists(query_file):
+                    if (trends is not None and candidate.endswith('.csv')) or os.path.exists(query_file):
                         # we have a directory that exists in both, let us determine the recall score
-                        with open(recall_file, 'r') as f_recall, open(query_file, 'r') as f_query:
+                        with open(recall_file, 'r') as f_recall:
                             recall_list = f_recall.readline().lower().split(',')[1:-1]
-                            query_list = f_query.readline().lower().split(',')[1:-1]
-                            frac1, num1 = get_recall(recall_list, query_list)
-                            frac2, num2 = get_recall_unordered(recall_list, query_list)
-                            frac3, num3 = get_recall(query_list, recall_list)
-                            frac4, num4 = get_recall_unordered(query_list, recall_list)
+                            if trends is not None:
+                                query_list = get_trend_queries(trends, candidate.split('.')[0])
+                            else:
+                                with open(query_file, 'r') as f_query:
+                                    query_list = f_query.readline().lower().split(',')[1:-1]
+                            stats = get_recall_stats(recall_list, query_list)
+                            frac1, num1 = stats['recall'], stats['recall matches']
+                            frac2, num2 = stats['unordered recall'], stats['unordered recall matches']
+                            frac3, frac4 = stats['precision'], stats['unordered precision']
 
 
                             print '{}\n{}\t{}\n\trecall:\t{:.3f}\t{:.3f}'.format(candidate.split('.')[0], len(recall_list), len(query_list),
@@ -69,6 +93,9 @@ def get_recall_trend_arg_parse():
     ap.add_argument('-recall',
                     help='Directory containing recall seed queries',
                     default=FILTERED_RECALL_DIR)
+    ap.add_argument('-trends',
+                    help='Trends directory or trend store to take the queries with trend data from instead of the '
+                         'query directory')
 
     return ap
 
@@ -76,4 +103,7 @@ if __name__ == '__main__':
     parser = get_recall_trend_arg_parse()
     args = parser.parse_args()
 
-    run_recall_with_trend(args.recall, args.query)
+    trends = None
+    if args.trends is not None:
+        trends = open_trends(args.trends)
+    run_recall_with_trend(args.recall, args.query, trends)
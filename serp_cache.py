@@ -0,0 +1,195 @@
+#
+# This file contains an on-disk cache for Google search result pages (SERPs).
+#
+# Every script in this repository issues its queries through google_query_similarity.get_query_html, which has to be
+# rate limited to avoid Google's anti-spam measures (we generally ran at 30-100 requests/hour). Rerunning a crawl, a
+# comparison or a pairwise computation for a seed would otherwise pay that rate limit again for pages that were
+# already downloaded. The cache stores each page gzip compressed under a content address computed from the request
+# parameters, so that only genuinely new queries go out to Google.
+#
+# Each entry is a single file named after the SHA-1 of (query, num_results, hl). The cache keeps the following
+# policies:
+#
+# * Time to live: the modification time of an entry is the time its page was fetched. Entries older than the TTL are
+#   treated as misses and refetched.
+# * Size bound: the access time of an entry is updated on every hit. The total size of the cache is kept up to date on
+#   every insert, and when it goes over the bound the least recently used entries are evicted first, down to
+#   EVICT_FRACTION of the bound so that the directory is only scanned once in a while.
+# * Offline mode: when set, a miss raises CacheMiss instead of going to the network, and entries never expire. This can
+#   be used to rerun an analysis strictly on the pages that were already collected, however old.
+#
+
+# standard library imports
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+
+DEFAULT_CACHE_DIR = './serpcache/'
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+EVICT_FRACTION = 0.9
+ENTRY_SUFFIX = '.html.gz'
+
+
+class CacheMiss(Exception):
+    """
+    Raised by an offline cache when the requested page has not been collected yet.
+    """
+    pass
+
+
+class SerpCache(object):
+    def __init__(self, directory=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        """
+        Create a search result page cache backed by a directory.
+
+        :param directory: The directory holding the cache entries, created if necessary
+        :param ttl: Number of seconds a page stays valid after it was fetched, None to never expire. Ignored offline.
+        :param max_bytes: Upper bound on the total compressed size of the cache, None for no bound
+        :param offline: If True, misses raise CacheMiss rather than being fetched
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        # Total size of the entries, counted on the first insert.
+        self._total = None
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def key(query, num_results, hl):
+        """
+        Compute the content address of a search request.
+
+        :param query: The query string
+        :param num_results: The number of results requested
+        :param hl: The interface language requested
+        :return: The hex digest identifying the request
+        """
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return hashlib.sha1('\x00'.join([query, str(num_results), hl])).hexdigest()
+
+    def path(self, key):
+        """
+        Get the file name of a cache entry.
+
+        :param key: The content address of the entry
+        :return: The path of the entry
+        """
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, query, num_results, hl):
+        """
+        Look up a page in the cache. Expired entries are removed and reported as a miss, unless the cache is offline.
+
+        :param query: The query string
+        :param num_results: The number of results requested
+        :param hl: The interface language requested
+        :return: The cached page, or None on a miss
+        """
+        name = self.path(self.key(query, num_results, hl))
+        if not os.path.isfile(name):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Offline, the pages cannot be fetched again, so they never expire.
+        fetched = os.path.getmtime(name)
+        now = time.time()
+        if not self.offline and self.ttl is not None and now - fetched > self.ttl:
+            os.remove(name)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with gzip.open(name, 'rb') as f:
+            page = f.read()
+
+        # Mark the entry as recently used, keeping the fetch time intact.
+        os.utime(name, (now, fetched))
+        with self._lock:
+            self.hits += 1
+        return page
+
+    def put(self, query, num_results, hl, page):
+        """
+        Store a freshly fetched page in the cache and evict old entries if the cache went over its size bound.
+
+        :param query: The query string
+        :param num_results: The number of results requested
+        :param hl: The interface language requested
+        :param page: The page to store
+        :return: None
+        """
+        name = self.path(self.key(query, num_results, hl))
+
+        # Write to a temporary file first so that an interrupted
+        # write never leaves a truncated entry behind.
+        tmp_name = name + '.tmp'
+        with gzip.open(tmp_name, 'wb') as f:
+            f.write(page)
+        replaced = os.path.getsize(name) if os.path.isfile(name) else 0
+        added = os.path.getsize(tmp_name)
+        os.rename(tmp_name, name)
+
+        if self.max_bytes is not None:
+            # Only one thread at a time should scan and prune the directory.
+            with self._lock:
+                if self._total is None:
+                    self._total = self.evict(None)
+                else:
+                    self._total += added - replaced
+                if self._total > self.max_bytes:
+                    self._total = self.evict(int(self.max_bytes * EVICT_FRACTION))
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used entries until the cache fits within the given size.
+
+        :param max_bytes: The size the cache should be brought under, None to only count its size
+        :return: The total size of the entries left
+        """
+        entries = list()
+        total = 0
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(ENTRY_SUFFIX):
+                continue
+            name = os.path.join(self.directory, fname)
+            st = os.stat(name)
+            entries.append((st.st_atime, st.st_size, name))
+            total += st.st_size
+
+        if max_bytes is None or total <= max_bytes:
+            return total
+
+        entries.sort()
+        for (atime, size, name) in entries:
+            if total <= max_bytes:
+                break
+            os.remove(name)
+            total -= size
+            self.evictions += 1
+        return total
+
+    def stats(self):
+        """
+        Get a printable summary of the cache counters.
+
+        :return: The summary string
+        """
+        lookups = self.hits + self.misses
+        rate = 0.0
+        if lookups > 0:
+            rate = (self.hits / float(lookups)) * 100
+        return 'SERP cache: {} hits, {} misses ({:.1f}% hit rate), {} evictions'.format(self.hits, self.misses, rate,
+                                                                                       self.evictions)
@@ -1,12 +1,8 @@
 #!/bin/bash
 # Usage ./dostats.sh ./gtrends/without_seed_cmp/ 2013-06-01 ./stats/
+# The seeds are processed in parallel by a single python process, see google_trends_analysis.run_seed_list.
 tdir=$1
 split=$2
 rdir=$3
 filename="seed_queries.txt"
-while read -r line
-do
-    seed=$line
-    echo "Current Seed: $seed"
-    python google_trends_analysis.py -s "$seed" -d $tdir -i $split -r $rdir
-done < "$filename"
+python google_trends_analysis.py -f $filename -d $tdir -i $split -r $rdir
@@ -0,0 +1,164 @@
+#
+# This file contains the running estimate of the crawl threshold (see google_related_queries.py).
+#
+# The threshold is Q25-1.5*IQR over the kernel values of the candidates of iteration 0, so it is only known once the
+# whole iteration has been fetched. To decide on candidates before that, the quantiles of the kernel values seen so far
+# are tracked with the P-square algorithm of Jain and Chlamtac, in its histogram form: a fixed number of markers are
+# kept at equally spaced quantiles and moved towards their ideal positions with a piecewise parabolic fit as the values
+# come in. Any quantile is then interpolated between the markers, in constant memory.
+#
+# The confidence bounds of the threshold come from the Dvoretzky-Kiefer-Wolfowitz inequality: with n values seen, the
+# empirical distribution is within eps = sqrt(ln(2/alpha)/(2n)) of the distribution of all the kernel values of the
+# iteration with probability 1-alpha, so each quantile Qp lies between the empirical Q(p-eps) and Q(p+eps). This
+# assumes the candidates come in a random order, which the related searches of a page only roughly follow.
+#
+
+# standard library imports
+from __future__ import division
+import bisect
+import math
+
+# third party imports
+import numpy as np
+
+
+class P2Histogram(object):
+    def __init__(self, cells=20):
+        """
+        Create an empty quantile estimator.
+
+        :param cells: The number of cells between the markers, the estimate is exact until cells+1 values have been seen
+        """
+        self.cells = cells
+        self.n = 0
+        self.heights = list()
+        self.positions = list()
+
+    def add(self, x):
+        """
+        Add a value to the estimator.
+
+        :param x: The value
+        :return: None
+        """
+        self.n += 1
+        b = self.cells
+        q = self.heights
+        pos = self.positions
+
+        # Keep the values themselves until there is one per marker.
+        if self.n <= b + 1:
+            bisect.insort(q, x)
+            pos.append(self.n)
+            return
+
+        # Find the cell of the value, extending the extreme markers if needed,
+        # and shift the markers above it.
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[b]:
+            q[b] = x
+            k = b - 1
+        else:
+            k = min(bisect.bisect_right(q, x) - 1, b - 1)
+        for i in range(k + 1, b + 1):
+            pos[i] += 1
+
+        # Move the inner markers that drifted from their ideal position.
+        for i in range(1, b):
+            d = 1 + (self.n - 1) * i / b - pos[i]
+            if (d >= 1 and pos[i + 1] - pos[i] > 1) or (d <= -1 and pos[i - 1] - pos[i] < -1):
+                d = 1 if d > 0 else -1
+                h = self._parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (pos[i + d] - pos[i])
+                q[i] = h
+                pos[i] += d
+
+    def _parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def quantile(self, p):
+        """
+        Estimate a quantile of the values added, interpolating linearly between the markers as np.percentile does
+        between the values.
+
+        :param p: The quantile, between 0 and 1
+        :return: The estimate, None if no value has been added
+        """
+        if self.n == 0:
+            return None
+        return float(np.interp(1 + p * (self.n - 1), self.positions, self.heights))
+
+
+class ThresholdEstimator(object):
+    def __init__(self, confidence=0.95, cells=20, min_samples=10):
+        """
+        Create a running estimate of the Q25-1.5*IQR threshold.
+
+        :param confidence: The probability that the threshold lies within the bounds
+        :param cells: The number of cells of the quantile estimator
+        :param min_samples: The number of values needed before taking any decision
+        """
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.histogram = P2Histogram(cells)
+
+    def add(self, kval):
+        """
+        Add the kernel value of a candidate.
+
+        :param kval: The kernel value
+        :return: None
+        """
+        self.histogram.add(kval)
+
+    def threshold(self):
+        """
+        Get the running estimate of the threshold.
+
+        :return: The estimate, None if no value has been added
+        """
+        if self.histogram.n == 0:
+            return None
+        q75, q25 = self.histogram.quantile(0.75), self.histogram.quantile(0.25)
+        return q25 - 1.5 * (q75 - q25)
+
+    def bounds(self):
+        """
+        Get the confidence bounds of the threshold.
+
+        :return: The bounds as a tuple (lower, upper), (None, None) if no value has been added
+        """
+        n = self.histogram.n
+        if n == 0:
+            return None, None
+        eps = math.sqrt(math.log(2 / (1 - self.confidence)) / (2 * n))
+
+        def q(p):
+            return self.histogram.quantile(min(max(p, 0.0), 1.0))
+
+        # The threshold is 2.5*Q25 - 1.5*Q75.
+        lower = 2.5 * q(0.25 - eps) - 1.5 * q(0.75 + eps)
+        upper = 2.5 * q(0.25 + eps) - 1.5 * q(0.75 - eps)
+        return lower, upper
+
+    def decide(self, kval):
+        """
+        Decide on a candidate if its kernel value is clear of the confidence bounds of the threshold.
+
+        :param kval: The kernel value of the candidate, already added
+        :return: True to approve the candidate, False to reject it, None if it cannot be decided yet
+        """
+        if self.histogram.n < self.min_samples:
+            return None
+        lower, upper = self.bounds()
+        if kval >= upper:
+            return True
+        if kval < lower:
+            return False
+        return None
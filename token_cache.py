@@ -0,0 +1,98 @@
+#
+# This file contains the caches used to avoid repeating the tokenization and stemming of the search result snippets.
+#
+# The same words (e.g. "privacy", "facebook") show up in almost every snippet of a crawl, and the same snippets show up
+# in the search results pages of many related queries. Stems are therefore kept by word in a bounded least recently
+# used cache, and the tokens of a snippet are kept by the hash of the snippet. The snippet cache can be saved to the
+# search result page cache directory, so that a rerun over cached pages does not need to tokenize them again.
+#
+
+# standard library imports
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+
+
+TOKEN_CACHE_FILE = 'tokens.pkl'
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        """
+        Create a least recently used cache.
+
+        :param size: The maximum number of entries kept
+        """
+        self.size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up an entry, marking it as the most recently used.
+
+        :param key: The key of the entry
+        :return: The value of the entry, or None if not cached
+        """
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Store an entry, evicting the least recently used one if the cache is full.
+
+        :param key: The key of the entry
+        :param value: The value of the entry, must not be None
+        :return: None
+        """
+        self._entries.pop(key, None)
+        if len(self._entries) >= self.size:
+            self._entries.popitem(last=False)
+        self._entries[key] = value
+
+
+class TokenCache(LRUCache):
+    """
+    A least recently used cache of the tokens of a text, keyed by the tokenizer used and the hash of the text.
+    """
+    @staticmethod
+    def key(tokenizer, text):
+        """
+        Compute the key of a text.
+
+        :param tokenizer: Name of the tokenizer, so that the tokens of different tokenizers are kept apart
+        :param text: The text tokenized
+        :return: The key of the text
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return tokenizer, hashlib.sha1(text).digest()
+
+    def save(self, filename):
+        """
+        Save the cached tokens to a file.
+
+        :param filename: The file to save to
+        :return: None
+        """
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            pickle.dump(self._entries.items(), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_name, filename)
+
+    def load(self, filename):
+        """
+        Add the tokens saved to a file to the cache, if the file exists.
+
+        :param filename: The file saved to
+        :return: None
+        """
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                for (k, v) in pickle.load(f):
+                    self.put(k, v)
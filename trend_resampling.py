@@ -0,0 +1,243 @@
+#!/usr/bin/env python2.7
+#
+# This script computes resampling based significance and confidence intervals for the shift of the trends of the
+# queries of a seed at an incident date, as a complement to the KS test of google_trends_analysis.py.
+#
+# The KS p-values assume the months of a trend are independent, which monthly search volumes are not: a high month is
+# usually followed by another. Both resampling methods here work on blocks of consecutive months instead, so that the
+# dependence within a block is kept:
+#
+# * Block permutation test: the blocks of the whole series are shuffled and the series is split again at the same
+#   month. The p-value of Cliff's Delta and of the median shift (median after the split minus median before it) is the
+#   fraction of shuffles giving a statistic at least as extreme as the observed one.
+# * Block bootstrap: the months before and after the split are each resampled with circular blocks, giving percentile
+#   confidence intervals for Cliff's Delta and the median shift.
+#
+# Every resample is drawn for all the queries of the seed at once, and the statistics are computed over the queries x
+# resamples rows in a single pass (see trend_tests.py). Resamples are drawn in chunks, each from its own random state
+# derived from the seed of the run, so that the results are the same whether the chunks are run in this process or in a
+# pool of worker processes.
+#
+# You will need to provide the following arguments to the argument parser for this script:
+#
+# * the seed (the directory of its trends data)
+# * the directory containing the trends data for seeds, or its trend store
+# * the incident date to split the trend data at
+# * the directory to put the results in
+# * optionally, the number of resamples, the block length, the random seed and the number of worker processes
+#
+
+# standard library imports
+from __future__ import division
+from argparse import ArgumentParser
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool
+import os
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+# local imports
+from trend_store import open_trends, seed_matrix
+from trend_tests import cliffs_delta
+
+CHUNK_SIZE = 100
+
+
+def shift_stats(values, split):
+    """
+    Compute Cliff's Delta and the median shift of every row split at a given month.
+
+    :param values: The rows x months matrix
+    :param split: The index of the first month after the split
+    :return: The arrays of deltas and of median shifts
+    """
+    pre, post = values[:, :split], values[:, split:]
+    d, _ = cliffs_delta(pre, post)
+    return d, np.median(post, axis=1) - np.median(pre, axis=1)
+
+
+def permutation_indices(rs, n, block, count):
+    """
+    Draw block permutations of a series: the blocks of consecutive months are put in a random order.
+
+    :param rs: The RandomState to draw from
+    :param n: The number of months of the series
+    :param block: The number of months of a block, the last block being shorter if it does not divide n
+    :param count: The number of permutations
+    :return: The count x n matrix of the month indices of every permutation
+    """
+    blocks = np.arange(n) // block
+    order = np.argsort(rs.rand(count, blocks[-1] + 1), axis=1)
+    rank = np.argsort(order, axis=1)
+
+    # Sort the months by the new position of their block, then by their position within it.
+    keys = rank[:, blocks] * block + np.arange(n) % block
+    return np.argsort(keys, axis=1)
+
+
+def bootstrap_indices(rs, start, n, block, count):
+    """
+    Draw circular block bootstrap samples of a segment of a series.
+
+    :param rs: The RandomState to draw from
+    :param start: The index of the first month of the segment
+    :param n: The number of months of the segment
+    :param block: The number of months of a block
+    :param count: The number of samples
+    :return: The count x n matrix of the month indices of every sample
+    """
+    nblocks = -(-n // block)
+    starts = rs.randint(0, n, size=(count, nblocks))
+    indices = (starts[:, :, np.newaxis] + np.arange(block)) % n
+    return start + indices.reshape(count, nblocks * block)[:, :n]
+
+
+def resample_chunk(args):
+    """
+    Compute the statistics of a chunk of resamples of all the rows.
+
+    :param args: The tuple (method, values, split, block, count, seed) where method is 'permutation' or 'bootstrap'
+    :return: The rows x count matrices of deltas and of median shifts
+    """
+    method, values, split, block, count, seed = args
+    rs = np.random.RandomState(seed)
+    rows, n = values.shape
+    if method == 'permutation':
+        indices = permutation_indices(rs, n, block, count)
+    else:
+        indices = np.hstack([bootstrap_indices(rs, 0, split, block, count),
+                             bootstrap_indices(rs, split, n - split, block, count)])
+
+    # All the resamples of all the rows, as rows x count rows.
+    resampled = values[:, indices].reshape(rows * count, n)
+    d, shift = shift_stats(resampled, split)
+    return d.reshape(rows, count), shift.reshape(rows, count)
+
+
+def run_chunks(method, values, split, block, resamples, seed, pool):
+    """
+    Draw the resamples in chunks of CHUNK_SIZE, each from a random state seeded from the seed of the run.
+
+    :return: The rows x resamples matrices of deltas and of median shifts
+    """
+    counts = [CHUNK_SIZE] * (resamples // CHUNK_SIZE)
+    if resamples % CHUNK_SIZE:
+        counts.append(resamples % CHUNK_SIZE)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=len(counts))
+    tasks = [(method, values, split, block, c, s) for (c, s) in zip(counts, seeds)]
+
+    results = pool.map(resample_chunk, tasks) if pool is not None else map(resample_chunk, tasks)
+    return np.hstack([r[0] for r in results]), np.hstack([r[1] for r in results])
+
+
+def permutation_test(values, split, resamples=1000, block=6, seed=0, pool=None):
+    """
+    Run the block permutation test of Cliff's Delta and of the median shift for every row.
+
+    :param values: The rows x months matrix, in chronological order
+    :param split: The index of the first month after the split
+    :param resamples: The number of permutations
+    :param block: The number of months of a block
+    :param seed: The seed of the random state
+    :param pool: A pool of worker processes to run the chunks of permutations in, this process if None
+    :return: The arrays of two sided p-values of the deltas and of the median shifts
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    d, shift = shift_stats(values, split)
+    perm_d, perm_shift = run_chunks('permutation', values, split, block, resamples, seed, pool)
+
+    # Count the permutations at least as extreme, the
+    # observed split being one of the permutations.
+    tol = 1e-12
+    d_p = (1 + (np.abs(perm_d) >= np.abs(d)[:, np.newaxis] - tol).sum(axis=1)) / (resamples + 1)
+    shift_p = (1 + (np.abs(perm_shift) >= np.abs(shift)[:, np.newaxis] - tol).sum(axis=1)) / (resamples + 1)
+    return d_p, shift_p
+
+
+def bootstrap_ci(values, split, resamples=1000, block=6, confidence=0.95, seed=0, pool=None):
+    """
+    Compute the block bootstrap percentile confidence intervals of Cliff's Delta and of the median shift for every row.
+
+    :param values: The rows x months matrix, in chronological order
+    :param split: The index of the first month after the split
+    :param resamples: The number of bootstrap samples
+    :param block: The number of months of a block
+    :param confidence: The coverage of the intervals
+    :param seed: The seed of the random state
+    :param pool: A pool of worker processes to run the chunks of samples in, this process if None
+    :return: The rows x 2 matrices of the (low, high) intervals of the deltas and of the median shifts
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    boot_d, boot_shift = run_chunks('bootstrap', values, split, block, resamples, seed, pool)
+
+    q = [50 * (1 - confidence), 50 * (1 + confidence)]
+    return np.percentile(boot_d, q, axis=1).T, np.percentile(boot_shift, q, axis=1).T
+
+
+def resample_stats(values, split, labels=None, resamples=1000, block=6, confidence=0.95, seed=0, pool=None):
+    """
+    Run the permutation test and compute the bootstrap confidence intervals for every row.
+
+    :param values: The rows x months matrix, in chronological order
+    :param split: The index of the first month after the split
+    :param labels: The queries of the rows, used as the index of the result
+    :param resamples: The number of permutations and of bootstrap samples
+    :param block: The number of months of a block
+    :param confidence: The coverage of the intervals
+    :param seed: The seed of the random state
+    :param pool: A pool of worker processes, this process if None
+    :return: A DataFrame with the delta, its p-value and interval and the median shift, its p-value and interval of
+             every query
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    d, shift = shift_stats(values, split)
+    d_p, shift_p = permutation_test(values, split, resamples, block, seed, pool)
+    d_ci, shift_ci = bootstrap_ci(values, split, resamples, block, confidence, seed + 1, pool)
+    return pd.DataFrame(OrderedDict([('delta', d), ('delta pvalue', d_p),
+                                     ('delta low', d_ci[:, 0]), ('delta high', d_ci[:, 1]),
+                                     ('shift', shift), ('shift pvalue', shift_p),
+                                     ('shift low', shift_ci[:, 0]), ('shift high', shift_ci[:, 1])]),
+                        index=labels)
+
+
+def main():
+    ap = ArgumentParser(description='Compute block permutation p-values and block bootstrap confidence intervals of '
+                                    'the trend shift of the queries of a seed at an incident date.')
+    ap.add_argument('-s', '-seed', help='Seed word', required=True)
+    ap.add_argument('-d', '-dir', help='Directory containing the trends data for seeds, or its trend store',
+                    required=True)
+    ap.add_argument('-i', '-inc', help='Incident date to split the trend data in YYYY-m-d format', required=True)
+    ap.add_argument('-r', '-rdir', help='Directory to put the results of the compute', required=True)
+    ap.add_argument('-n', '-num', help='Number of resamples', default=1000, type=int)
+    ap.add_argument('-k', '-block', help='Number of months of a block', default=6, type=int)
+    ap.add_argument('-c', '-conf', help='Coverage of the confidence intervals', default=0.95, type=float)
+    ap.add_argument('-x', '-rseed', help='Seed of the random state', default=0, type=int)
+    ap.add_argument('-p', '-procs', help='Number of worker processes, none by default', type=int)
+
+    args = ap.parse_args()
+
+    if not os.path.exists(args.r):
+        os.makedirs(args.r)
+
+    trends = open_trends(args.d)
+    labels, values, months = seed_matrix(trends, args.s)
+    split = int((months < np.datetime64(datetime.strptime(args.i, '%Y-%m-%d'))).sum())
+    if not labels or split == 0 or split == values.shape[1]:
+        print 'No trend data on both sides of the incident date for seed: ' + args.s
+        return
+
+    pool = Pool(args.p) if args.p else None
+    try:
+        df = resample_stats(values, split, labels, args.n, args.k, args.c, args.x, pool)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    df.to_csv(os.path.join(args.r, args.s + ' resampling.csv'), index_label='query')
+
+
+if __name__ == '__main__':
+    main()
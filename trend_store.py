@@ -0,0 +1,363 @@
+#!/usr/bin/env python2.7
+#
+# This script imports the Google trends data collected by google_trends.py into a columnar trend store, and contains the
+# loader used by the trend analysis scripts to read either a store or the original directories.
+#
+# google_trends.py writes one small csv file per query under gtrends/<collection mode>/<seed directory>/, with a date
+# column followed by the trend of the query (and of the seed reference when compared with the seed). Reading a seed
+# means parsing each of these files with pd.read_csv. A store holds the whole collection mode instead as:
+#
+# * values.npy: a float64 matrix with one row per column of every csv file and one column per month (NaN where a file
+#   has no value for the month), memory mapped when loaded
+# * dates.txt: the months, in column order
+# * rows.txt: the seed directory, file label and column name of every row, tab separated, in row order
+#
+# Loading a seed is then a slice of the matrix. TrendStore and CsvTrends have the same interface, and open_trends picks
+# the right one for a directory, so the analysis scripts accept either.
+#
+# This file also contains the scaling of trends compared with the reference of a seed to the reference trend pulled
+# alone, done over all the queries of a seed at once (see scale_to_reference).
+#
+# You will need to provide the following arguments to the argument parser for this script:
+#
+# * the collection mode directory to import (e.g. ./gtrends/with_seed_cmp/)
+# * optionally, the store directory to create, by default the same name under ./gtrendstore/
+#
+
+# standard library imports
+from __future__ import division
+from argparse import ArgumentParser
+from collections import OrderedDict
+import glob
+import os
+
+# third party imports
+import numpy as np
+import pandas as pd
+
+TREND_STORE_DIR = './gtrendstore/'
+VALUES_FILE = 'values.npy'
+
+
+class TrendStore(object):
+    def __init__(self, dates, rows, values):
+        """
+        Create a store from its parts. Use build to import trend directories and load to open a saved store.
+
+        :param dates: The list of months, in column order
+        :param rows: The list of (seed directory, file label, column name) tuples, in row order
+        :param values: The rows x months matrix of trend values
+        """
+        self.dates = list(dates)
+        self.rows = list(rows)
+        self.values = values
+
+        # Row range of each file, files being stored contiguously.
+        self._files = OrderedDict()
+        for (i, (seed, label, column)) in enumerate(self.rows):
+            start, end = self._files.get((seed, label), (i, i))
+            self._files[(seed, label)] = (start, i + 1)
+
+        self._seeds = OrderedDict()
+        for (seed, label) in self._files:
+            self._seeds.setdefault(seed, list()).append(label)
+
+    @classmethod
+    def build(cls, trends):
+        """
+        Import the trend data of every seed directory of a collection mode.
+
+        :param trends: The CsvTrends of the collection mode
+        :return: The store
+        """
+        frames = list()
+        rows = list()
+        for seed in trends.seeds():
+            for label in trends.files(seed):
+                df = trends.frame(seed, label)
+                if df.shape[1] < 2:
+                    continue
+                df = df.set_index('date')
+                frames.append(df)
+                rows.extend((seed, label, column) for column in df.columns)
+
+        dates = sorted(set().union(*[df.index for df in frames])) if frames else list()
+        values = np.full((len(rows), len(dates)), np.nan)
+        i = 0
+        for df in frames:
+            values[i:i + df.shape[1]] = df.reindex(dates).values.T
+            i += df.shape[1]
+        return cls(dates, rows, values)
+
+    def save(self, directory):
+        """
+        Save the store to a directory.
+
+        :param directory: The directory to save to, created if necessary
+        :return: None
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, VALUES_FILE), self.values)
+        with open(os.path.join(directory, 'dates.txt'), 'w') as f:
+            for d in self.dates:
+                f.write(d + '\n')
+        with open(os.path.join(directory, 'rows.txt'), 'w') as f:
+            for row in self.rows:
+                f.write('\t'.join(row) + '\n')
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load a store saved with save. The matrix is memory mapped unless specified otherwise.
+
+        :param directory: The directory the store was saved to
+        :param mmap: Set to False to read the matrix into memory
+        :return: The store
+        """
+        values = np.load(os.path.join(directory, VALUES_FILE), mmap_mode='r' if mmap else None)
+        with open(os.path.join(directory, 'dates.txt'), 'r') as f:
+            dates = [l.rstrip('\n') for l in f]
+        with open(os.path.join(directory, 'rows.txt'), 'r') as f:
+            rows = [tuple(l.rstrip('\n').split('\t')) for l in f]
+        return cls(dates, rows, values)
+
+    def seeds(self):
+        """
+        Get the seed directories of the store.
+
+        :return: The list of seed directories, '' standing for files directly under the collection mode directory
+        """
+        return list(self._seeds)
+
+    def files(self, seed):
+        """
+        Get the labels of the trend files of a seed directory, i.e. their names without the .csv extension.
+
+        :param seed: The seed directory
+        :return: The list of labels, in sorted order
+        """
+        return list(self._seeds.get(seed, ()))
+
+    def frame(self, seed, label):
+        """
+        Get the trend data of a file, as read by pd.read_csv from the file itself.
+
+        :param seed: The seed directory
+        :param label: The file label
+        :return: A DataFrame with the date column followed by the columns of the file
+        """
+        if (seed, label) not in self._files:
+            return pd.DataFrame()
+        start, end = self._files[(seed, label)]
+        values = np.asarray(self.values[start:end]).T
+
+        # Leave out the months missing from the file, and give integer
+        # columns back as integers as pd.read_csv does.
+        keep = ~np.isnan(values).all(axis=1)
+        values = values[keep]
+        if np.array_equal(values, np.round(values)):
+            values = values.astype(np.int64)
+        df = pd.DataFrame(values, columns=[r[2] for r in self.rows[start:end]])
+        df.insert(0, 'date', [d for (d, k) in zip(self.dates, keep) if k])
+        return df
+
+    def matrix(self, seed, column=1):
+        """
+        Get one column of every file of a seed directory as a matrix, e.g. the trends of the queries themselves (the
+        first column after the date) or of the seed reference they were compared with (the second).
+
+        :param seed: The seed directory
+        :param column: The position of the column within its file, the date being column 0
+        :return: The labels of the files having that column, the name of that column in each of them (e.g. the query)
+                 and the labels x months matrix of their values
+        """
+        labels = list()
+        columns = list()
+        index = list()
+        for label in self._seeds.get(seed, ()):
+            start, end = self._files[(seed, label)]
+            if start + column - 1 < end:
+                labels.append(label)
+                columns.append(self.rows[start + column - 1][2])
+                index.append(start + column - 1)
+        return labels, columns, np.asarray(self.values[index])
+
+    def months(self, seed):
+        """
+        Get the months of the columns of the matrices of a seed directory.
+
+        :param seed: The seed directory
+        :return: The list of months
+        """
+        return list(self.dates)
+
+
+class CsvTrends(object):
+    def __init__(self, directory):
+        """
+        Read the trend data of a collection mode from the directories written by google_trends.py.
+
+        :param directory: The collection mode directory, e.g. ./gtrends/with_seed_cmp/
+        """
+        self.directory = directory
+
+    def seeds(self):
+        seeds = sorted(d for d in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, d)))
+        if glob.glob(os.path.join(self.directory, '*.csv')):
+            seeds.insert(0, '')
+        return seeds
+
+    def files(self, seed):
+        filenames = glob.glob(os.path.join(self.directory, seed, '*.csv'))
+        return sorted(os.path.basename(f)[:-len('.csv')] for f in filenames)
+
+    def frame(self, seed, label):
+        filename = os.path.join(self.directory, seed, label + '.csv')
+        df = pd.DataFrame()
+        if os.path.isfile(filename):
+            df = pd.read_csv(filename, header=0)
+        return df
+
+    def matrix(self, seed, column=1):
+        labels = list()
+        columns = list()
+        rows = list()
+        for label in self.files(seed):
+            df = self.frame(seed, label)
+            if column < df.shape[1]:
+                labels.append(label)
+                columns.append(df.columns[column])
+                rows.append(df.iloc[:, column].values)
+        return labels, columns, np.array(rows, dtype=np.float64)
+
+    def months(self, seed):
+        files = self.files(seed)
+        if not files:
+            return list()
+        return self.frame(seed, files[0])['date'].tolist()
+
+
+def scale_to_reference(ref_trends, ref_scaled, trends, tolerance=2.5):
+    """
+    Scale trends pulled along with a reference to the trend of the reference pulled alone. Each row is scaled, rounding
+    up, by the factor bringing the maximum of the reference trend pulled with it to 100. A row is rejected if that
+    reference trend has no non-zero value, or if once scaled it differs from the reference pulled alone by more than the
+    tolerance per month: compared to the peak of the row, the reference then only has minute data and the scale would be
+    meaningless.
+
+    :param ref_trends: The rows x months matrix of the reference trend pulled along with each row
+    :param ref_scaled: The reference trend pulled alone
+    :param trends: The rows x months matrix of the trends to scale
+    :param tolerance: The largest average absolute difference per month between the scaled reference trends
+    :return: The rows x months matrix of scaled trends, as integers, and the boolean array of the rows accepted
+    """
+    ref_trends = np.asarray(ref_trends, dtype=np.float64)
+    ref_scaled = np.asarray(ref_scaled, dtype=np.float64)
+    trends = np.asarray(trends, dtype=np.float64)
+
+    peaks = ref_trends.max(axis=1)
+    accepted = peaks > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = (100 / peaks)[:, np.newaxis]
+        scaled_diff = np.abs(np.ceil(ref_trends * factors) - ref_scaled).sum(axis=1)
+        scaled = np.ceil(trends * factors)
+        accepted &= scaled_diff <= int(len(ref_scaled) * tolerance)
+
+    scaled[~accepted] = 0
+    return scaled.astype(np.int64), accepted
+
+
+def scale_seed_trends(trends, seed, ref):
+    """
+    Scale the trends of the queries of a seed directory compared with the reference of the seed to the trend of the
+    reference pulled alone, which is the file of the reference in the directory.
+
+    :param trends: The TrendStore or CsvTrends of the collection mode
+    :param seed: The seed directory
+    :param ref: The reference of the seed
+    :return: A DataFrame with the date column followed by the scaled trend of every query accepted, None if the reference
+             has no trend data
+    """
+    labels, queries, values = trends.matrix(seed, column=1)
+    if ref not in labels:
+        return None
+    ref_labels, ref_queries, ref_values = trends.matrix(seed, column=2)
+
+    # The reference trend of a file is its column named after the
+    # reference: the first one in the file of the reference, which
+    # may also hold the seed, and the second one in the other files.
+    r = labels.index(ref)
+    ref_trends = values.copy()
+    compared = np.array([q == ref for q in queries])
+    index = dict((l, i) for (i, l) in enumerate(labels))
+    for (l, q, v) in zip(ref_labels, ref_queries, ref_values):
+        if q == ref and not compared[index[l]]:
+            ref_trends[index[l]] = v
+            compared[index[l]] = True
+
+    # Only keep the months of the seed.
+    months = ~np.isnan(values[r])
+    values = values[:, months]
+    ref_trends = ref_trends[:, months]
+
+    scaled, accepted = scale_to_reference(ref_trends, values[r], values)
+    accepted &= compared & (values > 0).any(axis=1)
+
+    columns = [q for (q, a) in zip(queries, accepted) if a]
+    df = pd.DataFrame(scaled[accepted].T, columns=columns)
+    if columns:
+        df.insert(0, 'date', trends.frame(seed, ref)['date'])
+    return df
+
+
+def seed_matrix(trends, seed):
+    """
+    Get the trends of the queries of a seed directory over the months all of them have, in chronological order.
+
+    :param trends: The TrendStore or CsvTrends of the collection mode
+    :param seed: The seed directory
+    :return: The queries, the queries x months matrix and the array of months as datetime64
+    """
+    _, queries, values = trends.matrix(seed)
+    months = pd.to_datetime(trends.months(seed), format='%Y-%m-%d').values
+    if not queries:
+        return queries, values, months
+
+    keep = ~np.isnan(values).any(axis=0)
+    order = np.argsort(months[keep], kind='mergesort')
+    return queries, values[:, keep][:, order], months[keep][order]
+
+
+def open_trends(directory):
+    """
+    Open the trend data of a collection mode, from a store if the directory holds one, or else from the csv files.
+
+    :param directory: A store directory or a collection mode directory
+    :return: The TrendStore or CsvTrends
+    """
+    if os.path.isfile(os.path.join(directory, VALUES_FILE)):
+        return TrendStore.load(directory)
+    return CsvTrends(directory)
+
+
+def main():
+    ap = ArgumentParser(description='Import the trends data of a collection mode into a trend store.')
+    ap.add_argument('-t', '-tdir', help='Directory containing the trends data for seeds, e.g. ./gtrends/with_seed_cmp/',
+                    required=True)
+    ap.add_argument('-o', '-out', help='Directory of the store, by default the name of the trends directory under ' +
+                                       TREND_STORE_DIR)
+
+    args = ap.parse_args()
+
+    out = args.o
+    if out is None:
+        out = os.path.join(TREND_STORE_DIR, os.path.basename(os.path.normpath(args.t)))
+
+    store = TrendStore.build(CsvTrends(args.t))
+    store.save(out)
+    print out, len(store.seeds()), len(store.rows), len(store.dates)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#
+# This file contains the nonparametric tests comparing the trends of queries before and after an incident date (see
+# google_trends_analysis.py), computed for all the queries of a seed at once.
+#
+# The tests are run over a queries x months matrix split into the months before and after the incident. Every test only
+# depends on the ordering of the values of a row, so each row is sorted once, together with a mask telling which of its
+# values come before the split, and the statistics are read off cumulative counts over the sorted rows:
+#
+# * the two sample Kolmogorov-Smirnov statistic is the largest difference between the counts before and after the
+#   split at the end of each run of tied values, and its p-value follows scipy.stats.ks_2samp
+# * the Mann-Whitney U statistic (or Wilcoxon rank-sum) comes from the average ranks of the tied runs, and its p-value
+#   from the normal approximation with tie and continuity corrections, as in scipy.stats.mannwhitneyu
+# * Cliff's Delta counts, for every value before the split, the values after it that are smaller and larger, as
+#   cliffs_delta in deprecated/trend_stats.py does one row at a time
+#
+# Since the rows are sorted over all their months, the same sorted rows serve any split month (see sweep_tests).
+#
+# The counts and ranks are exact, and the floating point operations are the same as those of the one row functions,
+# so the results are identical to them.
+#
+
+# standard library imports
+from __future__ import division
+from collections import OrderedDict
+
+# third party imports
+import numpy as np
+import pandas as pd
+from scipy.stats import distributions
+
+
+class SortedSeries(object):
+    def __init__(self, values):
+        """
+        Sort the rows of a queries x months matrix, to be split at any month afterwards.
+
+        :param values: The queries x months matrix, in chronological order
+        """
+        values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+        self.order = np.argsort(values, axis=1, kind='mergesort')
+        values = np.take_along_axis(values, self.order, axis=1)
+
+        # Runs of tied values: the position of the first value of the run
+        # and the position after its last value, for every position.
+        rows, n = values.shape
+        positions = np.broadcast_to(np.arange(n), (rows, n))
+        first = np.ones((rows, n), dtype=bool)
+        first[:, 1:] = values[:, 1:] != values[:, :-1]
+        self.last = np.ones((rows, n), dtype=bool)
+        self.last[:, :-1] = first[:, 1:]
+        self.start = np.maximum.accumulate(np.where(first, positions, 0), axis=1)
+        self.end = np.minimum.accumulate(np.where(self.last, positions + 1, n)[:, ::-1], axis=1)[:, ::-1]
+
+    def split(self, split):
+        """
+        Split the sorted rows at a month, without sorting them again.
+
+        :param split: The index of the first month after the split
+        :return: The SortedSamples of the months before and after the split
+        """
+        samples = SortedSamples.__new__(SortedSamples)
+        samples._split(self, split)
+        return samples
+
+
+class SortedSamples(object):
+    def __init__(self, pre, post):
+        """
+        Sort the rows of two samples, the values of each row before and after the split.
+
+        :param pre: The queries x months matrix of the values before the split
+        :param post: The queries x months matrix of the values after the split
+        """
+        pre = np.atleast_2d(np.asarray(pre, dtype=np.float64))
+        post = np.atleast_2d(np.asarray(post, dtype=np.float64))
+        self._split(SortedSeries(np.hstack([pre, post])), pre.shape[1])
+
+    def _split(self, series, split):
+        self.n1 = split
+        self.n2 = series.order.shape[1] - split
+        self.is_pre = series.order < split
+        self.last = series.last
+        self.start = series.start
+        self.end = series.end
+
+        # Number of values before and after the split up to each position, included.
+        self.count_pre = np.cumsum(self.is_pre, axis=1)
+        self.count_post = np.cumsum(~self.is_pre, axis=1)
+
+
+def ks_2samp(pre, post, samples=None):
+    """
+    Compute the two sample Kolmogorov-Smirnov test of every row, as scipy.stats.ks_2samp.
+
+    :param pre: The queries x months matrix of the values before the split
+    :param post: The queries x months matrix of the values after the split
+    :param samples: The SortedSamples of pre and post, if already computed
+    :return: The arrays of KS statistics and p-values
+    """
+    s = samples if samples is not None else SortedSamples(pre, post)
+    n1, n2 = s.n1, s.n2
+
+    cdf1 = s.count_pre / n1
+    cdf2 = s.count_post / n2
+    d = np.where(s.last, np.absolute(cdf1 - cdf2), 0.0).max(axis=1)
+
+    en = np.sqrt(n1 * n2 / (n1 + n2))
+    prob = distributions.kstwobign.sf((en + 0.12 + 0.11 / en) * d)
+    return d, prob
+
+
+def mannwhitneyu(pre, post, alternative='two-sided', samples=None):
+    """
+    Compute the Mann-Whitney U test (Wilcoxon rank-sum) of every row, as scipy.stats.mannwhitneyu with the continuity
+    correction. Rows with all their values equal get NaN, where scipy raises a ValueError.
+
+    :param pre: The queries x months matrix of the values before the split
+    :param post: The queries x months matrix of the values after the split
+    :param alternative: 'two-sided', 'less' or 'greater', the alternative hypothesis for the values before the split
+    :param samples: The SortedSamples of pre and post, if already computed
+    :return: The arrays of U statistics of the values after the split and p-values
+    """
+    s = samples if samples is not None else SortedSamples(pre, post)
+    n1, n2 = s.n1, s.n2
+
+    # Average rank of every position, and rank sum of the values before the split.
+    ranks = .5 * (s.end + s.start + 1)
+    rank_pre = np.where(s.is_pre, ranks, 0.0).sum(axis=1)
+    u1 = n1*n2 + (n1*(n1+1))/2.0 - rank_pre
+    u2 = n1*n2 - u1
+
+    # Tie correction, from the size of every run of tied values.
+    size = np.float64(n1 + n2)
+    cnt = np.where(s.last, s.end - s.start, 0).astype(np.float64)
+    if size < 2:
+        T = np.ones(len(cnt))
+    else:
+        T = 1.0 - (cnt**3 - cnt).sum(axis=1) / (size**3 - size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(T * n1 * n2 * (n1+n2+1) / 12.0)
+        sd[T == 0] = np.nan
+
+        meanrank = n1*n2/2.0 + 0.5
+        if alternative == 'two-sided':
+            bigu = np.maximum(u1, u2)
+        elif alternative == 'less':
+            bigu = u1
+        elif alternative == 'greater':
+            bigu = u2
+        else:
+            raise ValueError("alternative should be 'less', 'greater' or 'two-sided'")
+
+        z = (bigu - meanrank) / sd
+        if alternative == 'two-sided':
+            p = 2 * distributions.norm.sf(abs(z))
+        else:
+            p = distributions.norm.sf(z)
+
+    u2[T == 0] = np.nan
+    return u2, p
+
+
+def cliffs_delta(pre, post, dull=0.147, samples=None):
+    """
+    Compute Cliff's Delta of every row, as cliffs_delta in deprecated/trend_stats.py.
+
+    :param pre: The queries x months matrix of the values before the split
+    :param post: The queries x months matrix of the values after the split
+    :param dull: The smallest absolute delta considered a difference (0.147 for small, 0.33 for medium and 0.474 for
+                 large)
+    :param samples: The SortedSamples of pre and post, if already computed
+    :return: The arrays of deltas and of whether they are larger than dull
+    """
+    s = samples if samples is not None else SortedSamples(pre, post)
+    m, n = s.n1, s.n2
+
+    # Values after the split smaller than each value (before its run of
+    # ties) and larger than it (after its run of ties).
+    smaller = np.take_along_axis(s.count_post, s.start, axis=1) - np.take_along_axis(~s.is_pre, s.start, axis=1)
+    larger = n - np.take_along_axis(s.count_post, s.end - 1, axis=1)
+    more = np.where(s.is_pre, smaller, 0).sum(axis=1)
+    less = np.where(s.is_pre, larger, 0).sum(axis=1)
+
+    d = (more - less) / (m*n)
+    return d, abs(d) > dull
+
+
+def split_tests(values, split, labels=None):
+    """
+    Run all the tests on a queries x months matrix split at a given month.
+
+    :param values: The queries x months matrix, in chronological order
+    :param split: The index of the first month after the split
+    :param labels: The queries of the rows, used as the index of the result
+    :return: A DataFrame with the KS statistic and p-value, the two sided Mann-Whitney U statistic and p-value and the
+             Cliff's Delta of every query
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    pre, post = values[:, :split], values[:, split:]
+    samples = SortedSamples(pre, post)
+
+    ks, ks_p = ks_2samp(pre, post, samples=samples)
+    u, u_p = mannwhitneyu(pre, post, samples=samples)
+    d, _ = cliffs_delta(pre, post, samples=samples)
+    return pd.DataFrame(OrderedDict([('ks', ks), ('ks pvalue', ks_p), ('u', u), ('u pvalue', u_p), ('delta', d)]),
+                        index=labels)
+
+
+def sweep_tests(values, splits):
+    """
+    Compute the KS statistic and Cliff's Delta of every row for every split month of a range. The rows are sorted once,
+    and only the counts of the months before and after each split are recomputed.
+
+    :param values: The queries x months matrix, in chronological order
+    :param splits: The indices of the first month after each split
+    :return: The splits x queries matrices of KS statistics and of deltas
+    """
+    series = SortedSeries(values)
+    ks = np.zeros((len(splits), len(series.order)))
+    deltas = np.zeros((len(splits), len(series.order)))
+    for (i, split) in enumerate(splits):
+        samples = series.split(split)
+        ks[i] = ks_2samp(None, None, samples=samples)[0]
+        deltas[i] = cliffs_delta(None, None, samples=samples)[0]
+    return ks, deltas